@@ -0,0 +1,92 @@
+"""Benchmark of the occupancy map rasterization (points per second), comparing the legacy per-point python loop
+to the vectorized implementation used in coclico.metrics.occupancy_map
+
+Usage: python -m benchmark.benchmark_occupancy_map --nb-points 1000000
+"""
+
+import argparse
+import time
+from typing import Tuple
+
+import numpy as np
+
+from coclico.metrics.commons import get_raster_geometry_from_las_bounds
+from coclico.metrics.occupancy_map import _create_2d_occupancy_array
+
+
+def _create_2d_occupancy_array_loop(
+    xs: np.array,
+    ys: np.array,
+    pixel_size: float,
+    x_min: float,
+    y_max: float,
+    nb_pixels: Tuple[int, int] = (1000, 1000),
+) -> np.array:
+    """Legacy implementation of occupancy_map._create_2d_occupancy_array (one python iteration per point)"""
+    grid = np.zeros((nb_pixels[1], nb_pixels[0]), dtype=bool)
+
+    for x, y in zip(xs, ys):
+        grid_x = min(int((x - (x_min - pixel_size / 2)) / pixel_size), nb_pixels[0] - 1)
+        grid_y = min(int(((y_max + pixel_size / 2) - y) / pixel_size), nb_pixels[1] - 1)
+        grid[grid_y, grid_x] = True
+
+    return grid
+
+
+def generate_points(nb_points: int, tile_size: float = 1000, seed: int = 0):
+    """Generate random points on a tile, with coordinates rounded to the centimeter like in a las file"""
+    rng = np.random.default_rng(seed)
+    xs = np.round(770000 + rng.uniform(0, tile_size, nb_points), 2)
+    ys = np.round(6278000 + rng.uniform(0, tile_size, nb_points), 2)
+
+    return xs, ys
+
+
+def time_function(func, *args, repeat: int = 1) -> float:
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        durations.append(time.perf_counter() - start)
+
+    return min(durations)
+
+
+def run_benchmark(nb_points: int, nb_points_loop: int, pixel_size: float, repeat: int):
+    xs, ys = generate_points(nb_points)
+    top_left, nb_pixels = get_raster_geometry_from_las_bounds(
+        (np.min(xs), np.min(ys), np.max(xs), np.max(ys)), pixel_size
+    )
+    args = (xs, ys, pixel_size, top_left[0], top_left[1], nb_pixels)
+    loop_args = (xs[:nb_points_loop], ys[:nb_points_loop], pixel_size, top_left[0], top_left[1], nb_pixels)
+
+    # check that both implementations generate the same map before timing them
+    if not np.array_equal(_create_2d_occupancy_array_loop(*loop_args), _create_2d_occupancy_array(*loop_args)):
+        raise RuntimeError("Vectorized occupancy map differs from the legacy implementation")
+
+    loop_duration = time_function(_create_2d_occupancy_array_loop, *loop_args)
+    vectorized_duration = time_function(_create_2d_occupancy_array, *args, repeat=repeat)
+
+    loop_speed = nb_points_loop / loop_duration
+    vectorized_speed = nb_points / vectorized_duration
+    print(f"Map size: {nb_pixels[0]} x {nb_pixels[1]} pixels ({pixel_size} m)")
+    print(f"Legacy python loop: {loop_speed:,.0f} points/s ({nb_points_loop} points in {loop_duration:.3f} s)")
+    print(f"Vectorized:         {vectorized_speed:,.0f} points/s ({nb_points} points in {vectorized_duration:.3f} s)")
+    print(f"Speedup: x{vectorized_speed / loop_speed:.1f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark occupancy map rasterization")
+    parser.add_argument("-n", "--nb-points", type=int, default=10_000_000, help="Number of points (vectorized)")
+    parser.add_argument(
+        "-l", "--nb-points-loop", type=int, default=1_000_000, help="Number of points for the legacy loop"
+    )
+    parser.add_argument("-p", "--pixel-size", type=float, default=0.5, help="Size of the output raster pixels")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Number of repetitions (best time is kept)")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    run_benchmark(args.nb_points, args.nb_points_loop, args.pixel_size, args.repeat)
@@ -1,2 +1,28 @@
 csv_separator = ";"
 composed_class_separator = "_"
+# Maximum number of points decoded at once when reading las files
+las_read_chunk_size = 1_000_000
+# Memory-map the point records of uncompressed las files instead of copying them
+las_memory_map = True
+# Number of threads used to decompress laz files (0 to use all the CPUs available to the container)
+laz_threads = 1
+# Memory budget (in bytes) of the in-process cache of the artifacts derived from the tiles (occupancy maps, ...)
+cache_max_bytes = 1024**3
+# Number of classes for which the MALT0 delaunay height rasters are computed at the same time (0 to use all the CPUs
+# available to the container)
+mnx_workers = 0
+# Size (in pixels) of the blocks in which the MALT0 delaunay height rasters are split to triangulate dense classes
+# (0 to triangulate each class at once), and size (in pixels) of the halo of points used around each block
+mnx_block_size = 0
+mnx_block_halo = 20
+# Step (in meters) of the integer encoding of the MALT0 height rasters (eg. 0.01 to store centimeters in int16/int32
+# compressed rasters with scale/offset metadata), 0 to store them as float32
+mnx_quantization_step = 0
+# Compression of the intermediate rasters written by each metric ("deflate", "zstd", "lzw", or None for no
+# compression), cf. coclico.io.write_raster
+raster_compression = {"mpla0": "deflate", "malt0": "deflate", "malt0_diff": "deflate"}
+# Number of threads used to compress the rasters (0 to use all the CPUs available to the container)
+raster_compression_threads = 0
+# Maximum proportion of pixels with values for a layer of the MPLA0/MALT0 intrinsic rasters to be also stored as a
+# list of pixels (cf. coclico.metrics.commons.tag_sparse_layers), 0 to disable
+sparse_layer_max_occupancy = 0.01
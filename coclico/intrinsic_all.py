@@ -0,0 +1,133 @@
+import argparse
+import logging
+from pathlib import Path
+from typing import List
+
+from gpao.job import Job
+from gpao_utils.store import Store
+
+import coclico.metrics.occupancy_map as occupancy_map
+from coclico.config import laz_threads
+from coclico.io import LAS_DIMENSIONS, configure_laz_decompression, read_config_file
+from coclico.metrics.listing import METRICS
+from coclico.metrics.metric import get_reader_options
+from coclico.version import __version__
+
+
+def compute_intrinsic_all(las_file: Path, config_file: Path, output_dir: Path, output_stem: str = None):
+    """Compute the intrinsic metrics of all the metrics that are in the config file for a single tile,
+    reading the las file only once.
+
+    Results are saved with the same layout as the one used by the metric-by-metric jobs:
+    output_dir / <metric_name> / "intrinsic" / <output_stem><metric intrinsic output extension>
+
+    Args:
+        las_file (Path): path to the las file on which to generate the intrinsic metrics
+        config_file (Path): Coclico configuration file (to know which metrics to compute)
+        output_dir (Path): root folder for the results (eg. the "ref" folder in the comparison output folder)
+        output_stem (str, optional): name of the output files without extension (the tile name, used to match the
+        tiles of the different classifications in the relative metrics). Defaults to None (stem of las_file).
+    """
+    config_dict = read_config_file(config_file)
+    output_stem = output_stem or las_file.stem
+    # Z is only used by the MALT0 height rasters
+    points = occupancy_map.read_las(las_file, LAS_DIMENSIONS)
+
+    for metric_name, metric_class in METRICS.items():
+        if metric_name in config_dict.keys():
+            metric = metric_class(None, config_file)
+            output = output_dir / metric_name / "intrinsic" / f"{output_stem}{metric.intrinsic_output_extension}"
+            logging.debug(f"Compute {metric_name} intrinsic metric for {las_file.name} in {output}")
+            metric.compute_metric_intrinsic_from_points(las_file, points, output)
+
+
+def create_intrinsic_all_jobs(
+    name: str,
+    tile_names: List[str],
+    input_path: Path,
+    out_path: Path,
+    store: Store,
+    config_file: Path,
+    laz_threads: int = None,
+) -> List[Job]:
+    """Create jobs to compute all intrinsic metrics for a single classified point cloud folder
+    (eg. ref, c1 or c2), with one job per tile
+
+    Args:
+        name (str): classification name (used for job name creation)
+        tile_names (List[str]): list of the filenames of the tiles on which to calculate the result
+        input_path (Path): input folder path (path to the results of the classification)
+        out_path (Path): root folder for the results of the classification (contains one folder per metric)
+        store (Store): Store object (as defined in gpao_utils) to handle mount points of distant stores
+        config_file (Path): Coclico configuration file
+        laz_threads (int, optional): if set, number of threads used to decompress laz files (0 to use all the CPUs
+        available to the container). Defaults to None (default of the job).
+
+    Returns:
+        List[Job]: List of GPAO jobs to create
+    """
+    jobs = []
+    for tile_name in tile_names:
+        input = input_path / tile_name
+        job_name = f"intrinsic_all_{name}_{input.stem}"
+        command = f"""
+docker run -t --rm --userns=host --shm-size=2gb
+-v {store.to_unix(input)}:/input
+-v {store.to_unix(out_path)}:/output
+-v {store.to_unix(config_file.parent)}:/config
+ghcr.io/ignf/coclico:{__version__}
+python -m coclico.intrinsic_all
+--input-file /input
+--output-dir /output
+--output-stem {input.stem}
+--config-file /config/{config_file.name}
+{get_reader_options(laz_threads=laz_threads)}
+"""
+        jobs.append(Job(job_name, command, tags=["docker"]))
+
+    return jobs
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Run all intrinsic metrics on one tile")
+    parser.add_argument("-i", "--input-file", type=Path, required=True, help="Path to the LAS file")
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        type=Path,
+        required=True,
+        help="Path to the output folder (results are saved in <output-dir>/<metric>/intrinsic/)",
+    )
+    parser.add_argument(
+        "--output-stem",
+        type=str,
+        default=None,
+        help="Name of the output files without extension (defaults to the name of the input file). "
+        "Used in docker jobs, where the input file is mounted with a generic name",
+    )
+    parser.add_argument(
+        "-c",
+        "--config-file",
+        type=Path,
+        required=True,
+        help="Coclico configuration file",
+    )
+    parser.add_argument(
+        "--laz-threads",
+        type=int,
+        default=laz_threads,
+        help="Number of threads used to decompress LAZ files (0 to use all the CPUs available to the container)",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(format="%(message)s", level=logging.DEBUG)
+    configure_laz_decompression(args.laz_threads)
+    compute_intrinsic_all(
+        las_file=Path(args.input_file),
+        config_file=args.config_file,
+        output_dir=args.output_dir,
+        output_stem=args.output_stem,
+    )
@@ -1,10 +1,73 @@
 import logging
-from typing import Dict
+import os
+from pathlib import Path
+from typing import Dict, Iterator, List, NamedTuple, Sequence, Tuple
 
+import laspy
+import numpy as np
+import rasterio
 import yaml
 
+from coclico.config import (
+    las_memory_map,
+    las_read_chunk_size,
+    laz_threads,
+    raster_compression_threads,
+)
+from coclico.metrics.commons import MAX_CLASS_KEYS, tag_empty_layers, tag_sparse_layers
 from coclico.metrics.listing import METRICS
 
+# laspy backend used to decompress laz files (None for laspy default backend), cf. configure_laz_decompression
+_laz_backend = None
+
+# Dimensions (named as in laspy) that are used by the intrinsic metrics
+LAS_DIMENSIONS = ("X", "Y", "Z", "classification")
+
+# Layers to decompress in a laz file (for point formats 6 to 10) for each dimension
+LAS_DECOMPRESSION_SELECTIONS = {
+    "X": laspy.DecompressionSelection.XY_RETURNS_CHANNEL,
+    "Y": laspy.DecompressionSelection.XY_RETURNS_CHANNEL,
+    "Z": laspy.DecompressionSelection.Z,
+    "classification": laspy.DecompressionSelection.CLASSIFICATION,
+}
+
+
+class LasPoints(NamedTuple):
+    """Points of a las file, restricted to the dimensions used by the metrics.
+
+    X, Y and Z are the raw integer coordinates as stored in the las file (scaled coordinates are computed on demand
+    with the xs, ys and zs properties). Dimensions that have not been read are set to None.
+    """
+
+    X: np.ndarray
+    Y: np.ndarray
+    Z: np.ndarray
+    classification: np.ndarray
+    scales: np.ndarray
+    offsets: np.ndarray
+    crs: object
+
+    @property
+    def xs(self) -> np.ndarray:
+        return self.X * self.scales[0] + self.offsets[0]
+
+    @property
+    def ys(self) -> np.ndarray:
+        return self.Y * self.scales[1] + self.offsets[1]
+
+    @property
+    def zs(self) -> np.ndarray:
+        return self.Z * self.scales[2] + self.offsets[2]
+
+    @property
+    def nbytes(self) -> int:
+        """Number of bytes used by the decoded dimensions"""
+        return sum(array.nbytes for array in (self.X, self.Y, self.Z, self.classification) if array is not None)
+
+    @property
+    def nb_points(self) -> int:
+        return len(next(array for array in (self.X, self.Y, self.Z, self.classification) if array is not None))
+
 
 def read_config_file(config_file: str) -> Dict:
     with open(config_file, "r") as f:
@@ -23,5 +86,360 @@ def read_config_file(config_file: str) -> Dict:
                 f" in {config_file}: keys for metric {metric_name} ({list(metric_dict.keys())}) do not match "
                 f"expected keys: {list(expected_metric_keys)}"
             )
+        # the classes of a metric are processed with a classification bitmask (cf. commons.create_class_bitmask_lut)
+        if len(metric_dict["weights"]) > MAX_CLASS_KEYS:
+            raise ValueError(
+                f" in {config_file}: metric {metric_name} has {len(metric_dict['weights'])} classes, at most "
+                f"{MAX_CLASS_KEYS} classes are supported"
+            )
 
     return config
+
+
+def _read_cgroup_cpu_quota(cgroup_root: Path = Path("/sys/fs/cgroup")) -> float:
+    """Read the CPU quota of the cgroup of the process (eg. set with `docker run --cpus`), for cgroup v2 or v1
+
+    Args:
+        cgroup_root (Path, optional): cgroup filesystem mount point. Defaults to Path("/sys/fs/cgroup").
+
+    Returns:
+        float: number of CPUs allowed by the quota, or None if there is no quota
+    """
+    try:
+        quota, period = (cgroup_root / "cpu.max").read_text().split()
+        return int(quota) / int(period) if quota != "max" else None
+    except (OSError, ValueError):
+        pass
+
+    try:
+        quota = int((cgroup_root / "cpu" / "cpu.cfs_quota_us").read_text())
+        period = int((cgroup_root / "cpu" / "cpu.cfs_period_us").read_text())
+        return quota / period if quota > 0 and period > 0 else None
+    except (OSError, ValueError):
+        pass
+
+    return None
+
+
+def get_available_cpu_count(cgroup_root: Path = Path("/sys/fs/cgroup")) -> int:
+    """Get the number of CPUs that the process can use: the CPUs it is allowed to run on, limited by the cgroup CPU
+    quota if there is one (which is the case in a docker container run with --cpus)
+
+    Args:
+        cgroup_root (Path, optional): cgroup filesystem mount point. Defaults to Path("/sys/fs/cgroup").
+
+    Returns:
+        int: number of available CPUs (at least 1)
+    """
+    cpu_count = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    quota = _read_cgroup_cpu_quota(cgroup_root)
+    if quota is not None:
+        cpu_count = min(cpu_count, int(quota))
+
+    return max(1, cpu_count)
+
+
+def configure_laz_decompression(threads: int = laz_threads) -> int:
+    """Configure the backend used by all the las readers of coclico to decompress laz files:
+    - the multithreaded lazrs backend is used when more than 1 thread is requested (and lazrs is available)
+    - the default laspy backend (single-threaded) is used otherwise
+
+    The number of threads is capped to the number of available CPUs (cf. get_available_cpu_count), so that it
+    respects the CPU quota of the container. It has to be configured before any laz file is decompressed
+    (lazrs reads the RAYON_NUM_THREADS environment variable when its thread pool is created).
+
+    Args:
+        threads (int, optional): number of threads used to decompress laz files, 0 to use all the available CPUs.
+        Defaults to laz_threads (from coclico.config).
+
+    Returns:
+        int: number of threads that will actually be used
+    """
+    global _laz_backend
+
+    available_cpu_count = get_available_cpu_count()
+    threads = available_cpu_count if threads == 0 else min(threads, available_cpu_count)
+
+    if threads > 1 and laspy.LazBackend.LazrsParallel.is_available():
+        os.environ["RAYON_NUM_THREADS"] = str(threads)
+        _laz_backend = laspy.LazBackend.LazrsParallel
+    else:
+        threads = 1
+        _laz_backend = None
+    logging.debug(f"Laz decompression uses {threads} thread(s) ({available_cpu_count} CPU(s) available)")
+
+    return threads
+
+
+def get_decompression_selection(dimensions: Sequence[str]) -> laspy.DecompressionSelection:
+    """Get the laz layers that have to be decompressed to read dimensions (only the base layer is decompressed for
+    the other dimensions). Selective decompression is only possible for point formats 6 to 10: the other point
+    formats are always fully decompressed.
+
+    Args:
+        dimensions (Sequence[str]): dimensions to read (among LAS_DIMENSIONS)
+
+    Returns:
+        laspy.DecompressionSelection: layers to decompress
+    """
+    selection = laspy.DecompressionSelection.base()
+    for dimension in dimensions:
+        selection |= LAS_DECOMPRESSION_SELECTIONS[dimension]
+
+    return selection
+
+
+def read_las_header(las_file: Path) -> Tuple[Tuple[float, float, float, float], object]:
+    """Read the bounds and the crs of a las file from its header only (no point is decoded)
+
+    Args:
+        las_file (Path): path to the las file to read
+
+    Returns:
+        Tuple[Tuple[float, float, float, float], object]: ((x_min, y_min, x_max, y_max), crs)
+    """
+    with laspy.open(las_file) as f:
+        header = f.header
+        las_bounds = (header.mins[0], header.mins[1], header.maxs[0], header.maxs[1])
+        crs = header.parse_crs()
+
+    return las_bounds, crs
+
+
+def _get_chunk_dimension(chunk: laspy.PackedPointRecord, dimension: str) -> np.ndarray:
+    """Get a dimension of a chunk of points with its compact type (int32 for coordinates, uint8 for
+    classification, whatever the point format)"""
+    if dimension == "classification":
+        return np.asarray(chunk[dimension], dtype=np.uint8)
+
+    return np.asarray(chunk[dimension], dtype=np.int32)
+
+
+def _get_records_dimension(records: np.ndarray, dimension: str) -> np.ndarray:
+    """Get a dimension of memory-mapped point records as a strided view (no copy), except for the classification of
+    point formats 0 to 5 which is stored in a bit field"""
+    if dimension == "classification" and "classification" not in records.dtype.names:
+        # classification is stored in the 5 lower bits of raw_classification for point formats 0 to 5
+        return records["raw_classification"] & np.uint8(0b11111)
+
+    return records[dimension]
+
+
+def _can_memory_map(header: laspy.LasHeader) -> bool:
+    return las_memory_map and not header.are_points_compressed and header.point_count > 0
+
+
+def memmap_las_points(las_file: Path, dimensions: Sequence[str] = LAS_DIMENSIONS) -> LasPoints:
+    """Memory-map the point records of an uncompressed las file: the dimensions are returned as strided views on the
+    file (no copy in the process memory, and the pages of the file are shared in the page cache with the other
+    processes that read it).
+
+    Args:
+        las_file (Path): path to the las file to read (must be uncompressed)
+        dimensions (Sequence[str], optional): dimensions to read (among LAS_DIMENSIONS). Defaults to LAS_DIMENSIONS.
+
+    Raises:
+        ValueError: if the las file is compressed
+
+    Returns:
+        LasPoints: points of the las file (as read-only views on the file)
+    """
+    with laspy.open(las_file) as f:
+        header = f.header
+        crs = header.parse_crs()
+    if header.are_points_compressed:
+        raise ValueError(f"Cannot memory-map the points of a compressed file: {las_file}")
+
+    records = np.memmap(
+        las_file,
+        dtype=header.point_format.dtype(),
+        mode="r",
+        offset=header.offset_to_point_data,
+        shape=(header.point_count,),
+    )
+    arrays = {dimension: _get_records_dimension(records, dimension) for dimension in dimensions}
+    logging.debug(
+        f"Memory-mapped {header.point_count} points of {las_file} (dimensions: {list(dimensions)}) without copying "
+        + f"the {header.point_count * header.point_format.size} bytes of point records"
+    )
+
+    return LasPoints(
+        arrays.get("X"),
+        arrays.get("Y"),
+        arrays.get("Z"),
+        arrays.get("classification"),
+        header.scales,
+        header.offsets,
+        crs,
+    )
+
+
+def iter_las_points(
+    las_file: Path, chunk_size: int = las_read_chunk_size, dimensions: Sequence[str] = LAS_DIMENSIONS
+) -> Iterator[LasPoints]:
+    """Read a las file chunk by chunk, decoding only the requested dimensions, so that the memory used to store the
+    points does not depend on the number of points in the file
+
+    Args:
+        las_file (Path): path to the las file to read
+        chunk_size (int, optional): maximum number of points to read at once. Defaults to las_read_chunk_size.
+        dimensions (Sequence[str], optional): dimensions to read (among LAS_DIMENSIONS). Defaults to LAS_DIMENSIONS.
+
+    Yields:
+        LasPoints: points of each chunk (views on the file for uncompressed las files, cf. memmap_las_points)
+    """
+    with laspy.open(las_file) as f:
+        memory_map = _can_memory_map(f.header)
+    if memory_map:
+        points = memmap_las_points(las_file, dimensions)
+        for start in range(0, points.nb_points, chunk_size):
+            chunk = slice(start, start + chunk_size)
+            yield points._replace(**{dimension: getattr(points, dimension)[chunk] for dimension in dimensions})
+        return
+
+    with laspy.open(
+        las_file, laz_backend=_laz_backend, decompression_selection=get_decompression_selection(dimensions)
+    ) as f:
+        scales, offsets, crs = f.header.scales, f.header.offsets, f.header.parse_crs()
+        for chunk in f.chunk_iterator(chunk_size):
+            arrays = {dimension: _get_chunk_dimension(chunk, dimension) for dimension in dimensions}
+            yield LasPoints(
+                arrays.get("X"), arrays.get("Y"), arrays.get("Z"), arrays.get("classification"), scales, offsets, crs
+            )
+
+
+def read_las_points(
+    las_file: Path, dimensions: Sequence[str] = LAS_DIMENSIONS, chunk_size: int = las_read_chunk_size
+) -> LasPoints:
+    """Read all the points of a las file, decoding only the requested dimensions into compact arrays
+    (int32 for coordinates, uint8 for classification).
+
+    The points are decoded chunk by chunk and copied into the output arrays, so that the full point records are never
+    stored in memory all at once. Uncompressed las files are memory-mapped instead (cf. memmap_las_points).
+
+    Args:
+        las_file (Path): path to the las file to read
+        dimensions (Sequence[str], optional): dimensions to read (among LAS_DIMENSIONS). Defaults to LAS_DIMENSIONS.
+        chunk_size (int, optional): maximum number of points to decode at once. Defaults to las_read_chunk_size.
+
+    Returns:
+        LasPoints: points of the las file
+    """
+    with laspy.open(las_file) as f:
+        nb_points = f.header.point_count
+        point_size = f.header.point_format.size
+        scales, offsets, crs = f.header.scales, f.header.offsets, f.header.parse_crs()
+        memory_map = _can_memory_map(f.header)
+    if memory_map:
+        return memmap_las_points(las_file, dimensions)
+
+    arrays = {
+        dimension: np.empty(nb_points, dtype=np.uint8 if dimension == "classification" else np.int32)
+        for dimension in dimensions
+    }
+    start = 0
+    for chunk in iter_las_points(las_file, chunk_size, dimensions):
+        end = start + chunk.nb_points
+        for dimension in dimensions:
+            arrays[dimension][start:end] = getattr(chunk, dimension)
+        start = end
+
+    points = LasPoints(
+        arrays.get("X"), arrays.get("Y"), arrays.get("Z"), arrays.get("classification"), scales, offsets, crs
+    )
+    logging.debug(
+        f"Decoded {points.nbytes} bytes for {nb_points} points of {las_file} (dimensions: {list(dimensions)}) "
+        + f"instead of {nb_points * point_size} bytes for the full point records"
+    )
+
+    return points
+
+
+def write_raster(
+    raster: np.array,
+    output_tif: Path,
+    transform: rasterio.Affine,
+    crs,
+    nodata=None,
+    compress: str = None,
+    nbits: int = None,
+    empty_layers: np.array = None,
+    descriptions: List[str] = None,
+    scales: List[float] = None,
+    offsets: List[float] = None,
+    sparse_max_occupancy: float = 0,
+    sparse_values: bool = False,
+    num_threads: int = raster_compression_threads,
+):
+    """Save a 3d raster (one layer per class) in a GeoTIFF file that is optimized to be written once and read many
+    times:
+    - the file is tiled, with one band after the other
+    - the empty layers (only zeros or nodata) are flagged (cf. commons.tag_empty_layers) and not written on disk, as
+    well as the empty tiles of the other layers (sparse file)
+    - the file can be compressed, with a predictor that depends on the data type (floating point predictor for floats,
+    horizontal differencing for integers) and with multithreaded compression
+    - binary layers can be stored with less than 8 bits per pixel (nbits)
+    - the layers with very few pixels with values can be stored as a list of pixels in band tags instead of their
+    band, which is not written on disk either (cf. commons.tag_sparse_layers, read with commons.read_dense_layers)
+
+    Args:
+        raster (np.array): 3d raster to save
+        output_tif (Path): path to output
+        transform (rasterio.Affine): georeferencing of the raster
+        crs: crs of the output raster
+        nodata (optional): nodata value of the raster. Defaults to None.
+        compress (str, optional): compression ("deflate", "zstd", "lzw"), None for no compression. Defaults to None.
+        nbits (int, optional): number of bits per pixel for integer rasters (eg. 1 for binary layers).
+        Defaults to None (size of the data type).
+        empty_layers (np.array, optional): boolean array that is True for each empty layer. Defaults to None
+        (computed from raster).
+        descriptions (List[str], optional): description of each layer. Defaults to None.
+        scales (List[float], optional): scale of each layer (for quantized values). Defaults to None.
+        offsets (List[float], optional): offset of each layer (for quantized values). Defaults to None.
+        sparse_max_occupancy (float, optional): maximum proportion of pixels with values for a layer to be stored as a
+        list of pixels. Defaults to 0 (no sparse encoding).
+        sparse_values (bool, optional): if True, the values of the pixels are stored in the sparse encoding, otherwise
+        only their indices (binary maps only: the pixels are read back as 1). Defaults to False.
+        num_threads (int, optional): number of threads used to compress the raster (0 to use all the CPUs available
+        to the container). Defaults to raster_compression_threads.
+    """
+    output_tif.parent.mkdir(parents=True, exist_ok=True)
+    empty_value = 0 if nodata is None else nodata
+    if empty_layers is None:
+        empty_layers = np.all(raster == empty_value, axis=(1, 2))
+
+    creation_options = {"tiled": True, "interleave": "band", "sparse_ok": True}
+    if nbits:
+        creation_options["nbits"] = nbits
+    if compress:
+        creation_options["compress"] = compress
+        creation_options["num_threads"] = num_threads or get_available_cpu_count()
+        if not nbits:
+            creation_options["predictor"] = 3 if np.issubdtype(raster.dtype, np.floating) else 2
+
+    with rasterio.Env():
+        with rasterio.open(
+            output_tif,
+            "w",
+            driver="GTiff",
+            height=raster.shape[1],
+            width=raster.shape[2],
+            count=raster.shape[0],
+            dtype=raster.dtype,
+            crs=crs,
+            nodata=nodata,
+            transform=transform,
+            **creation_options,
+        ) as out_file:
+            tag_empty_layers(out_file, empty_layers)
+            is_sparse = tag_sparse_layers(out_file, raster, empty_value, sparse_max_occupancy, sparse_values)
+            # the bands of the empty and sparse layers are not written (sparse file)
+            for ii in np.flatnonzero(~(empty_layers | is_sparse)):
+                out_file.write(raster[ii], int(ii) + 1)
+            if descriptions is not None:
+                for ii, description in enumerate(descriptions):
+                    out_file.set_band_description(ii + 1, description)
+            if scales is not None:
+                out_file.scales = scales
+            if offsets is not None:
+                out_file.offsets = offsets
@@ -10,6 +10,7 @@ from gpao_utils.store import Store
 
 from coclico.csv_manipulation import merge_results, results_by_tile
 from coclico.gpao_utils import add_dependency_to_jobs, save_projects_as_json
+from coclico.intrinsic_all import create_intrinsic_all_jobs
 from coclico.io import read_config_file
 from coclico.metrics.listing import METRICS
 from coclico.unlock import create_unlock_job
@@ -61,6 +62,28 @@ def parse_args():
         help="Ajouter une étape de pré-processing pour corriger l'encodage des fichiers issus de TerraScan (unlock) "
         + "Attention: l'entête des fichiers d'entrée sera modifiée !",
     )
+    parser.add_argument(
+        "-f",
+        "--fused-intrinsic",
+        action="store_true",
+        default=False,
+        help="Calculer toutes les métriques intrinsèques d'une dalle dans un seul job (lecture unique de la dalle) "
+        + "au lieu d'un job par métrique et par dalle",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        help="(Optionnel) Lire les dalles par paquets de CHUNK_SIZE points dans les jobs de métriques intrinsèques "
+        + "pour borner la mémoire utilisée (incompatible avec --fused-intrinsic)",
+    )
+    parser.add_argument(
+        "--laz-threads",
+        type=int,
+        default=None,
+        help="(Optionnel) Nombre de threads utilisés pour décompresser les fichiers LAZ dans les jobs de métriques "
+        + "intrinsèques (0 pour utiliser tous les CPU disponibles dans le conteneur). Par défaut : 1",
+    )
 
     return parser.parse_args()
 
@@ -95,6 +118,9 @@ def create_compare_project(
     project_name: str,
     config_file: Path,
     unlock: bool = False,
+    fused_intrinsic: bool = False,
+    chunk_size: int = None,
+    laz_threads: int = None,
 ) -> Project:
     """Main function to generate a GPAO project needed to compare classifications (c1, c2..) with respect to a
     reference classification (ref) and save it as json files in out.
@@ -108,12 +134,23 @@ def create_compare_project(
         project_name (str): base project name for gpao projects
         config_file (Path): config file containing dict with the weight of each metric for each class.
         unlock (bool, optional): If True, Defaults to False.
+        fused_intrinsic (bool, optional): If True, compute all intrinsic metrics of a tile in a single job
+        (cf. coclico.intrinsic_all) instead of creating one job per metric and per tile. Defaults to False.
+        chunk_size (int, optional): If set, the intrinsic metric jobs read the las files by chunks of chunk_size
+        points (bounded memory). Defaults to None (read all points at once).
+        laz_threads (int, optional): If set, number of threads used by the intrinsic metric jobs to decompress laz
+        files (0 to use all the CPUs available to the container). Defaults to None.
+
+    Raises:
+        ValueError: if both fused_intrinsic and chunk_size are set (the fused job needs all the points in memory)
 
     Returns:
         Project: gpao project
     """
 
     check_pathes_ends_with_different_names(classifications)
+    if fused_intrinsic and chunk_size:
+        raise ValueError("Chunked reading (chunk_size) cannot be used with fused intrinsic jobs (fused_intrinsic)")
 
     logging.debug(
         f"Create GPAO projects to compare {len(classifications)} classification(s): {classifications}"
@@ -142,18 +179,26 @@ def create_compare_project(
             unlock_job = create_unlock_job("ref", tile_names, ref, store)
             jobs.append(unlock_job)
 
+        if fused_intrinsic:
+            fused_jobs = create_intrinsic_all_jobs("ref", tile_names, ref, out_ref, store, config_file, laz_threads)
+            add_dependency_to_jobs(fused_jobs, unlock_job)
+            jobs.extend(fused_jobs)
+
         for metric_name, metric_class in METRICS.items():
             if metric_name in config_dict.keys():
-                metric = metric_class(store, config_file)
+                metric = metric_class(store, config_file, chunk_size, laz_threads)
 
                 out_ref_metric = out_ref / metric_name / "intrinsic"
                 out_ref_metric.mkdir(parents=True, exist_ok=True)
-                metric_jobs = metric.create_metric_intrinsic_jobs("ref", tile_names, ref, out_ref_metric)
-                add_dependency_to_jobs(metric_jobs, unlock_job)
+                if fused_intrinsic:
+                    ref_jobs[metric_name] = fused_jobs
+                else:
+                    metric_jobs = metric.create_metric_intrinsic_jobs("ref", tile_names, ref, out_ref_metric)
+                    add_dependency_to_jobs(metric_jobs, unlock_job)
 
-                ref_jobs[metric_name] = metric_jobs
+                    ref_jobs[metric_name] = metric_jobs
 
-                jobs.extend(metric_jobs)
+                    jobs.extend(metric_jobs)
 
     for ci in classifications:
         ci_jobs = []
@@ -169,15 +214,26 @@ def create_compare_project(
                 unlock_job = create_unlock_job(ci.name, tile_names, ci, store)
                 jobs.append(unlock_job)
 
+            if fused_intrinsic:
+                fused_jobs = create_intrinsic_all_jobs(
+                    ci.name, tile_names, ci, out_ci, store, config_file, laz_threads
+                )
+                add_dependency_to_jobs(fused_jobs, unlock_job)
+                ci_jobs.extend(fused_jobs)
+
             for metric_name, metric_class in METRICS.items():
                 if metric_name in config_dict.keys():
-                    metric = metric_class(store, config_file)
+                    metric = metric_class(store, config_file, chunk_size, laz_threads)
 
                     out_ci_metric = out_ci / metric_name / "intrinsic"
 
                     out_ci_metric.mkdir(parents=True, exist_ok=True)
-                    ci_intrinsic_jobs = metric.create_metric_intrinsic_jobs(ci.name, tile_names, ci, out_ci_metric)
-                    add_dependency_to_jobs(ci_intrinsic_jobs, unlock_job)
+                    if fused_intrinsic:
+                        ci_intrinsic_jobs = fused_jobs
+                    else:
+                        ci_intrinsic_jobs = metric.create_metric_intrinsic_jobs(ci.name, tile_names, ci, out_ci_metric)
+                        add_dependency_to_jobs(ci_intrinsic_jobs, unlock_job)
+                        ci_jobs.extend(ci_intrinsic_jobs)
 
                     out_ci_to_ref_metric = out_ci / metric_name / "to_ref"
                     out_ci_to_ref_metric.mkdir(parents=True, exist_ok=True)
@@ -194,7 +250,6 @@ def create_compare_project(
 
                     ci_merge_deps.append(ci_to_ref_jobs[-1])
 
-                    ci_jobs.extend(ci_intrinsic_jobs)
                     ci_jobs.extend(ci_to_ref_jobs)
 
         resulti = out_ci / (str(ci.name) + "_result.csv")
@@ -227,6 +282,9 @@ def compare(
     project_name: str,
     config_file: Path = Path("./configs/metrics_config.yaml"),
     unlock: bool = False,
+    fused_intrinsic: bool = False,
+    chunk_size: int = None,
+    laz_threads: int = None,
 ):
     """Main function to compare one or more classifications (c1, c2..) with respect to a reference
     classification (ref) and save it as json files in out.
@@ -244,6 +302,12 @@ def compare(
         config_file (Path, optional): Yaml file containing the weight of each metric for each class.
         Defaults to Path("./configs/metrics_weights.yaml").
         unlock (bool, optional): If True, Defaults to False.
+        fused_intrinsic (bool, optional): If True, compute all intrinsic metrics of a tile in a single job.
+        Defaults to False.
+        chunk_size (int, optional): If set, the intrinsic metric jobs read the las files by chunks of chunk_size
+        points (bounded memory). Defaults to None.
+        laz_threads (int, optional): If set, number of threads used by the intrinsic metric jobs to decompress laz
+        files. Defaults to None.
     """
 
     logging.debug(
@@ -259,7 +323,18 @@ def compare(
 
     shutil.copyfile(config_file, out_config_file)
 
-    project = create_compare_project(classifications, ref, out, store, project_name, out_config_file, unlock)
+    project = create_compare_project(
+        classifications,
+        ref,
+        out,
+        store,
+        project_name,
+        out_config_file,
+        unlock,
+        fused_intrinsic,
+        chunk_size,
+        laz_threads,
+    )
 
     builder = Builder([project])
     logging.info(f"Send projects to gpao server: {gpao_hostname}")
@@ -283,4 +358,7 @@ if __name__ == "__main__":
         args.project_name,
         args.config_file,
         args.unlock,
+        args.fused_intrinsic,
+        args.chunk_size,
+        args.laz_threads,
     )
@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 import pandas as pd
 from gpao.job import Job
@@ -20,7 +20,18 @@ class MALT0(Metric):
 
     # Pixel size for MNx
     pixel_size = 0.5
+    # Method used to compute the MNx (cf. malt0_intrinsic.MNX_METHODS)
+    mnx_method = "delaunay"
+    # For the vectorized MNx methods, maximum distance (in pixels) of the empty pixels to fill (0: no filling)
+    mnx_fill_holes = 0
+    # Step (in meters) of the integer encoding of the MNx rasters (eg. 0.01 for centimeters), 0 to store float32 values
+    mnx_quantization_step = 0
+    # Percentiles of the height differences computed by the relative metric (in addition to max/mean/std)
+    diff_quantiles = (50, 90, 99)
+    # If True, the relative metric also saves the height difference rasters of each tile (in <output>/diff)
+    output_diff_rasters = False
     metric_name = "malt0"
+    intrinsic_output_extension = ".tif"
 
     def create_metric_intrinsic_one_job(self, name: str, input: Path, output: Path):
         job_name = f"{self.metric_name}_intrinsic_{name}_{input.stem}"
@@ -32,15 +43,34 @@ docker run -t --rm --userns=host --shm-size=2gb
 ghcr.io/ignf/coclico:{__version__}
 python -m coclico.malt0.malt0_intrinsic
 --input-file /input
---output-mnx-file /output/{input.stem}.tif
+--output-mnx-file /output/{input.stem}{self.intrinsic_output_extension}
 --config-file /config/{self.config_file.name}
 --pixel-size {self.pixel_size}
+--mnx-method {self.mnx_method}
+--mnx-fill-holes {self.mnx_fill_holes}
+--mnx-quantization-step {self.mnx_quantization_step}
+{self.reader_options()}
 
 """
 
         job = Job(job_name, command, tags=["docker"])
         return job
 
+    def compute_metric_intrinsic_from_points(self, las_file: Path, points: Tuple, output: Path):
+        # imported here to avoid circular imports
+        from coclico.malt0 import malt0_intrinsic
+
+        malt0_intrinsic.compute_metric_intrinsic_from_points(
+            las_file,
+            points,
+            self.config_file,
+            output,
+            self.pixel_size,
+            mnx_method=self.mnx_method,
+            mnx_fill_holes=self.mnx_fill_holes,
+            mnx_quantization_step=self.mnx_quantization_step,
+        )
+
     def create_metric_relative_to_ref_jobs(
         self, name: str, out_c1: Path, out_ref: Path, output: Path, c1_jobs: List[Job], ref_jobs: List[Job]
     ) -> Job:
@@ -58,6 +88,7 @@ python -m coclico.malt0.malt0_relative
 --output-csv-tile /output/result_tile.csv
 --output-csv /output/result.csv
 --config-file /config/{self.config_file.name}
+{"--output-diff-dir /output/diff" if self.output_diff_rasters else ""}
 """
 
         job = Job(job_name, command, tags=["docker"])
@@ -76,6 +107,7 @@ python -m coclico.malt0.malt0_relative
             - mean_diff
             - std_diff
         (these columns are described in the malt0_relative function docstring)
+        The percentile columns (p50_diff, p90_diff, p99_diff) are not used in the note and are dropped.
 
         Args:
             metric_df (pd.DataFrame): malt0 relative results as a pandas dataframe
@@ -111,5 +143,7 @@ python -m coclico.malt0.malt0_relative
         ) / sum_coefs
 
         metric_df.drop(columns=["max_diff", "mean_diff", "std_diff"], inplace=True)
+        quantile_columns = [f"p{q}_diff" for q in MALT0.diff_quantiles]
+        metric_df.drop(columns=[c for c in quantile_columns if c in metric_df.columns], inplace=True)
 
         return metric_df
@@ -1,32 +1,53 @@
 import argparse
 import logging
-import tempfile
+import uuid
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import Iterable, List, Tuple
 
+import cv2
 import numpy as np
 import pdal
 import rasterio
+from osgeo import gdal
 
 import coclico.io
 import coclico.metrics.commons as commons
 import coclico.metrics.occupancy_map as occupancy_map
+from coclico.config import (
+    laz_threads,
+    mnx_block_halo,
+    mnx_block_size,
+    mnx_quantization_step,
+    mnx_workers,
+    raster_compression,
+    sparse_layer_max_occupancy,
+)
 from coclico.malt0.malt0 import MALT0
+from coclico.metrics.cache import LRUCache, tile_cache
 
+gdal.UseExceptions()
 
-def create_mnx_map(las_file, class_weights, output_tif, pixel_size, no_data_value=-9999):
-    reader = pdal.Reader.las(filename=str(las_file), tag="IN")
-    pipeline = reader.pipeline()
-    info = pipeline.quickinfo
-    bounds = info["readers.las"]["bounds"]
-    top_left, nb_pixels = commons.get_raster_geometry_from_las_bounds(
-        (
-            bounds["minx"],
-            bounds["miny"],
-            bounds["maxx"],
-            bounds["maxy"],
-        ),
-        pixel_size,
-    )
+# Methods to compute the height rasters: "delaunay" interpolates the points of each class with a triangulation (pdal
+# filters.delaunay + filters.faceraster), the other methods use the max/min/mean height of the points of each class in
+# each pixel, computed for all the classes in a single vectorized pass on the points
+MNX_METHODS = ("delaunay", "max", "min", "mean")
+# Dimensions of the las files that are needed to create the height rasters from decoded points
+MNX_DIMENSIONS = ("X", "Y", "Z", "classification")
+
+
+def _add_mnx_stages(
+    pipeline: pdal.Pipeline,
+    class_weights: dict,
+    output_tif: Path,
+    pixel_size: float,
+    top_left: Tuple[float, float],
+    nb_pixels: Tuple[int, int],
+    no_data_value=-9999,
+) -> pdal.Pipeline:
+    """Add the stages that create the height rasters (delaunay triangulation + faceraster for each class) to a pdal
+    pipeline in which the input points are tagged "IN"
+    """
     lower_left = (top_left[0], top_left[1] - nb_pixels[1] * pixel_size)
 
     raster_tags = []
@@ -57,29 +78,531 @@ def create_mnx_map(las_file, class_weights, output_tif, pixel_size, no_data_valu
         inputs=raster_tags,
         rasters=["faceraster"],
     )
-    pipeline.execute()
 
+    return pipeline
+
+
+def to_pdal_array(points: coclico.io.LasPoints, selection: np.array) -> np.ndarray:
+    """Convert selected points to a numpy structured array that can be used as input of a pdal pipeline (with scaled
+    X, Y, Z coordinates and Classification dimensions)
+
+    Args:
+        points (LasPoints): points with X, Y, Z and classification
+        selection (np.array): indices (or boolean mask) of the points to convert
+
+    Returns:
+        np.ndarray: structured array of the selected points
+    """
+    classification = points.classification[selection]
+    array = np.empty(
+        len(classification),
+        dtype=[("X", np.float64), ("Y", np.float64), ("Z", np.float64), ("Classification", np.uint8)],
+    )
+    for dimension, values, axis in [("X", points.X, 0), ("Y", points.Y, 1), ("Z", points.Z, 2)]:
+        array[dimension] = values[selection] * points.scales[axis] + points.offsets[axis]
+    array["Classification"] = classification
+
+    return array
+
+
+def _create_class_mnx_layer(
+    points: coclico.io.LasPoints,
+    class_key: str,
+    class_indices: np.array,
+    pixel_size: float,
+    top_left: Tuple[float, float],
+    nb_pixels: Tuple[int, int],
+    no_data_value=-9999,
+) -> np.array:
+    """Create the height raster of a single class with pdal (delaunay triangulation + faceraster), from points that
+    have already been decoded (given to pdal through the python-pdal array input). The pdal output raster is kept in
+    memory (GDAL /vsimem/ file system).
+    """
+    if len(class_indices) == 0:
+        return np.full((nb_pixels[1], nb_pixels[0]), no_data_value, dtype=np.float32)
+
+    mem_tif = f"/vsimem/{uuid.uuid4().hex}/mnx.tif"
+    try:
+        # filters.merge is only used to tag the array input as "IN"
+        pipeline = pdal.Filter.merge(tag="IN").pipeline(to_pdal_array(points, class_indices))
+        pipeline = _add_mnx_stages(pipeline, {class_key: 1}, mem_tif, pixel_size, top_left, nb_pixels, no_data_value)
+        pipeline.execute()
+        with rasterio.Env():
+            with rasterio.open(mem_tif) as src:
+                return src.read(1)
+    finally:
+        gdal.Unlink(mem_tif)
+
+
+def _select_points(points: coclico.io.LasPoints, selection: np.array) -> coclico.io.LasPoints:
+    """Copy the selected points (X, Y, Z and classification), to be sent to another process"""
+    return coclico.io.LasPoints(
+        points.X[selection],
+        points.Y[selection],
+        points.Z[selection],
+        points.classification[selection],
+        points.scales,
+        points.offsets,
+        None,
+    )
+
+
+def _create_block_mnx_layer(task: Tuple) -> np.array:
+    """Create the height raster of a block of a class from the points of the block (cf. _select_points), in a worker
+    process of create_mnx_array_with_delaunay"""
+    points, class_key, pixel_size, top_left, nb_pixels, no_data_value = task
+    all_points = np.arange(len(points.X))
+    return _create_class_mnx_layer(points, class_key, all_points, pixel_size, top_left, nb_pixels, no_data_value)
+
+
+def _set_mnx_blocks(mnx: np.array, tasks: List[Tuple], layers: Iterable[np.array]):
+    """Copy (inplace) the height raster of each task of create_mnx_array_with_delaunay in its layer and block"""
+    for (ii, _, (col_start, row_start, col_end, row_end), _), layer in zip(tasks, layers):
+        mnx[ii, row_start:row_end, col_start:col_end] = layer
+
+
+def get_mnx_blocks(nb_pixels: Tuple[int, int], block_size: int = 0) -> List[Tuple[int, int, int, int]]:
+    """Split a raster grid in square blocks of block_size pixels (the blocks on the right and bottom borders can be
+    smaller)
+
+    Args:
+        nb_pixels (Tuple[int, int]): number of pixels on each axis in format (x, y)
+        block_size (int, optional): size of the blocks (in pixels). Defaults to 0 (a single block for the whole grid).
+
+    Returns:
+        List[Tuple[int, int, int, int]]: (col_start, row_start, col_end, row_end) of each block (end excluded)
+    """
+    if block_size <= 0:
+        return [(0, 0, nb_pixels[0], nb_pixels[1])]
+
+    return [
+        (col, row, min(col + block_size, nb_pixels[0]), min(row + block_size, nb_pixels[1]))
+        for row in range(0, nb_pixels[1], block_size)
+        for col in range(0, nb_pixels[0], block_size)
+    ]
+
+
+def create_mnx_array_with_delaunay(
+    las_file: Path,
+    points: coclico.io.LasPoints,
+    class_weights: dict,
+    pixel_size: float,
+    no_data_value=-9999,
+    workers: int = mnx_workers,
+    block_size: int = mnx_block_size,
+    block_halo: int = mnx_block_halo,
+    grid: Tuple[Tuple[float, float], Tuple[int, int]] = None,
+    cache: LRUCache = tile_cache,
+) -> Tuple[np.array, float, float]:
+    """Create the height rasters of each class with pdal (delaunay triangulation + faceraster) from points that have
+    already been decoded, so that the las file is not read a second time by pdal. The raster grid is the one of the
+    occupancy maps (cf. occupancy_map.get_grid_geometry), unless grid is set.
+
+    Each class is processed by its own pdal pipeline. With more than one worker, the pipelines are executed in a pool
+    of processes, to which only the points of each class (and block) are sent. The layers are kept in the sorted class
+    keys order.
+
+    If block_size is set, the grid is also split in blocks of block_size pixels (cf. get_mnx_blocks), and each block
+    of each class is triangulated separately, with the points of the block and of a halo of block_halo pixels around
+    it. Only the pixels of the block itself are kept in the output. Away from the block borders, the result is the
+    same as with a single triangulation of the class. Near the block borders, the values are the same as long as the
+    triangles around a pixel only depend on points of the halo, which is the case when the halo is larger than the
+    distance between neighbour points: differences can only appear in sparse areas (with triangles larger than the
+    halo), and are below 1 mm otherwise (float32 rounding).
+
+    Args:
+        las_file (Path): path to the las file from which points have been read (used as cache key)
+        points (LasPoints): points with X, Y, Z and classification
+        class_weights (dict): class weights dict (to know for which classes to generate the rasters)
+        pixel_size (float): size of the output rasters pixels
+        no_data_value (int, optional): no_data value for the output raster. Defaults to -9999.
+        workers (int, optional): maximum number of pdal pipelines executed at the same time (0 to use all the CPUs
+        available to the container). Defaults to mnx_workers.
+        block_size (int, optional): size (in pixels) of the blocks that are triangulated separately (0 to triangulate
+        each class at once). Defaults to mnx_block_size.
+        block_halo (int, optional): size (in pixels) of the halo around each block. Defaults to mnx_block_halo.
+        grid (Tuple[Tuple[float, float], Tuple[int, int]], optional): coordinates of the top-left pixel center and
+        number of pixels on each axis of the output grid (as returned by commons.get_raster_geometry_from_las_bounds).
+        Defaults to None (grid of the occupancy maps of the points).
+        cache (LRUCache, optional): cache used for the grid geometry and the points indices of each class (with
+        las_file as key). Defaults to tile_cache.
+
+    Returns:
+        Tuple[np.array, float, float]: (mnx, x_min, y_max) where mnx is a float32 array with one layer per class and
+        x_min, y_max are the coordinates of the center of the top left pixel
+    """
+    if grid is None:
+        grid = occupancy_map.get_grid_geometry(las_file, points, pixel_size, cache)
+    top_left, nb_pixels = grid
+    class_keys = sorted(class_weights.keys())
+    classes_indices = [occupancy_map.get_class_points_indices(las_file, points, k, cache) for k in class_keys]
+    blocks = get_mnx_blocks(nb_pixels, block_size)
+
+    # one task per class and per block: (layer index, class key, block, indices of the points of the block + halo)
+    tasks = []
+    for ii, (class_key, class_indices) in enumerate(zip(class_keys, classes_indices)):
+        if len(class_indices) == 0:
+            # classes without points are filled with no_data_value directly (no pdal pipeline)
+            continue
+        if len(blocks) == 1:
+            tasks.append((ii, class_key, blocks[0], class_indices))
+            continue
+
+        flat_indices = occupancy_map.compute_points_flat_pixel_indices(
+            points, class_indices, pixel_size, top_left[0], top_left[1], nb_pixels
+        )
+        rows, cols = np.divmod(flat_indices, nb_pixels[0])
+        for col_start, row_start, col_end, row_end in blocks:
+            in_block = (
+                (cols >= col_start - block_halo)
+                & (cols < col_end + block_halo)
+                & (rows >= row_start - block_halo)
+                & (rows < row_end + block_halo)
+            )
+            tasks.append((ii, class_key, (col_start, row_start, col_end, row_end), class_indices[in_block]))
+
+    mnx = np.empty((len(class_keys), nb_pixels[1], nb_pixels[0]), dtype=np.float32)
+    for ii, class_indices in enumerate(classes_indices):
+        if len(class_indices) == 0:
+            mnx[ii] = no_data_value
+
+    def get_block_geometry(block):
+        col_start, row_start, col_end, row_end = block
+        block_top_left = (top_left[0] + col_start * pixel_size, top_left[1] - row_start * pixel_size)
+        return block_top_left, (col_end - col_start, row_end - row_start)
+
+    workers = max(1, min(workers or coclico.io.get_available_cpu_count(), len(tasks)))
+    logging.debug(f"Create MNx of {len(class_keys)} classes in {len(blocks)} block(s) with {workers} workers")
+    if workers == 1:
+        layers = (
+            _create_class_mnx_layer(
+                points, class_key, block_indices, pixel_size, *get_block_geometry(block), no_data_value
+            )
+            for _, class_key, block, block_indices in tasks
+        )
+        _set_mnx_blocks(mnx, tasks, layers)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            layers = executor.map(
+                _create_block_mnx_layer,
+                (
+                    (
+                        _select_points(points, block_indices),
+                        class_key,
+                        pixel_size,
+                        *get_block_geometry(block),
+                        no_data_value,
+                    )
+                    for _, class_key, block, block_indices in tasks
+                ),
+            )
+            _set_mnx_blocks(mnx, tasks, layers)
+
+    return mnx, top_left[0], top_left[1]
+
+
+def create_mnx_array_with_delaunay_from_las(
+    las_file: Path,
+    class_weights: dict,
+    pixel_size: float,
+    chunk_size: int,
+    no_data_value=-9999,
+    workers: int = mnx_workers,
+    block_size: int = mnx_block_size,
+    block_halo: int = mnx_block_halo,
+) -> Tuple[np.array, float, float, object]:
+    """Create the height rasters of each class with pdal (cf. create_mnx_array_with_delaunay), reading las_file chunk
+    by chunk, on the grid defined by the las header bounds (the same grid as
+    occupancy_map.create_occupancy_map_array_from_las).
+
+    The file is read once: only the points of the classes of class_weights are kept from each chunk (with the
+    dimensions needed by the triangulation), so that the memory used for the points depends on the number of points
+    of these classes instead of the whole file. The points are then triangulated by blocks of block_size pixels with
+    their halo (cf. create_mnx_array_with_delaunay).
+
+    Args:
+        las_file (Path): path to the las file
+        class_weights (dict): class weights dict (to know for which classes to generate the rasters)
+        pixel_size (float): size of the output rasters pixels
+        chunk_size (int): maximum number of points to read at once
+        no_data_value (int, optional): no_data value for the output raster. Defaults to -9999.
+        workers (int, optional): maximum number of pdal pipelines executed at the same time (0 to use all the CPUs
+        available to the container). Defaults to mnx_workers.
+        block_size (int, optional): size (in pixels) of the blocks that are triangulated separately (0 for a single
+        block). Defaults to mnx_block_size.
+        block_halo (int, optional): size (in pixels) of the halo around each block. Defaults to mnx_block_halo.
+
+    Returns:
+        Tuple[np.array, float, float, object]: (mnx, x_min, y_max, crs)
+    """
+    las_bounds, crs = coclico.io.read_las_header(las_file)
+    top_left, nb_pixels = commons.get_raster_geometry_from_las_bounds(las_bounds, pixel_size)
+    class_lut = commons.create_class_bitmask_lut(sorted(class_weights.keys()))
+
+    chunks = []
+    for chunk in coclico.io.iter_las_points(las_file, chunk_size, MNX_DIMENSIONS):
+        in_classes = class_lut[chunk.classification] != 0
+        chunks.append(
+            chunk._replace(
+                X=chunk.X[in_classes],
+                Y=chunk.Y[in_classes],
+                Z=chunk.Z[in_classes],
+                classification=chunk.classification[in_classes],
+            )
+        )
+
+    if not chunks:
+        # file without points: all the layers are empty, as the layers of the classes without points
+        mnx = np.full((len(class_weights), nb_pixels[1], nb_pixels[0]), no_data_value, dtype=np.float32)
+        return mnx, top_left[0], top_left[1], crs
+
+    points = chunks[0]._replace(
+        **{dimension: np.concatenate([getattr(chunk, dimension) for chunk in chunks]) for dimension in MNX_DIMENSIONS}
+    )
+    del chunks
+    logging.debug(f"Triangulate {points.nb_points} points of {las_file.name}")
+    # the points are only used for this file: their indices by class are cached in a temporary cache
+    mnx, _, _ = create_mnx_array_with_delaunay(
+        las_file,
+        points,
+        class_weights,
+        pixel_size,
+        no_data_value,
+        workers,
+        block_size,
+        block_halo,
+        grid=(top_left, nb_pixels),
+        cache=LRUCache(),
+    )
+
+    return mnx, top_left[0], top_left[1], crs
+
+
+def _init_mnx_values(method: str, shape: Tuple[int, int], z_dtype: np.dtype) -> np.array:
+    """Create the per-pixel accumulator of the vectorized method, filled with the neutral element of the reduction"""
+    if method == "mean":
+        return np.zeros(shape, dtype=np.float64)
+
+    info = np.iinfo(z_dtype) if np.issubdtype(z_dtype, np.integer) else np.finfo(z_dtype)
+    return np.full(shape, info.min if method == "max" else info.max, dtype=z_dtype)
+
+
+def fill_small_holes(mnx_layer: np.array, occupied: np.array, max_distance: int):
+    """Fill (inplace) the small holes of a height raster layer: empty pixels get the mean value of their occupied
+    neighbours (8-connectivity), iteratively, so that all the empty pixels that are at most max_distance pixels away
+    from an occupied pixel are filled.
+
+    Args:
+        mnx_layer (np.array): 2d height raster
+        occupied (np.array): 2d boolean array, True where mnx_layer has a value
+        max_distance (int): maximum distance (in pixels) to an occupied pixel for an empty pixel to be filled
+    """
+    values = np.where(occupied, mnx_layer, 0).astype(np.float32)
+    weights = occupied.astype(np.float32)
+    for _ in range(max_distance):
+        sums = cv2.boxFilter(values, -1, (3, 3), normalize=False, borderType=cv2.BORDER_CONSTANT)
+        nb_neighbours = cv2.boxFilter(weights, -1, (3, 3), normalize=False, borderType=cv2.BORDER_CONSTANT)
+        to_fill = (weights == 0) & (nb_neighbours > 0)
+        if not np.any(to_fill):
+            break
+        values[to_fill] = sums[to_fill] / nb_neighbours[to_fill]
+        weights[to_fill] = 1
+
+    filled = (weights > 0) & ~occupied
+    mnx_layer[filled] = values[filled]
+
+
+def create_mnx_array_from_chunks(
+    chunks: Iterable[coclico.io.LasPoints],
+    class_keys: List[str],
+    method: str,
+    pixel_size: float,
+    x_min: float,
+    y_max: float,
+    nb_pixels: Tuple[int, int],
+    no_data_value=-9999,
+    fill_holes: int = 0,
+) -> np.array:
+    """Create the height rasters of each class with a vectorized method (cf. MNX_METHODS): the height of a pixel is
+    the max, min or mean height of the points of the class that fall in this pixel, and pixels without points are
+    set to no_data_value (unless they are filled with fill_small_holes).
+
+    Points can be read chunk by chunk (the per-pixel values are accumulated chunk after chunk). Heights are reduced
+    on the raw las Z values, and scaled only once per pixel.
+
+    Args:
+        chunks (Iterable[LasPoints]): points of each chunk (X, Y, Z and classification are used)
+        class_keys (List[str]): ordered list of (potentially composed) class keys (one output layer per key)
+        method (str): "max", "min" or "mean"
+        pixel_size (float): size of the output raster pixels
+        x_min (float): x coordinate of the center of the top left pixel
+        y_max (float): y coordinate of the center of the top left pixel
+        nb_pixels (Tuple[int, int]): number of pixels on each axis in format (x, y)
+        no_data_value (int, optional): no_data value for the output raster. Defaults to -9999.
+        fill_holes (int, optional): if > 0, fill the empty pixels that are at most fill_holes pixels away from an
+        occupied pixel (cf. fill_small_holes). Defaults to 0.
+
+    Raises:
+        ValueError: if method is not a vectorized method
+
+    Returns:
+        np.array: float32 array of shape (len(class_keys), nb_pixels[1], nb_pixels[0])
+    """
+    if method not in MNX_METHODS[1:]:
+        raise ValueError(f"Unknown vectorized method to create height rasters: {method}")
+
+    nb_layers = len(class_keys)
+    flat_size = nb_pixels[0] * nb_pixels[1]
+    class_lut = commons.create_class_bitmask_lut(class_keys)
+    counts = np.zeros((nb_layers, flat_size), dtype=np.uint32)
+    values = None
+    z_scale, z_offset = 1, 0
+
+    for points in chunks:
+        if values is None:
+            values = _init_mnx_values(method, (nb_layers, flat_size), points.Z.dtype)
+            z_scale, z_offset = points.scales[2], points.offsets[2]
+
+        points_masks = class_lut[points.classification]
+        has_layer = points_masks != 0
+        flat_indices = occupancy_map.compute_points_flat_pixel_indices(
+            points, has_layer, pixel_size, x_min, y_max, nb_pixels
+        )
+        zs = points.Z[has_layer]
+        points_masks = points_masks[has_layer]
+
+        for ii in range(nb_layers):
+            in_layer = ((points_masks >> points_masks.dtype.type(ii)) & 1).astype(bool)
+            layer_indices = flat_indices[in_layer]
+            counts[ii] += np.bincount(layer_indices, minlength=flat_size).astype(np.uint32)
+            if method == "max":
+                np.maximum.at(values[ii], layer_indices, zs[in_layer])
+            elif method == "min":
+                np.minimum.at(values[ii], layer_indices, zs[in_layer])
+            else:
+                values[ii] += np.bincount(layer_indices, weights=zs[in_layer], minlength=flat_size)
+
+    occupied = counts > 0
+    if values is None:
+        mnx = np.full((nb_layers, flat_size), no_data_value, dtype=np.float32)
+    else:
+        if method == "mean":
+            values = values / np.maximum(counts, 1)
+        mnx = np.where(occupied, values * z_scale + z_offset, no_data_value).astype(np.float32)
+
+    mnx = mnx.reshape(nb_layers, nb_pixels[1], nb_pixels[0])
+    if fill_holes > 0:
+        for mnx_layer, occupied_layer in zip(mnx, occupied.reshape(mnx.shape)):
+            fill_small_holes(mnx_layer, occupied_layer, fill_holes)
+
+    return mnx
+
+
+def quantize_mnx(mnx: np.array, no_data_value, step: float) -> Tuple[np.array, np.array, int]:
+    """Encode height rasters as integers: each value z is stored as round((z - offset) / step), with one offset by
+    layer (the minimum value of the layer, rounded down to a multiple of step). The values are stored in int16 if they
+    fit, in int32 otherwise, and the pixels with no_data_value get the minimum value of the integer type.
+
+    Args:
+        mnx (np.array): 3d array of height rasters (one layer per class)
+        no_data_value (int): no_data value of mnx
+        step (float): quantization step (eg. 0.01 to store centimeters)
+
+    Raises:
+        ValueError: if the range of the values of a layer is too large to be stored as int32
+
+    Returns:
+        Tuple[np.array, np.array, int]: quantized rasters, offset of each layer, no_data value of the quantized rasters
+    """
+    is_valid = mnx != no_data_value
+    offsets = np.zeros(mnx.shape[0])
+    max_values = np.zeros(mnx.shape[0])
+    for ii, (layer, layer_is_valid) in enumerate(zip(mnx, is_valid)):
+        if np.any(layer_is_valid):
+            offsets[ii] = np.floor(np.min(layer, where=layer_is_valid, initial=np.inf) / step) * step
+            max_values[ii] = np.max(layer, where=layer_is_valid, initial=-np.inf)
+
+    max_quantized = np.max(np.rint((max_values - offsets) / step), initial=0)
+    for dtype in (np.int16, np.int32):
+        if max_quantized < np.iinfo(dtype).max:
+            break
+    else:
+        raise ValueError(f"Height range of the MNx is too large to be quantized with step {step}")
+
+    quantized_no_data = np.iinfo(dtype).min
+    quantized = np.full(mnx.shape, quantized_no_data, dtype=dtype)
+    for ii in range(mnx.shape[0]):
+        quantized[ii][is_valid[ii]] = np.rint((mnx[ii][is_valid[ii]] - offsets[ii]) / step)
 
-def mask_raster_with_nodata(raster_to_mask: Path, mask: np.array, output_tif: Path):
-    """Replace data in raster_to_mask by "no_data_value" where mask=0
-    (usual masks are occupancy maps for which 1 indicates that there are data)
+    return quantized, offsets, quantized_no_data
+
+
+def write_mnx_map(
+    mnx: np.array,
+    x_min: float,
+    y_max: float,
+    crs,
+    output_tif: Path,
+    pixel_size: float,
+    no_data_value=-9999,
+    quantization_step: float = 0,
+    empty_layers: np.array = None,
+    compress: str = raster_compression["malt0"],
+    sparse_max_occupancy: float = sparse_layer_max_occupancy,
+):
+    """Save height rasters (as returned by create_mnx_array_from_chunks) in a single output_tif file with one layer
+    per class.
+
+    The rasters are stored as float32, or as integers with scale/offset metadata if quantization_step is set
+    (cf. quantize_mnx), so that each value is known with a precision of quantization_step / 2.
+    The file is tiled with one band after the other, and the empty layers are flagged (cf. commons.tag_empty_layers)
+    and not written on disk (sparse file, read as no_data_value), cf. coclico.io.write_raster. The pixels of the
+    layers with very few pixels with values are also stored as lists of pixels (cf. commons.tag_sparse_layers).
 
     Args:
-        raster_to_mask (Path): Path to the raster on which to replace data
-        mask (np.array): Binary Array (with the same shape as raster_to_mask data) with 1 where to keep data,
-        0 where to replace them with the nodata value
-        output_tif (Path): Path to the resulting file
+        mnx (np.array): 3d array of height rasters (one layer per class)
+        x_min (float): x coordinate of the center of the top left pixel
+        y_max (float): y coordinate of the center of the top left pixel
+        crs: crs of the output raster (as read in the las header)
+        output_tif (Path): path to output
+        pixel_size (float): size of the output raster pixels
+        no_data_value (int, optional): no_data value for the output raster. Defaults to -9999.
+        quantization_step (float, optional): quantization step of the integer encoding (eg. 0.01 to store
+        centimeters). Defaults to 0 (float32 values).
+        empty_layers (np.array, optional): boolean array that is True for each layer without values. Defaults to None
+        (computed from mnx).
+        compress (str, optional): compression of the output file (None for no compression).
+        Defaults to raster_compression["malt0"].
+        sparse_max_occupancy (float, optional): maximum proportion of pixels with values for a layer to be also
+        stored as a list of pixels (0 to disable). Defaults to sparse_layer_max_occupancy.
     """
-    with rasterio.Env():
-        with rasterio.open(str(raster_to_mask)) as src:
-            raster = src.read()
-            out_meta = src.meta
-            nodata = src.nodata
+    if empty_layers is None:
+        empty_layers = np.all(mnx == no_data_value, axis=(1, 2))
 
-        raster[mask == 0] = nodata
+    if quantization_step:
+        data, offsets, no_data_value = quantize_mnx(mnx, no_data_value, quantization_step)
+        scales = [quantization_step] * mnx.shape[0]
+        offsets = offsets.tolist()
+        logging.debug(f"MNx quantized as {data.dtype} with step {quantization_step}")
+    else:
+        data = mnx.astype(np.float32, copy=False)
+        scales, offsets = None, None
 
-        with rasterio.open(str(output_tif), "w", **out_meta) as dest:
-            dest.write(raster)
+    coclico.io.write_raster(
+        data,
+        output_tif,
+        transform=rasterio.transform.from_origin(
+            x_min - pixel_size / 2, y_max + pixel_size / 2, pixel_size, pixel_size
+        ),
+        crs=crs,
+        nodata=no_data_value,
+        compress=compress,
+        empty_layers=empty_layers,
+        scales=scales,
+        offsets=offsets,
+        sparse_max_occupancy=sparse_max_occupancy,
+        sparse_values=True,
+    )
 
 
 def compute_metric_intrinsic(
@@ -88,6 +611,13 @@ def compute_metric_intrinsic(
     output_tif: Path,
     pixel_size: float = 0.5,
     no_data_value=-9999,
+    chunk_size: int = None,
+    mnx_method: str = "delaunay",
+    mnx_fill_holes: int = 0,
+    mnx_workers: int = mnx_workers,
+    mnx_block_size: int = mnx_block_size,
+    mnx_block_halo: int = mnx_block_halo,
+    mnx_quantization_step: float = mnx_quantization_step,
 ):
     """
     Create for each class that is in config_file keys:
@@ -102,18 +632,206 @@ def compute_metric_intrinsic(
         output_tif (Path): path to output height raster
         pixel_size (float, optional): size of the output rasters pixels. Defaults to 0.5.
         no_data_value (int, optional): no_data value for the output raster. Defaults to -9999.
+        chunk_size (int, optional): if set, read the las file by chunks of chunk_size points (bounded memory). With the
+        "delaunay" method, the points of the classes of the metric are kept for the triangulation (cf.
+        create_mnx_array_with_delaunay_from_las). Defaults to None (read all points at once).
+        mnx_method (str, optional): method used to compute the height rasters (cf. MNX_METHODS).
+        Defaults to "delaunay".
+        mnx_fill_holes (int, optional): for the vectorized methods, fill the empty pixels that are at most
+        mnx_fill_holes pixels away from a pixel with points (cf. fill_small_holes). Defaults to 0 (no filling).
+        mnx_workers (int, optional): for the "delaunay" method, maximum number of pdal pipelines executed at the
+        same time (0 to use all the CPUs available to the container). Defaults to mnx_workers from coclico.config.
+        mnx_block_size (int, optional): for the "delaunay" method, size (in pixels) of the blocks that are
+        triangulated separately (cf. create_mnx_array_with_delaunay). Defaults to mnx_block_size from coclico.config.
+        mnx_block_halo (int, optional): for the "delaunay" method, size (in pixels) of the halo around each block.
+        Defaults to mnx_block_halo from coclico.config.
+        mnx_quantization_step (float, optional): quantization step of the integer encoding of the output raster (cf.
+        write_mnx_map), 0 to store float32 values. Defaults to mnx_quantization_step from coclico.config.
+    """
+    if chunk_size:
+        config_dict = coclico.io.read_config_file(config_file)
+        class_weights = config_dict[MALT0.metric_name]["weights"]
+        if mnx_method == "delaunay":
+            # occupancy maps and height rasters are both computed on the grid of the las header bounds
+            with commons.log_duration(f"Occupancy maps creation for {las_file.name}"):
+                binary_maps, _, _, _ = occupancy_map.create_occupancy_map_array_from_las(
+                    las_file, pixel_size, class_weights, chunk_size
+                )
+            with commons.log_duration(f"MNx rasterization (delaunay) of {las_file.name}"):
+                mnx, x_min, y_max, crs = create_mnx_array_with_delaunay_from_las(
+                    las_file,
+                    class_weights,
+                    pixel_size,
+                    chunk_size,
+                    no_data_value,
+                    mnx_workers,
+                    mnx_block_size,
+                    mnx_block_halo,
+                )
+            with commons.log_duration("MNx masking"):
+                mnx[binary_maps == 0] = no_data_value
+            with commons.log_duration(f"MNx writing to {output_tif}"):
+                write_mnx_map(mnx, x_min, y_max, crs, output_tif, pixel_size, no_data_value, mnx_quantization_step)
+        else:
+            las_bounds, crs = coclico.io.read_las_header(las_file)
+            (x_min, y_max), nb_pixels = commons.get_raster_geometry_from_las_bounds(las_bounds, pixel_size)
+            chunks = coclico.io.iter_las_points(las_file, chunk_size, MNX_DIMENSIONS)
+            with commons.log_duration(f"MNx rasterization ({mnx_method}) of {las_file.name}"):
+                mnx = create_mnx_array_from_chunks(
+                    chunks,
+                    sorted(class_weights.keys()),
+                    mnx_method,
+                    pixel_size,
+                    x_min,
+                    y_max,
+                    nb_pixels,
+                    no_data_value,
+                    mnx_fill_holes,
+                )
+            with commons.log_duration(f"MNx writing to {output_tif}"):
+                write_mnx_map(mnx, x_min, y_max, crs, output_tif, pixel_size, no_data_value, mnx_quantization_step)
+    else:
+        with commons.log_duration(f"Points reading for {las_file.name}"):
+            points = occupancy_map.read_las(las_file, MNX_DIMENSIONS)
+        compute_metric_intrinsic_from_points(
+            las_file,
+            points,
+            config_file,
+            output_tif,
+            pixel_size,
+            no_data_value,
+            mnx_method,
+            mnx_fill_holes,
+            mnx_workers,
+            mnx_block_size,
+            mnx_block_halo,
+            mnx_quantization_step,
+        )
+
+
+def compute_metric_intrinsic_from_points(
+    las_file: Path,
+    points: coclico.io.LasPoints,
+    config_file: Path,
+    output_tif: Path,
+    pixel_size: float = 0.5,
+    no_data_value=-9999,
+    mnx_method: str = "delaunay",
+    mnx_fill_holes: int = 0,
+    mnx_workers: int = mnx_workers,
+    mnx_block_size: int = mnx_block_size,
+    mnx_block_halo: int = mnx_block_halo,
+    mnx_quantization_step: float = mnx_quantization_step,
+):
+    """Compute malt0 intrinsic metric (cf. compute_metric_intrinsic) from points that have already been read.
+
+    With the "delaunay" method, the height rasters are generated with pdal from the decoded points, one class per
+    worker (cf. create_mnx_array_with_delaunay), and masked with the occupancy maps that are shared with the other
+    metrics computed on the same tile through the tiles cache (cf. occupancy_map.get_occupancy_map_array).
+    With the vectorized methods, the height rasters are computed from the points on the same grid as the occupancy
+    maps: pixels without points already contain no_data_value, so that no masking is needed.
+
+    Args:
+        las_file (Path): path to the las file on which to generate malt0 intrinsic metric
+        points (LasPoints): points as returned by occupancy_map.read_las for las_file (Z is needed for the
+        vectorized methods, and to avoid reading las_file again for the "delaunay" method)
+        config_file (Path): class weights dict in the config file (to know for which classes to generate the rasters)
+        output_tif (Path): path to output height raster
+        pixel_size (float, optional): size of the output rasters pixels. Defaults to 0.5.
+        no_data_value (int, optional): no_data value for the output raster. Defaults to -9999.
+        mnx_method (str, optional): method used to compute the height rasters (cf. MNX_METHODS).
+        Defaults to "delaunay".
+        mnx_fill_holes (int, optional): for the vectorized methods, fill the empty pixels that are at most
+        mnx_fill_holes pixels away from a pixel with points (cf. fill_small_holes). Defaults to 0 (no filling).
+        mnx_workers (int, optional): for the "delaunay" method, maximum number of pdal pipelines executed at the
+        same time (0 to use all the CPUs available to the container). Defaults to mnx_workers from coclico.config.
+        mnx_block_size (int, optional): for the "delaunay" method, size (in pixels) of the blocks that are
+        triangulated separately (cf. create_mnx_array_with_delaunay). Defaults to mnx_block_size from coclico.config.
+        mnx_block_halo (int, optional): for the "delaunay" method, size (in pixels) of the halo around each block.
+        Defaults to mnx_block_halo from coclico.config.
+        mnx_quantization_step (float, optional): quantization step of the integer encoding of the output raster (cf.
+        write_mnx_map), 0 to store float32 values. Defaults to mnx_quantization_step from coclico.config.
     """
     config_dict = coclico.io.read_config_file(config_file)
     class_weights = config_dict[MALT0.metric_name]["weights"]
 
-    output_tif.parent.mkdir(parents=True, exist_ok=True)
+    if mnx_method == "delaunay":
+        with commons.log_duration(f"Occupancy maps creation for {las_file.name}"):
+            binary_maps, _, _ = occupancy_map.get_occupancy_map_array(las_file, points, pixel_size, class_weights)
+        create_masked_mnx_map(
+            las_file,
+            points,
+            binary_maps,
+            class_weights,
+            output_tif,
+            pixel_size,
+            no_data_value,
+            mnx_workers,
+            mnx_block_size,
+            mnx_block_halo,
+            mnx_quantization_step,
+        )
+    else:
+        (x_min, y_max), nb_pixels = occupancy_map.get_grid_geometry(las_file, points, pixel_size)
+        with commons.log_duration(f"MNx rasterization ({mnx_method}) of {las_file.name}"):
+            mnx = create_mnx_array_from_chunks(
+                [points],
+                sorted(class_weights.keys()),
+                mnx_method,
+                pixel_size,
+                x_min,
+                y_max,
+                nb_pixels,
+                no_data_value,
+                mnx_fill_holes,
+            )
+        with commons.log_duration(f"MNx writing to {output_tif}"):
+            write_mnx_map(mnx, x_min, y_max, points.crs, output_tif, pixel_size, no_data_value, mnx_quantization_step)
+
+
+def create_masked_mnx_map(
+    las_file: Path,
+    points: coclico.io.LasPoints,
+    binary_maps: np.array,
+    class_weights: dict,
+    output_tif: Path,
+    pixel_size: float = 0.5,
+    no_data_value=-9999,
+    workers: int = mnx_workers,
+    block_size: int = mnx_block_size,
+    block_halo: int = mnx_block_halo,
+    quantization_step: float = mnx_quantization_step,
+):
+    """Create the height rasters of las_file (cf. create_mnx_array_with_delaunay) and mask them with the occupancy
+    maps binary_maps. The rasters are kept in memory, so that output_tif is the only raster that is written on disk.
+
+    Args:
+        las_file (Path): path to the las file on which to generate malt0 intrinsic metric
+        points (LasPoints): points of las_file (X, Y, Z and classification are used)
+        binary_maps (np.array): occupancy maps of the classes of class_weights, on the grid of the occupancy maps of
+        points (cf. occupancy_map.get_occupancy_map_array)
+        class_weights (dict): class weights dict (to know for which classes to generate the rasters)
+        output_tif (Path): path to output height raster
+        pixel_size (float, optional): size of the output rasters pixels. Defaults to 0.5.
+        no_data_value (int, optional): no_data value for the output raster. Defaults to -9999.
+        workers (int, optional): maximum number of pdal pipelines executed at the same time (0 to use all the CPUs
+        available to the container). Defaults to mnx_workers.
+        block_size (int, optional): size (in pixels) of the blocks that are triangulated separately (0 to triangulate
+        each class at once). Defaults to mnx_block_size.
+        block_halo (int, optional): size (in pixels) of the halo around each block. Defaults to mnx_block_halo.
+        quantization_step (float, optional): quantization step of the integer encoding of the output raster (cf.
+        write_mnx_map), 0 to store float32 values. Defaults to mnx_quantization_step.
+    """
+    with commons.log_duration(f"MNx rasterization (delaunay) of {las_file.name}"):
+        mnx, x_min, y_max = create_mnx_array_with_delaunay(
+            las_file, points, class_weights, pixel_size, no_data_value, workers, block_size, block_halo
+        )
 
-    with tempfile.NamedTemporaryFile(suffix=las_file.stem + "_mnx.tif") as tmp_mnx:
-        xs, ys, classifs, _ = occupancy_map.read_las(las_file)
-        binary_maps, _, _ = occupancy_map.create_occupancy_map_array(xs, ys, classifs, pixel_size, class_weights)
+    with commons.log_duration("MNx masking"):
+        mnx[binary_maps == 0] = no_data_value
 
-        create_mnx_map(las_file, class_weights, tmp_mnx.name, pixel_size, no_data_value)
-        mask_raster_with_nodata(tmp_mnx.name, binary_maps, output_tif)
+    with commons.log_duration(f"MNx writing to {output_tif}"):
+        write_mnx_map(mnx, x_min, y_max, points.crs, output_tif, pixel_size, no_data_value, quantization_step)
 
 
 def parse_args():
@@ -128,14 +846,75 @@ def parse_args():
         help="Coclico configuration file",
     )
     parser.add_argument("-p", "--pixel-size", type=float, required=True, help="Size of the output raster pixels")
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        help="If set, read the LAS file by chunks of this number of points (bounded memory)",
+    )
+    parser.add_argument(
+        "--laz-threads",
+        type=int,
+        default=laz_threads,
+        help="Number of threads used to decompress LAZ files (0 to use all the CPUs available to the container)",
+    )
+    parser.add_argument(
+        "--mnx-method",
+        choices=MNX_METHODS,
+        default="delaunay",
+        help="Method used to compute the height rasters: delaunay triangulation, or max/min/mean height of the points "
+        "in each pixel (vectorized)",
+    )
+    parser.add_argument(
+        "--mnx-fill-holes",
+        type=int,
+        default=0,
+        help="For the vectorized methods, fill the empty pixels that are at most this number of pixels away from a "
+        "pixel with points",
+    )
+    parser.add_argument(
+        "--mnx-workers",
+        type=int,
+        default=mnx_workers,
+        help="For the delaunay method, maximum number of classes processed at the same time (0 to use all the CPUs "
+        "available to the container)",
+    )
+    parser.add_argument(
+        "--mnx-block-size",
+        type=int,
+        default=mnx_block_size,
+        help="For the delaunay method, size (in pixels) of the blocks that are triangulated separately "
+        "(0 to triangulate each class at once)",
+    )
+    parser.add_argument(
+        "--mnx-block-halo",
+        type=int,
+        default=mnx_block_halo,
+        help="For the delaunay method, size (in pixels) of the halo of points used around each block",
+    )
+    parser.add_argument(
+        "--mnx-quantization-step",
+        type=float,
+        default=mnx_quantization_step,
+        help="If set, store the height rasters as compressed integers with this step (eg. 0.01 for centimeters) "
+        "instead of float32",
+    )
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = parse_args()
     logging.basicConfig(format="%(message)s", level=logging.DEBUG)
+    coclico.io.configure_laz_decompression(args.laz_threads)
     compute_metric_intrinsic(
         las_file=Path(args.input_file),
         config_file=args.config_file,
         output_tif=Path(args.output_mnx_file),
+        chunk_size=args.chunk_size,
+        mnx_method=args.mnx_method,
+        mnx_fill_holes=args.mnx_fill_holes,
+        mnx_workers=args.mnx_workers,
+        mnx_block_size=args.mnx_block_size,
+        mnx_block_halo=args.mnx_block_halo,
+        mnx_quantization_step=args.mnx_quantization_step,
     )
@@ -1,19 +1,39 @@
 import argparse
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Dict, List, Tuple
 
 import numpy as np
 import numpy.ma as ma
 import pandas as pd
 import rasterio
+from osgeo import gdal
 
-from coclico.config import csv_separator
-from coclico.io import read_config_file
+from coclico.config import csv_separator, raster_compression
+from coclico.io import read_config_file, write_raster
 from coclico.malt0.malt0 import MALT0
+from coclico.metrics.commons import (
+    intersect_sorted_indices,
+    read_dense_layers,
+    read_empty_layers,
+    read_sparse_layers,
+)
+
+gdal.UseExceptions()
+
+# Number of pixels of each layer that are processed at once when computing stats, so that the intermediate arrays stay
+# in the CPU cache
+STATS_BLOCK_SIZE = 1 << 16
+# Width (in meters) and number of the bins of the histograms used to compute the percentiles of the height differences:
+# the percentiles are estimated with an error smaller than the bin width, the last bin gathers all the differences that
+# are larger than DIFF_HISTOGRAM_BIN_SIZE * (DIFF_HISTOGRAM_NB_BINS - 1)
+DIFF_HISTOGRAM_BIN_SIZE = 0.01
+DIFF_HISTOGRAM_NB_BINS = 10000
 
 
 def compute_stats_single_raster(raster: np.array):
-    """Compute stats for a single raster, masked by an occupancy raster.
+    """Compute stats for a single raster, where pixels without values are NaN (or masked, for masked arrays).
 
     Returns a np.array for each statistic:
     - maximum value
@@ -23,24 +43,196 @@ def compute_stats_single_raster(raster: np.array):
     - m2 (square distance to the mean), used to calculate the variance
     (as in https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm)
 
-    Each array contains one value for each layer of the raster.
+    Each array contains one value for each layer of the raster (0 for layers without values).
+
+    The raster is read block by block (STATS_BLOCK_SIZE pixels of each layer at once): stats are computed on each block
+    from float32 values with float64 accumulators, then merged with update_overall_stats, so that the raster is read
+    only once from memory.
 
     Args:
-        raster (np.array): raster for which to compute
-        occupancy_raster (np.array): occupancy map of the raster (1 where there are values to compare, 0 anywhere else)
+        raster (np.array): 3d raster for which to compute stats (one layer per class), with NaN (or masked values)
+        where there are no values to compare
 
     Returns:
         np.arrays: max value, pixel count, mean, standard deviation and m2 values
     """
-    max_val = ma.max(raster, axis=(1, 2)).filled(0)
-    count = ma.count(raster, axis=(1, 2))
-    mean_val = ma.mean(raster, axis=(1, 2)).filled(0)
-    std_val = ma.std(raster, axis=(1, 2)).filled(0)
-    m2 = ma.sum(np.square(raster - mean_val[:, None, None]), axis=(1, 2)).filled(0)  # distance to the mean
+    if ma.isMaskedArray(raster):
+        raster = raster.astype(np.float32).filled(np.nan)
+    values = raster.reshape(raster.shape[0], -1)
+    nb_layers, nb_pixels = values.shape
+
+    max_val = np.full(nb_layers, -np.inf)
+    count = np.zeros(nb_layers, dtype=np.int64)
+    mean_val = np.zeros(nb_layers)
+    m2 = np.zeros(nb_layers)
+    for start in range(0, nb_pixels, STATS_BLOCK_SIZE):
+        end = start + STATS_BLOCK_SIZE
+        block = values[:, start:end]
+        is_valid = ~np.isnan(block)
+        block_count = np.count_nonzero(is_valid, axis=1)
+        block_sum = np.add.reduce(block, axis=1, dtype=np.float64, where=is_valid)
+        block_mean = np.divide(block_sum, block_count, out=np.zeros(nb_layers), where=block_count > 0)
+        block_m2 = np.add.reduce(np.square(block - block_mean[:, None]), axis=1, where=is_valid)
+        block_max = np.maximum.reduce(block, axis=1, where=is_valid, initial=-np.inf)
+
+        # layers without values in the current and previous blocks are handled by update_overall_stats
+        with np.errstate(invalid="ignore", divide="ignore"):
+            max_val, count, mean_val, m2 = update_overall_stats(
+                block_max, max_val, block_count, count, block_mean, mean_val, block_m2, m2
+            )
+
+    has_values = count > 0
+    max_val = np.where(has_values, max_val, 0)
+    std_val = np.sqrt(np.divide(m2, count, out=np.zeros(nb_layers), where=has_values))
 
     return max_val, count, mean_val, std_val, m2
 
 
+def compute_histogram_single_raster(
+    raster: np.array, bin_size: float = DIFF_HISTOGRAM_BIN_SIZE, nb_bins: int = DIFF_HISTOGRAM_NB_BINS
+) -> np.array:
+    """Compute a fixed-width histogram of the (positive) values of each layer of a raster, where pixels without
+    values are NaN (or masked, for masked arrays).
+
+    The histograms have a fixed size whatever the number of pixels, and histograms computed on several rasters can be
+    merged by summing them. Values larger than the range of the histogram are counted in the last bin.
+
+    Args:
+        raster (np.array): 3d raster for which to compute histograms (one layer per class)
+        bin_size (float, optional): width of the bins. Defaults to DIFF_HISTOGRAM_BIN_SIZE.
+        nb_bins (int, optional): number of bins. Defaults to DIFF_HISTOGRAM_NB_BINS.
+
+    Returns:
+        np.array: histograms, as an array of shape (nb_layers, nb_bins)
+    """
+    if ma.isMaskedArray(raster):
+        raster = raster.astype(np.float32).filled(np.nan)
+    values = raster.reshape(raster.shape[0], -1)
+    nb_layers, nb_pixels = values.shape
+    # offset of the histogram of each layer in the flattened histograms
+    layer_offsets = np.arange(nb_layers) * nb_bins
+
+    histogram = np.zeros(nb_layers * nb_bins, dtype=np.int64)
+    for start in range(0, nb_pixels, STATS_BLOCK_SIZE):
+        end = start + STATS_BLOCK_SIZE
+        block = values[:, start:end]
+        is_valid = ~np.isnan(block)
+        # valid values are sorted by layer, as the block is read in row-major order
+        bins = np.clip(block[is_valid] / bin_size, 0, nb_bins - 1).astype(np.int64)
+        bins += np.repeat(layer_offsets, np.count_nonzero(is_valid, axis=1))
+        histogram += np.bincount(bins, minlength=nb_layers * nb_bins)
+
+    return histogram.reshape(nb_layers, nb_bins)
+
+
+def compute_quantiles_from_histogram(
+    histogram: np.array, max_val: np.array, quantiles: Tuple[float], bin_size: float = DIFF_HISTOGRAM_BIN_SIZE
+) -> np.array:
+    """Estimate percentiles from the histograms computed with compute_histogram_single_raster (or a sum of such
+    histograms), with a linear interpolation inside the bin that contains each percentile.
+
+    Args:
+        histogram (np.array): histograms, as an array of shape (nb_layers, nb_bins)
+        max_val (np.array): maximum value of each layer, used to bound the estimated percentiles (and as the value of
+        the percentiles that fall in the last bin of the histogram)
+        quantiles (Tuple[float]): percentiles to compute (between 0 and 100)
+        bin_size (float, optional): width of the bins. Defaults to DIFF_HISTOGRAM_BIN_SIZE.
+
+    Returns:
+        np.array: percentiles, as an array of shape (nb_layers, len(quantiles)) (0 for layers without values)
+    """
+    nb_layers, nb_bins = histogram.shape
+    layers = np.arange(nb_layers)
+    count = histogram.sum(axis=1)
+    cumulated_count = np.cumsum(histogram, axis=1)
+
+    out = np.zeros((nb_layers, len(quantiles)))
+    for ii, quantile in enumerate(quantiles):
+        rank = quantile / 100 * count
+        # first bin for which the cumulated count reaches the rank of the percentile
+        bin_index = np.argmax(cumulated_count >= rank[:, None], axis=1)
+        bin_count = histogram[layers, bin_index]
+        count_before = cumulated_count[layers, bin_index] - bin_count
+        fraction = np.divide(rank - count_before, bin_count, out=np.zeros(nb_layers), where=bin_count > 0)
+        value = np.where(bin_index < nb_bins - 1, np.minimum((bin_index + fraction) * bin_size, max_val), max_val)
+        out[:, ii] = np.where(count > 0, value, 0)
+
+    return out
+
+
+def read_raster_with_nan(raster_file: Path, layers: np.array = None) -> np.array:
+    """Read a raster as a float32 array, with NaN where pixels have the nodata value. The scale/offset metadata of
+    the layers (eg. for quantized height rasters, cf. malt0_intrinsic.write_mnx_map) is applied to the values.
+
+    Args:
+        raster_file (Path): path to the raster file
+        layers (np.array, optional): indices (starting from 0) of the layers to read. Defaults to None (all layers).
+
+    Returns:
+        np.array: 3d array of the raster values
+    """
+    with rasterio.Env():
+        with rasterio.open(raster_file) as src:
+            indexes = list(range(1, src.count + 1)) if layers is None else [int(ii) + 1 for ii in layers]
+            raster = read_dense_layers(src, indexes, out_dtype=np.float32)
+            nodata = src.nodata
+            scales = np.array([src.scales[ii - 1] for ii in indexes], dtype=np.float32)
+            offsets = np.array([src.offsets[ii - 1] for ii in indexes], dtype=np.float32)
+
+    is_nodata = raster == nodata if nodata is not None and not np.isnan(nodata) else None
+    if np.any(scales != 1) or np.any(offsets != 0):
+        raster *= scales[:, None, None]
+        raster += offsets[:, None, None]
+    if is_nodata is not None:
+        raster[is_nodata] = np.nan
+
+    return raster
+
+
+def write_diff_raster(
+    diff_raster: np.array,
+    profile: Dict,
+    classes: List[str],
+    output_tif: Path,
+    no_data_value=-9999,
+    compress: str = raster_compression["malt0_diff"],
+):
+    """Save a height difference raster (one layer per class, NaN where there is no difference) in a tiled float32
+    output_tif file (cf. coclico.io.write_raster).
+    The NaN values of diff_raster are replaced by no_data_value in place.
+
+    Args:
+        diff_raster (np.array): 3d array of height differences (one layer per class)
+        profile (Dict): rasterio profile of the compared rasters (for the georeferencing)
+        classes (List[str]): class of each layer (used as band description)
+        output_tif (Path): path to output
+        no_data_value (int, optional): no_data value for the output raster. Defaults to -9999.
+        compress (str, optional): compression of the output file (None for no compression).
+        Defaults to raster_compression["malt0_diff"].
+    """
+    diff_raster[np.isnan(diff_raster)] = no_data_value
+    write_raster(
+        diff_raster.astype(np.float32, copy=False),
+        output_tif,
+        transform=profile["transform"],
+        crs=profile["crs"],
+        nodata=no_data_value,
+        compress=compress,
+        descriptions=classes,
+    )
+
+
+def build_diff_vrt(diff_files: List[Path], output_vrt: Path):
+    """Build a virtual mosaic (VRT) of the height difference rasters of all the tiles
+
+    Args:
+        diff_files (List[Path]): height difference rasters (as written by write_diff_raster)
+        output_vrt (Path): path to the output vrt file
+    """
+    # the vrt file is written when the dataset is flushed
+    gdal.BuildVRT(str(output_vrt), [str(f) for f in diff_files]).FlushCache()
+
+
 def update_overall_stats(
     max_val: np.array,
     max_previous: np.array,
@@ -86,6 +278,7 @@ def compute_metric_relative(
     config_file: str,
     output_csv: Path,
     output_csv_tile: Path,
+    output_diff_dir: Path = None,
 ):
     """Compute metrics that describe the difference between c1 and ref height maps.
     The occupancy map is used to mask the pixels for which the difference is computed
@@ -94,12 +287,18 @@ def compute_metric_relative(
     - mean_diff: the average difference in z between the height maps
     - max_diff: the maximum difference in z between the height maps
     - std_diff: the standard deviation of the difference in z betweeen the height maps
+    - p50_diff, p90_diff, p99_diff: percentiles of the difference in z between the height maps (cf.
+    MALT0.diff_quantiles), estimated from fixed-size histograms that are merged across tiles
 
-    If there is no reference point: mean_diff = 0, max_diff = 0, std_diff = 0
+    If there is no reference point: mean_diff = 0, max_diff = 0, std_diff = 0 (and percentiles = 0)
 
     These metrics are stored tile by tile and class by class in the output_csv_tile file
     These metrics are stored class by class for the whole data in the output_csv file
 
+    If output_diff_dir is set, the absolute height difference rasters are also saved tile by tile in this folder
+    (<tile_stem>.tif, one layer per class), with a virtual mosaic of all tiles (diff.vrt). Each raster is written in a
+    background thread while the next tile is processed.
+
     Args:
         c1_dir (Path):  path to the c1 classification directory,
                         where there are json files with the result of mpap0 intrinsic metric
@@ -108,7 +307,8 @@ def compute_metric_relative(
         config_file (Path): Coclico configuration file
         output_csv (Path):  path to output csv file
         output_csv_tile (Path):  path to output csv file, result by tile
-
+        output_diff_dir (Path, optional): path to the output folder for the height difference rasters.
+        Defaults to None (height difference rasters are not saved).
     """
     config_dict = read_config_file(config_file)
     class_weights = config_dict[MALT0.metric_name]["weights"]
@@ -129,35 +329,93 @@ def compute_metric_relative(
     # Store the squared distance to the current mean of the rasters differences
     # in the previously seen rasters
     total_m2 = np.zeros(len(classes))
-
-    for ref_file in ref_dir.iterdir():
-        c1_file = c1_dir / ref_file.name
-        with rasterio.Env():
-            with rasterio.open(c1_file) as c1:
-                c1_raster = c1.read(masked=True)
-
-            with rasterio.open(ref_file) as ref:
-                ref_raster = ref.read(masked=True)
-
-        max_diff, count, mean_diff, std_diff, m2_diff = compute_stats_single_raster(np.abs(c1_raster - ref_raster))
-        new_line = [
-            {
-                "tile": ref_file.stem,
-                "class": cl,
-                "max_diff": max_diff[ii],
-                "mean_diff": mean_diff[ii],
-                # return 0 if there is not enough points to compute std (numpy std for 0 or 1 point returns np.nan)
-                "std_diff": std_diff[ii] if not np.isnan(std_diff[ii]) else 0,
-            }
-            for ii, cl in enumerate(classes)
-        ]
-        csv_data.extend(new_line)
-
-        total_max_diff, total_count, total_mean_diff, total_m2 = update_overall_stats(
-            max_diff, total_max_diff, count, total_count, mean_diff, total_mean_diff, m2_diff, total_m2
-        )
+    # Store the histograms of the rasters differences in the previously seen rasters, to compute percentiles
+    total_histogram = np.zeros((len(classes), DIFF_HISTOGRAM_NB_BINS), dtype=np.int64)
+
+    if output_diff_dir is not None:
+        output_diff_dir.mkdir(parents=True, exist_ok=True)
+    diff_files = []
+    pending_write = None
+
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        for ref_file in ref_dir.iterdir():
+            c1_file = c1_dir / ref_file.name
+            c1_sparse, ref_sparse = read_sparse_layers(c1_file), read_sparse_layers(ref_file)
+            # the difference has no value in the layers that are empty in c1 or in ref: they are not read
+            has_values = ~(read_empty_layers(c1_file) | read_empty_layers(ref_file))
+            # layers that are sparse in both c1 and ref are compared from their lists of pixels, without being read
+            is_sparse = np.zeros(len(classes), dtype=bool)
+            is_sparse[list(c1_sparse.keys() & ref_sparse.keys())] = True
+            sparse_layers = np.flatnonzero(has_values & is_sparse)
+            layers = np.flatnonzero(has_values & ~is_sparse)
+            c1_raster = read_raster_with_nan(c1_file, layers)
+            ref_raster = read_raster_with_nan(ref_file, layers)
+
+            # the difference is NaN where one of the rasters has no value
+            diff_layers = np.abs(np.subtract(c1_raster, ref_raster, out=c1_raster), out=c1_raster)
+            # stats of the layers that are not read are 0
+            stats = np.zeros((5, len(classes)))
+            histogram = np.zeros((len(classes), DIFF_HISTOGRAM_NB_BINS), dtype=np.int64)
+            if len(layers):
+                stats[:, layers] = compute_stats_single_raster(diff_layers)
+                histogram[layers] = compute_histogram_single_raster(diff_layers)
+            sparse_diffs = {}
+            for ii in sparse_layers:
+                c1_indices, c1_values = c1_sparse[ii]
+                ref_indices, ref_values = ref_sparse[ii]
+                # the difference has values on the pixels that are in both lists
+                c1_positions, ref_positions = intersect_sorted_indices(c1_indices, ref_indices)
+                diff = np.abs(c1_values[c1_positions] - ref_values[ref_positions])[None, :]
+                stats[:, [ii]] = compute_stats_single_raster(diff)
+                histogram[[ii]] = compute_histogram_single_raster(diff)
+                sparse_diffs[ii] = (c1_indices[c1_positions], diff[0])
+            max_diff, count, mean_diff, std_diff, m2_diff = stats
+            quantiles_diff = compute_quantiles_from_histogram(histogram, max_diff, MALT0.diff_quantiles)
+            new_line = [
+                {
+                    "tile": ref_file.stem,
+                    "class": cl,
+                    "max_diff": max_diff[ii],
+                    "mean_diff": mean_diff[ii],
+                    # return 0 if there is not enough points to compute std (numpy std for 0 or 1 point returns np.nan)
+                    "std_diff": std_diff[ii] if not np.isnan(std_diff[ii]) else 0,
+                    **{f"p{q}_diff": quantiles_diff[ii, jj] for jj, q in enumerate(MALT0.diff_quantiles)},
+                }
+                for ii, cl in enumerate(classes)
+            ]
+            csv_data.extend(new_line)
+
+            total_max_diff, total_count, total_mean_diff, total_m2 = update_overall_stats(
+                max_diff, total_max_diff, count, total_count, mean_diff, total_mean_diff, m2_diff, total_m2
+            )
+            total_histogram += histogram
+
+            if output_diff_dir is not None:
+                # diff_raster is not used anymore in this thread: it is handed over to the writer thread
+                if len(layers) == len(classes):
+                    diff_raster = diff_layers
+                else:
+                    diff_raster = np.full((len(classes), *diff_layers.shape[1:]), np.nan, dtype=np.float32)
+                    diff_raster[layers] = diff_layers
+                for ii, (indices, diff) in sparse_diffs.items():
+                    diff_raster[ii].flat[indices] = diff
+                with rasterio.open(ref_file) as src:
+                    profile = src.profile
+                if pending_write is not None:
+                    # keep at most one tile waiting to be written
+                    pending_write.result()
+                diff_file = output_diff_dir / f"{ref_file.stem}.tif"
+                pending_write = writer.submit(write_diff_raster, diff_raster, profile, classes, diff_file)
+                diff_files.append(diff_file)
+
+        if pending_write is not None:
+            pending_write.result()
+
+    if diff_files:
+        build_diff_vrt(diff_files, output_diff_dir / "diff.vrt")
 
     total_std_diff = np.sqrt(total_m2 / total_count)
+    total_quantiles_diff = compute_quantiles_from_histogram(total_histogram, total_max_diff, MALT0.diff_quantiles)
 
     output_csv.parent.mkdir(parents=True, exist_ok=True)
     df = pd.DataFrame(csv_data)
@@ -171,6 +429,7 @@ def compute_metric_relative(
             "mean_diff": total_mean_diff[ii],
             # return 0 if there is not enough points to compute std (numpy std for 0 or 1 point returns np.nan)
             "std_diff": total_std_diff[ii] if not np.isnan(total_std_diff[ii]) else 0,
+            **{f"p{q}_diff": total_quantiles_diff[ii, jj] for jj, q in enumerate(MALT0.diff_quantiles)},
         }
         for ii, cl in enumerate(classes)
     ]
@@ -210,6 +469,13 @@ def parse_args():
         type=Path,
         help="Coclico configuration file",
     )
+    parser.add_argument(
+        "--output-diff-dir",
+        type=Path,
+        default=None,
+        help="If set, path to a folder where to save the height difference rasters (one tif file per tile, "
+        "and a vrt mosaic of all tiles)",
+    )
 
     return parser.parse_args()
 
@@ -223,4 +489,5 @@ if __name__ == "__main__":
         config_file=args.config_file,
         output_csv=Path(args.output_csv),
         output_csv_tile=Path(args.output_csv_tile),
+        output_diff_dir=args.output_diff_dir,
     )
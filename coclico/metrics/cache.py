@@ -0,0 +1,123 @@
+import logging
+from collections import OrderedDict
+from typing import Hashable
+
+import numpy as np
+
+from coclico.config import cache_max_bytes
+
+
+def freeze(value):
+    """Get a read-only copy of the numpy arrays of a value to cache (arrays, or tuples/lists of arrays and scalars).
+    The arrays are copied so that the caller's arrays are not modified, and so that views do not keep their base
+    array alive (which would not be counted in the cache budget)."""
+    if isinstance(value, np.ndarray):
+        frozen = value.copy()
+        frozen.flags.writeable = False
+        return frozen
+    if isinstance(value, (tuple, list)):
+        return type(value)(freeze(v) for v in value)
+
+    return value
+
+
+def get_nbytes(value) -> int:
+    """Get the number of bytes used by the numpy arrays of a cached value (arrays, or tuples/lists of arrays and
+    scalars, for which the scalars are neglected)"""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(get_nbytes(v) for v in value)
+
+    return 0
+
+
+class LRUCache:
+    """In-process cache with a memory budget: when adding a value would exceed the budget, the least recently used
+    values are evicted. Numpy arrays are stored as read-only copies so that the cached values cannot be modified by
+    the code that uses them (and do not keep alive larger arrays that they would be views of).
+    """
+
+    def __init__(self, max_bytes: int = cache_max_bytes):
+        """Initialize LRUCache object
+
+        Args:
+            max_bytes (int, optional): memory budget of the cache (in bytes). Defaults to cache_max_bytes.
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._values = OrderedDict()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._values
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def get(self, key: Hashable):
+        """Get a value from the cache, and mark it as the most recently used one
+
+        Args:
+            key (Hashable): key of the value
+
+        Returns:
+            the cached value, or None if the key is not in the cache
+        """
+        if key not in self._values:
+            return None
+        self._values.move_to_end(key)
+
+        return self._values[key]
+
+    def put(self, key: Hashable, value):
+        """Add a value to the cache, evicting the least recently used values if needed to stay within the memory
+        budget. Values that are larger than the whole budget are not cached. The value is copied (cf. freeze), so it
+        can still be modified by the caller.
+
+        Args:
+            key (Hashable): key of the value
+            value: value to cache (numpy array, or tuple/list of numpy arrays and scalars)
+
+        Returns:
+            the cached (read-only) value, or value if it is not cached
+        """
+        nbytes = get_nbytes(value)
+        if nbytes > self.max_bytes:
+            logging.debug(f"Value for {key} is not cached: {nbytes} bytes exceed the cache budget ({self.max_bytes})")
+            return value
+
+        self.pop(key)
+        while self._values and self.nbytes + nbytes > self.max_bytes:
+            evicted_key, evicted_value = self._values.popitem(last=False)
+            self.nbytes -= get_nbytes(evicted_value)
+            logging.debug(f"Evicted {evicted_key} from cache")
+
+        self._values[key] = freeze(value)
+        self.nbytes += nbytes
+
+        return self._values[key]
+
+    def pop(self, key: Hashable):
+        """Remove a value from the cache
+
+        Args:
+            key (Hashable): key of the value
+
+        Returns:
+            the removed value, or None if the key was not in the cache
+        """
+        value = self._values.pop(key, None)
+        if value is not None:
+            self.nbytes -= get_nbytes(value)
+
+        return value
+
+    def clear(self):
+        """Remove all the values from the cache"""
+        self._values.clear()
+        self.nbytes = 0
+
+
+# Cache of the artifacts derived from the tiles (occupancy maps, points indices by class, grid geometry), shared by
+# all the metrics computed in the same process (cf. coclico.intrinsic_all)
+tile_cache = LRUCache()
@@ -1,10 +1,28 @@
+import base64
 import logging
-from typing import List, Tuple
+import time
+import zlib
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
 
 import numpy as np
+import rasterio
 
 from coclico.config import composed_class_separator
 
+# Band tag used to flag the layers of the intrinsic rasters that are empty (class without points in the tile), so that
+# relative metrics do not need to read them
+EMPTY_LAYER_TAG = "EMPTY_LAYER"
+# Band tags used to store a sparse encoding of the layers of the intrinsic rasters that have very few pixels with
+# values (rare classes): sorted flat indices of the pixels with values, and values of these pixels
+# (cf. tag_sparse_layers)
+SPARSE_INDICES_TAG = "SPARSE_INDICES"
+SPARSE_VALUES_TAG = "SPARSE_VALUES"
+# Maximum number of (potentially composed) class keys of a metric, so that the layers a classification code belongs
+# to fit in a 64 bits mask (cf. create_class_bitmask_lut)
+MAX_CLASS_KEYS = 64
+
 
 def split_composed_class(class_key: str) -> List[str]:
     """Split composed class key (separated by COMPOSED_CLASS_SEPARATOR) into its elementary classes.
@@ -18,6 +36,72 @@ def split_composed_class(class_key: str) -> List[str]:
     return class_key.split(composed_class_separator)
 
 
+def create_class_bitmask_lut(class_keys: List[str]) -> np.array:
+    """Create a lookup table from las classification codes (0 to 255) to a bitmask of the class keys that contain
+    this classification code: bit ii of lut[code] is set if code is one of the elementary classes of class_keys[ii].
+    Example: for class_keys ["1", "3_4", "4_5"], lut[1] = 0b001, lut[3] = 0b010, lut[4] = 0b110, lut[5] = 0b100,
+    and lut[code] = 0 for all other codes.
+
+    Args:
+        class_keys (List[str]): ordered list of (potentially composed) class keys
+
+    Raises:
+        ValueError: if there are more than MAX_CLASS_KEYS class keys (that would not fit in the bitmask)
+
+    Returns:
+        np.array: lookup table with 256 values, using the smallest unsigned integer type that can hold the bitmask
+    """
+    nb_keys = len(class_keys)
+    if nb_keys > MAX_CLASS_KEYS:
+        raise ValueError(
+            f"Cannot create a classification bitmask for more than {MAX_CLASS_KEYS} classes (got {nb_keys})"
+        )
+    dtype = next(dt for dt in (np.uint8, np.uint16, np.uint32, np.uint64) if np.iinfo(dt).bits >= nb_keys)
+
+    lut = np.zeros(256, dtype=dtype)
+    for ii, class_key in enumerate(class_keys):
+        for elementary_class in split_composed_class(class_key):
+            lut[int(elementary_class)] |= dtype(1) << dtype(ii)
+
+    return lut
+
+
+def count_points_by_class(classifs_chunks: Iterable[np.array]) -> np.array:
+    """Count the points for each las classification code, accumulating the counts chunk by chunk (so that the points
+    of a chunk can be released as soon as they have been counted)
+
+    Args:
+        classifs_chunks (Iterable[np.array]): classification values of the points, for each chunk of points
+
+    Returns:
+        np.array: number of points for each classification code (256 values)
+    """
+    counts = np.zeros(256, dtype=np.int64)
+    for classifs in classifs_chunks:
+        counts += np.bincount(np.asarray(classifs, dtype=np.uint8), minlength=256)
+
+    return counts
+
+
+def merge_counts_by_class(counts: np.array, class_keys: List[str]) -> np.array:
+    """Merge points counts by las classification code into counts by (potentially composed) class key, using the
+    classification bitmask lookup table (cf. create_class_bitmask_lut): the count of a composed class is the sum of
+    the counts of its elementary classes.
+
+    Args:
+        counts (np.array): number of points for each classification code (as returned by count_points_by_class)
+        class_keys (List[str]): ordered list of (potentially composed) class keys
+
+    Returns:
+        np.array: number of points for each class key (in the class_keys order)
+    """
+    lut = create_class_bitmask_lut(class_keys)
+    # membership[ii, code] is 1 if code is one of the elementary classes of class_keys[ii]
+    membership = (lut[np.newaxis, :] >> np.arange(len(class_keys), dtype=lut.dtype)[:, np.newaxis]) & 1
+
+    return membership.astype(np.int64) @ counts
+
+
 def bounded_affine_function(coordinates_min: Tuple, coordinates_max: Tuple, x_query: np.array) -> np.array:
     """Compute clamped affine function
                max ________ or ______min
@@ -74,3 +158,198 @@ def get_raster_geometry_from_las_bounds(las_bounds: Tuple[float], pixel_size: fl
     logging.debug(f"Raster number of pixels infered from in las file: ({x_pixels}, {y_pixels})")
 
     return (x_min, y_max), (x_pixels, y_pixels)
+
+
+@contextmanager
+def log_duration(stage: str):
+    """Context manager that logs (debug level) the duration of the code executed in its context
+
+    Args:
+        stage (str): name of the stage (used in the log message)
+    """
+    start = time.perf_counter()
+    yield
+    logging.debug(f"{stage}: {time.perf_counter() - start:.3f}s")
+
+
+def tag_empty_layers(dataset: rasterio.io.DatasetWriter, empty_layers: np.array):
+    """Flag the empty layers of a raster that is being written with a band tag (cf. EMPTY_LAYER_TAG)
+
+    Args:
+        dataset (rasterio.io.DatasetWriter): raster opened in write mode
+        empty_layers (np.array): boolean array that is True for each empty layer
+    """
+    for ii, is_empty in enumerate(empty_layers):
+        if is_empty:
+            dataset.update_tags(ii + 1, **{EMPTY_LAYER_TAG: "YES"})
+
+
+def read_empty_layers(raster_file: Path) -> np.array:
+    """Read which layers of a raster have been flagged as empty (cf. tag_empty_layers), without reading the raster
+    values. Layers of rasters written without flags are considered as not empty.
+
+    Args:
+        raster_file (Path): path to the raster file
+
+    Returns:
+        np.array: boolean array that is True for each empty layer
+    """
+    with rasterio.Env():
+        with rasterio.open(raster_file) as src:
+            return np.array([src.tags(ii + 1).get(EMPTY_LAYER_TAG) == "YES" for ii in range(src.count)], dtype=bool)
+
+
+def encode_array(array: np.array) -> str:
+    """Encode a 1d array as a compressed ascii string (zlib + base64), to be stored in a raster tag
+
+    Args:
+        array (np.array): 1d array
+
+    Returns:
+        str: encoded array
+    """
+    return base64.b64encode(zlib.compress(np.ascontiguousarray(array).tobytes())).decode("ascii")
+
+
+def decode_array(encoded: str, dtype) -> np.array:
+    """Decode an array encoded with encode_array
+
+    Args:
+        encoded (str): encoded array
+        dtype: data type of the array
+
+    Returns:
+        np.array: 1d array
+    """
+    return np.frombuffer(zlib.decompress(base64.b64decode(encoded)), dtype=dtype)
+
+
+def tag_sparse_layers(
+    dataset: rasterio.io.DatasetWriter,
+    raster: np.array,
+    empty_value,
+    max_occupancy: float,
+    store_values: bool = False,
+) -> np.array:
+    """Store a sparse encoding of the layers of a raster that is being written in band tags, for the layers in which
+    the proportion of pixels with values (ie. that are not equal to empty_value) is positive and lower than
+    max_occupancy.
+
+    The encoding contains the sorted flat indices of the pixels with values (stored as differences between consecutive
+    indices, cf. SPARSE_INDICES_TAG) and optionally their raw values (cf. SPARSE_VALUES_TAG), so that relative metrics
+    can work on these pixels only. The bands of the encoded layers do not need to be written: they are rebuilt from
+    the tags by read_dense_layers (without values, the pixels of the list are set to 1, eg. for binary maps).
+
+    Args:
+        dataset (rasterio.io.DatasetWriter): raster opened in write mode
+        raster (np.array): 3d raster that is written in dataset
+        empty_value: value of the pixels without values (0 for binary maps, nodata otherwise)
+        max_occupancy (float): maximum proportion of pixels with values for a layer to be encoded (0 to disable)
+        store_values (bool, optional): if True, store the values of the pixels (eg. for height rasters), otherwise
+        only their indices (eg. for binary maps). Defaults to False.
+
+    Returns:
+        np.array: boolean array that is True for each encoded layer
+    """
+    is_sparse = np.zeros(raster.shape[0], dtype=bool)
+    if not max_occupancy:
+        return is_sparse
+    nb_pixels = raster.shape[1] * raster.shape[2]
+    for ii, layer in enumerate(raster):
+        has_value = (layer != empty_value).ravel()
+        count = np.count_nonzero(has_value)
+        if count == 0 or count > max_occupancy * nb_pixels:
+            continue
+        indices = np.flatnonzero(has_value).astype(np.uint32)
+        tags = {SPARSE_INDICES_TAG: encode_array(np.diff(indices, prepend=np.uint32(0)))}
+        if store_values:
+            tags[SPARSE_VALUES_TAG] = encode_array(layer.ravel()[indices])
+        dataset.update_tags(ii + 1, **tags)
+        is_sparse[ii] = True
+
+    return is_sparse
+
+
+def _decode_sparse_layer(tags: Dict[str, str], dtype) -> Tuple[np.array, np.array]:
+    """Decode the sparse encoding of a layer from its band tags (cf. tag_sparse_layers): sorted flat indices of the
+    pixels with values, and raw values of these pixels (None if they are not stored)"""
+    indices = np.cumsum(decode_array(tags[SPARSE_INDICES_TAG], np.uint32), dtype=np.int64)
+    values = decode_array(tags[SPARSE_VALUES_TAG], dtype) if SPARSE_VALUES_TAG in tags else None
+
+    return indices, values
+
+
+def read_sparse_layers(raster_file: Path) -> Dict[int, Tuple[np.array, np.array]]:
+    """Read the sparse encoding of the layers of a raster (cf. tag_sparse_layers), without reading the raster
+    values. The scale/offset metadata of the layers is applied to the values.
+
+    Args:
+        raster_file (Path): path to the raster file
+
+    Returns:
+        Dict[int, Tuple[np.array, np.array]]: for each layer that has a sparse encoding (index starting from 0), sorted
+        flat indices of the pixels with values, and values of these pixels (as float32, None if they are not stored)
+    """
+    sparse_layers = {}
+    with rasterio.Env():
+        with rasterio.open(raster_file) as src:
+            for ii in range(src.count):
+                tags = src.tags(ii + 1)
+                if SPARSE_INDICES_TAG not in tags:
+                    continue
+                indices, values = _decode_sparse_layer(tags, src.dtypes[ii])
+                if values is not None:
+                    values = values.astype(np.float32) * np.float32(src.scales[ii]) + np.float32(src.offsets[ii])
+                sparse_layers[ii] = (indices, values)
+
+    return sparse_layers
+
+
+def read_dense_layers(dataset: rasterio.io.DatasetReader, indexes: List[int] = None, out_dtype=None) -> np.array:
+    """Read the raw values of layers of a raster, including the layers that are only stored as a sparse encoding in
+    band tags (cf. tag_sparse_layers): their bands are not written on disk (read as nodata or 0), and the pixels of
+    their lists are filled from the tags.
+
+    Args:
+        dataset (rasterio.io.DatasetReader): raster opened in read mode
+        indexes (List[int], optional): indexes of the bands to read (starting from 1). Defaults to None (all bands).
+        out_dtype (optional): data type of the output array. Defaults to None (data type of the raster).
+
+    Returns:
+        np.array: 3d array of the raster values
+    """
+    if indexes is None:
+        indexes = list(range(1, dataset.count + 1))
+    if not indexes:
+        return np.empty((0, dataset.height, dataset.width), dtype=out_dtype or dataset.dtypes[0])
+
+    raster = dataset.read(indexes, out_dtype=out_dtype)
+    for layer, index in zip(raster, indexes):
+        tags = dataset.tags(index)
+        if SPARSE_INDICES_TAG in tags:
+            indices, values = _decode_sparse_layer(tags, dataset.dtypes[index - 1])
+            layer.flat[indices] = 1 if values is None else values
+
+    return raster
+
+
+def intersect_sorted_indices(indices_a: np.array, indices_b: np.array) -> Tuple[np.array, np.array]:
+    """Find the common values of two sorted arrays of unique indices (eg. flat pixel indices of sparse layers, cf.
+    read_sparse_layers), with a binary search of each value of the smallest array in the largest one.
+
+    Args:
+        indices_a (np.array): sorted unique indices
+        indices_b (np.array): sorted unique indices
+
+    Returns:
+        Tuple[np.array, np.array]: positions of the common values in indices_a and in indices_b
+    """
+    if len(indices_a) > len(indices_b):
+        positions_b, positions_a = intersect_sorted_indices(indices_b, indices_a)
+        return positions_a, positions_b
+
+    positions_b = np.searchsorted(indices_b, indices_a)
+    is_common = positions_b < len(indices_b)
+    is_common[is_common] = indices_b[positions_b[is_common]] == indices_a[is_common]
+
+    return np.flatnonzero(is_common), positions_b[is_common]
@@ -1,24 +1,60 @@
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 import pandas as pd
 from gpao.job import Job
 from gpao_utils.store import Store
 
 
+def get_reader_options(chunk_size: int = None, laz_threads: int = None) -> str:
+    """Get the options of the intrinsic metrics command lines related to the way las files are read
+
+    Args:
+        chunk_size (int, optional): number of points to read at once (cf. Metric). Defaults to None.
+        laz_threads (int, optional): number of threads to decompress laz files (cf. Metric). Defaults to None.
+
+    Returns:
+        str: command line options (empty string if there is no option to pass)
+    """
+    options = []
+    if chunk_size:
+        options.append(f"--chunk-size {chunk_size}")
+    if laz_threads is not None:
+        options.append(f"--laz-threads {laz_threads}")
+
+    return " ".join(options)
+
+
 class Metric:
     """Base class for metrics"""
 
-    def __init__(self, store: Store, config_file: Path):
+    # Extension of the intrinsic metric result file (one file per tile)
+    intrinsic_output_extension = ""
+
+    def __init__(self, store: Store, config_file: Path, chunk_size: int = None, laz_threads: int = None):
         """Initialize Metric object
 
         Args:
             store (Store): Store object (as defined in gpao_utils) to handle mount points of distant stores on various
             computers
             config_file (str): File of parameters for the metric for each class (cf. config file)
+            chunk_size (int, optional): if set, the intrinsic metric jobs read the las files by chunks of chunk_size
+            points (bounded memory). Defaults to None (read all points at once).
+            laz_threads (int, optional): if set, number of threads used by the intrinsic metric jobs to decompress laz
+            files (0 to use all the CPUs available to the container). Defaults to None (default of the jobs).
         """
         self.store = store
         self.config_file = config_file
+        self.chunk_size = chunk_size
+        self.laz_threads = laz_threads
+
+    def reader_options(self) -> str:
+        """Options of the intrinsic metric command lines related to the way las files are read
+
+        Returns:
+            str: command line options (empty string if there is no option to pass)
+        """
+        return get_reader_options(self.chunk_size, self.laz_threads)
 
     def create_metric_intrinsic_jobs(
         self, name: str, tile_names: List[str], input_path: Path, out_path: Path
@@ -52,6 +88,20 @@ class Metric:
         """
         raise NotImplementedError
 
+    def compute_metric_intrinsic_from_points(self, las_file: Path, points: Tuple, output: Path):
+        """Compute the intrinsic metric for a single point cloud file, from points that have already been read
+        (used to compute all intrinsic metrics with a single read of the point cloud, cf. coclico.intrinsic_all)
+
+        Args:
+            las_file (Path): full path of the input tile
+            points (LasPoints): points of the input tile, as returned by coclico.metrics.occupancy_map.read_las
+            output (Path): path to the output file
+
+        Raises:
+            NotImplementedError: should be implemented in children classes
+        """
+        raise NotImplementedError
+
     def create_metric_relative_to_ref_jobs(
         self, name: str, out_c1: Path, out_ref: Path, output: Path, c1_jobs: List[Job], ref_jobs: List[Job]
     ) -> List[Job]:
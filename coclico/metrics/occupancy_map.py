@@ -1,16 +1,170 @@
 import logging
 from pathlib import Path
-from typing import Tuple
+from typing import Iterable, List, Sequence, Tuple
 
-import laspy
 import numpy as np
 import rasterio
 
+from coclico.config import raster_compression, sparse_layer_max_occupancy
+from coclico.io import (
+    LasPoints,
+    iter_las_points,
+    read_las_header,
+    read_las_points,
+    write_raster,
+)
+from coclico.metrics.cache import LRUCache, tile_cache
 from coclico.metrics.commons import (
+    count_points_by_class,
+    create_class_bitmask_lut,
     get_raster_geometry_from_las_bounds,
-    split_composed_class,
+    merge_counts_by_class,
 )
 
+# Dimensions of the las files that are needed to create occupancy maps
+OCCUPANCY_DIMENSIONS = ("X", "Y", "classification")
+
+
+def compute_flat_pixel_indices(
+    xs: np.array,
+    ys: np.array,
+    pixel_size: float,
+    x_min: float,
+    y_max: float,
+    nb_pixels: Tuple[int, int] = (1000, 1000),
+) -> np.array:
+    """Compute the index of the pixel in which each point falls, in a flattened (row-major) 2d map.
+
+    Points on the right/bottom border of the map are assigned to the last column/row.
+
+    Args:
+        xs (np.array): vector of x coordinates of all points
+        ys (np.array): vector of y coordinates of all points
+        pixel_size (float): pixel size (in meters) of the output map
+        x_min (float): x coordinate (in meters) of the pixel center of the upper left corner of the map
+        y_max (float): y coordinate (in meters) of the pixel center of the upper left corner of the map
+        nb_pixels (float, optional): number of pixels on each axis in format (x, y). Defaults to (1000, 1000).
+
+    Returns:
+        np.array: vector of flat pixel indices (row * nb_pixels[0] + column) for all points
+    """
+    # conversion to int truncates toward zero, like int() on a single value
+    grid_x = ((xs - (x_min - pixel_size / 2)) / pixel_size).astype(np.int64)  # x_min is left pixel center
+    grid_y = (((y_max + pixel_size / 2) - ys) / pixel_size).astype(np.int64)  # y_max is upper pixel center
+    np.minimum(grid_x, nb_pixels[0] - 1, out=grid_x)
+    np.minimum(grid_y, nb_pixels[1] - 1, out=grid_y)
+
+    return grid_y * nb_pixels[0] + grid_x
+
+
+def get_integer_grid_geometry(
+    scales: np.array, offsets: np.array, pixel_size: float, x_min: float, y_max: float
+) -> Tuple[int, int, int]:
+    """Express the raster geometry in the units of the raw integer las coordinates (X, Y), so that pixel indices can
+    be computed with integer arithmetic only (cf. compute_flat_pixel_indices_from_records).
+
+    This is possible only if the pixels borders fall on the grid of the integer coordinates (eg. pixel size of 0.5m
+    with a las scale of 0.01m).
+
+    Args:
+        scales (np.array): las scales (for x, y, z)
+        offsets (np.array): las offsets (for x, y, z)
+        pixel_size (float): pixel size (in meters) of the output map
+        x_min (float): x coordinate (in meters) of the pixel center of the upper left corner of the map
+        y_max (float): y coordinate (in meters) of the pixel center of the upper left corner of the map
+
+    Returns:
+        Tuple[int, int, int]: (left, top, pixel_size) of the map in las integer units, or None if the map geometry
+        cannot be expressed exactly in las integer units
+    """
+
+    def to_integer_units(value: float, scale: float) -> int:
+        units = value / scale
+        rounded_units = int(np.round(units))
+        if abs(units - rounded_units) > 1e-6 or abs(rounded_units) >= 2**30:
+            return None
+        return rounded_units
+
+    if scales[0] != scales[1]:
+        return None
+
+    left = to_integer_units(x_min - pixel_size / 2 - offsets[0], scales[0])
+    top = to_integer_units(y_max + pixel_size / 2 - offsets[1], scales[1])
+    pixel_units = to_integer_units(pixel_size, scales[0])
+    if left is None or top is None or not pixel_units:
+        return None
+
+    return left, top, pixel_units
+
+
+def compute_flat_pixel_indices_from_records(
+    X: np.array, Y: np.array, left: int, top: int, pixel_units: int, nb_pixels: Tuple[int, int] = (1000, 1000)
+) -> np.array:
+    """Compute the index of the pixel in which each point falls, in a flattened (row-major) 2d map, from the raw
+    integer las coordinates (without converting them to scaled float coordinates).
+
+    Points on the right/bottom border of the map are assigned to the last column/row.
+
+    Args:
+        X (np.array): vector of raw integer x coordinates (as stored in the las file) of all points
+        Y (np.array): vector of raw integer y coordinates (as stored in the las file) of all points
+        left (int): x coordinate of the left border of the map (in las integer units)
+        top (int): y coordinate of the top border of the map (in las integer units)
+        pixel_units (int): pixel size (in las integer units)
+        nb_pixels (float, optional): number of pixels on each axis in format (x, y). Defaults to (1000, 1000).
+
+    Returns:
+        np.array: vector of flat pixel indices (row * nb_pixels[0] + column) for all points
+    """
+    index_dtype = np.int32 if nb_pixels[0] * nb_pixels[1] < 2**31 else np.int64
+    grid_x = np.subtract(X, left, dtype=index_dtype)
+    np.floor_divide(grid_x, pixel_units, out=grid_x)
+    np.clip(grid_x, 0, nb_pixels[0] - 1, out=grid_x)
+    grid_y = np.subtract(top, Y, dtype=index_dtype)
+    np.floor_divide(grid_y, pixel_units, out=grid_y)
+    np.clip(grid_y, 0, nb_pixels[1] - 1, out=grid_y)
+
+    grid_y *= nb_pixels[0]
+    grid_y += grid_x
+
+    return grid_y
+
+
+def compute_points_flat_pixel_indices(
+    points: LasPoints,
+    selection: np.array,
+    pixel_size: float,
+    x_min: float,
+    y_max: float,
+    nb_pixels: Tuple[int, int],
+) -> np.array:
+    """Compute the index of the pixel in which each selected point falls, in a flattened (row-major) 2d map.
+    Integer arithmetic is used on the raw las coordinates when the map geometry allows it (cf.
+    get_integer_grid_geometry), otherwise the coordinates are scaled and compute_flat_pixel_indices is used.
+
+    Args:
+        points (LasPoints): points (only X and Y are used)
+        selection (np.array): boolean mask of the points for which to compute the index
+        pixel_size (float): pixel size (in meters) of the output map
+        x_min (float): x coordinate (in meters) of the pixel center of the upper left corner of the map
+        y_max (float): y coordinate (in meters) of the pixel center of the upper left corner of the map
+        nb_pixels (Tuple[int, int]): number of pixels on each axis in format (x, y)
+
+    Returns:
+        np.array: vector of flat pixel indices for the selected points
+    """
+    X, Y = points.X[selection], points.Y[selection]
+    integer_geometry = None
+    if np.issubdtype(X.dtype, np.integer):
+        integer_geometry = get_integer_grid_geometry(points.scales, points.offsets, pixel_size, x_min, y_max)
+
+    if integer_geometry is None:
+        xs = X * points.scales[0] + points.offsets[0]
+        ys = Y * points.scales[1] + points.offsets[1]
+        return compute_flat_pixel_indices(xs, ys, pixel_size, x_min, y_max, nb_pixels)
+
+    return compute_flat_pixel_indices_from_records(X, Y, *integer_geometry, nb_pixels)
+
 
 def _create_2d_occupancy_array(
     xs: np.array,
@@ -36,58 +190,336 @@ def _create_2d_occupancy_array(
     """
     # numpy array is filled with (y, x) instead of (x, y)
     grid = np.zeros((nb_pixels[1], nb_pixels[0]), dtype=bool)
-
-    for x, y in zip(xs, ys):
-        grid_x = min(int((x - (x_min - pixel_size / 2)) / pixel_size), nb_pixels[0] - 1)  # x_min is left pixel center
-        grid_y = min(int(((y_max + pixel_size / 2) - y) / pixel_size), nb_pixels[1] - 1)  # y_max is upper pixel center
-        grid[grid_y, grid_x] = True
+    flat_indices = compute_flat_pixel_indices(xs, ys, pixel_size, x_min, y_max, nb_pixels)
+    grid.ravel()[flat_indices] = True
 
     return grid
 
 
-def read_las(las_file: Path):
-    with laspy.open(las_file) as f:
-        las = f.read()
+def read_las(las_file: Path, dimensions: Sequence[str] = OCCUPANCY_DIMENSIONS) -> LasPoints:
+    """Read the points of a las file, decoding only the dimensions that are needed to create occupancy maps
+    (X, Y and classification by default)
 
-    xs, ys = las.x, las.y
-    classifs = las.classification
-    crs = las.header.parse_crs()
+    Args:
+        las_file (Path): path to the las file to read
+        dimensions (Sequence[str], optional): dimensions to decode. Defaults to OCCUPANCY_DIMENSIONS.
 
-    return xs, ys, classifs, crs
+    Returns:
+        LasPoints: points of the las file
+    """
+    return read_las_points(las_file, dimensions)
 
 
-def create_occupancy_map_array(xs: np.array, ys: np.array, classifs: np.array, pixel_size: float, class_weights: dict):
-    las_bounds = (np.min(xs), np.min(ys), np.max(xs), np.max(ys))
+def _update_occupancy_layers(
+    flat_maps: np.array,
+    points: LasPoints,
+    class_lut: np.array,
+    pixel_size: float,
+    x_min: float,
+    y_max: float,
+    nb_pixels: Tuple[int, int],
+):
+    """Set (inplace) the pixels of all the layers the class of each point belongs to (composed classes included)
+    in the flat binary maps flat_maps (one row per layer). The pixel indices are computed once for all the layers,
+    then each layer is set with a fancy assignment (np.bitwise_or.at is unbuffered and slow on numpy < 1.25)."""
+    points_masks = class_lut[points.classification]
+    has_layer = points_masks != 0
+    flat_indices = compute_points_flat_pixel_indices(points, has_layer, pixel_size, x_min, y_max, nb_pixels)
+    points_masks = points_masks[has_layer]
+    for ii, flat_map in enumerate(flat_maps):
+        in_layer = ((points_masks >> points_masks.dtype.type(ii)) & 1).astype(bool)
+        flat_map[flat_indices[in_layer]] = 1
 
-    top_left, nb_pixels = get_raster_geometry_from_las_bounds(las_bounds, pixel_size)
-    x_min, y_max = top_left
 
-    def create_binary_map_from_class(class_key):
-        splitted_class_key = split_composed_class(class_key)
-        splitted_class_key_int = [int(ii) for ii in splitted_class_key]
-
-        map = _create_2d_occupancy_array(
-            xs[np.isin(classifs, splitted_class_key_int)],
-            ys[np.isin(classifs, splitted_class_key_int)],
-            pixel_size,
-            x_min,
-            y_max,
-            nb_pixels,
-        )
+def _create_occupancy_map_array_on_grid(
+    chunks: Iterable[LasPoints],
+    class_keys: List[str],
+    pixel_size: float,
+    x_min: float,
+    y_max: float,
+    nb_pixels: Tuple[int, int],
+) -> np.array:
+    """Create the 2d occupancy maps for each class key on a known raster grid, with a single pass on the points:
+    the layers of each point are found with the classification bitmask lookup table (cf. create_class_bitmask_lut)
+    """
+    class_lut = create_class_bitmask_lut(class_keys)
+    flat_maps = np.zeros((len(class_keys), nb_pixels[0] * nb_pixels[1]), dtype=np.uint8)
+    for points in chunks:
+        _update_occupancy_layers(flat_maps, points, class_lut, pixel_size, x_min, y_max, nb_pixels)
+
+    # numpy array is filled with (y, x) instead of (x, y)
+    return flat_maps.reshape((len(class_keys), nb_pixels[1], nb_pixels[0]))
 
-        return map
+
+def create_occupancy_map_array_from_chunks(
+    chunks: Iterable[LasPoints],
+    las_bounds: Tuple[float, float, float, float],
+    pixel_size: float,
+    class_weights: dict,
+):
+    """Create the 2d occupancy maps for each class that is in class_weights keys from points that are read chunk
+    by chunk: each chunk is added to the maps then released, so that the peak memory only depends on the raster
+    size and on the chunk size.
+
+    As the raster geometry has to be known before reading the points, it is computed from las_bounds (usually
+    the bounds stored in the las header, cf. coclico.io.read_las_header).
+
+    Args:
+        chunks (Iterable[LasPoints]): points of each chunk (X, Y and classification are used)
+        las_bounds (Tuple[float, float, float, float]): (x_min, y_min, x_max, y_max) of the points
+        pixel_size (float): size of the output raster pixels
+        class_weights (dict): class weights dict (to know for which classes to generate the binary map)
+
+    Returns:
+        Tuple[np.array, float, float]: (binary_maps, x_min, y_max) as in create_occupancy_map_array
+    """
+    top_left, nb_pixels = get_raster_geometry_from_las_bounds(las_bounds, pixel_size)
+    x_min, y_max = top_left
 
     # get results for classes that are in weights dictionary (merged if necessary) in a 3d array
     # which represents a raster with 1 layer per class
     # keys are sorted to make sure that raster layers can be retrieved in the same order
-    binary_maps = np.array([create_binary_map_from_class(k) for k in sorted(class_weights.keys())], dtype=np.uint8)
+    class_keys = sorted(class_weights.keys())
+    binary_maps = _create_occupancy_map_array_on_grid(chunks, class_keys, pixel_size, x_min, y_max, nb_pixels)
 
     logging.debug(f"Creating binary maps with shape {binary_maps.shape}")
-    logging.debug(f"The binary maps order is {sorted(class_weights.keys())}")
+    logging.debug(f"The binary maps order is {class_keys}")
     return binary_maps, x_min, y_max
 
 
-def create_occupancy_map(las_file, class_weights, output_tif, pixel_size):
+def get_points_bounds(points: LasPoints) -> Tuple[float, float, float, float]:
+    """Get the (x_min, y_min, x_max, y_max) bounds of points, computed on the raw las coordinates"""
+    return (
+        np.min(points.X) * points.scales[0] + points.offsets[0],
+        np.min(points.Y) * points.scales[1] + points.offsets[1],
+        np.max(points.X) * points.scales[0] + points.offsets[0],
+        np.max(points.Y) * points.scales[1] + points.offsets[1],
+    )
+
+
+def create_occupancy_map_array_from_points(points: LasPoints, pixel_size: float, class_weights: dict):
+    """Create the 2d occupancy maps for each class that is in class_weights keys from points that have already been
+    read. The raster geometry is computed from the points bounds.
+
+    Args:
+        points (LasPoints): points (X, Y and classification are used)
+        pixel_size (float): size of the output raster pixels
+        class_weights (dict): class weights dict (to know for which classes to generate the binary map)
+
+    Returns:
+        Tuple[np.array, float, float]: (binary_maps, x_min, y_max) where x_min, y_max are the coordinates of the
+        center of the top left pixel
+    """
+    return create_occupancy_map_array_from_chunks([points], get_points_bounds(points), pixel_size, class_weights)
+
+
+def get_grid_geometry(
+    las_file: Path, points: LasPoints, pixel_size: float, cache: LRUCache = tile_cache
+) -> Tuple[Tuple[float, float], Tuple[int, int]]:
+    """Get the raster geometry of a tile for a given pixel size (computed from the points bounds as in
+    create_occupancy_map_array_from_points), using the tiles cache to compute it only once per tile.
+
+    Args:
+        las_file (Path): path to the las file from which points have been read (used as cache key)
+        points (LasPoints): points of the las file (X and Y are used)
+        pixel_size (float): size of the raster pixels
+        cache (LRUCache, optional): cache to use. Defaults to tile_cache.
+
+    Returns:
+        Tuple[Tuple[float, float], Tuple[int, int]]: coordinates of the top-left pixel center, and number of pixels
+        on each axis (as in get_raster_geometry_from_las_bounds)
+    """
+    key = ("grid_geometry", str(las_file), pixel_size)
+    geometry = cache.get(key)
+    if geometry is None:
+        geometry = get_raster_geometry_from_las_bounds(get_points_bounds(points), pixel_size)
+        geometry = cache.put(key, geometry)
+
+    return geometry
+
+
+def get_class_points_indices(
+    las_file: Path, points: LasPoints, class_key: str, cache: LRUCache = tile_cache
+) -> np.array:
+    """Get the indices of the points that belong to a (potentially composed) class, using the tiles cache to compute
+    them only once per tile and class key.
+
+    Args:
+        las_file (Path): path to the las file from which points have been read (used as cache key)
+        points (LasPoints): points of the las file (classification is used)
+        class_key (str): class key (eg. "2" or "3_4_5")
+        cache (LRUCache, optional): cache to use. Defaults to tile_cache.
+
+    Returns:
+        np.array: sorted indices of the points of the class
+    """
+    key = ("points_indices", str(las_file), class_key)
+    indices = cache.get(key)
+    if indices is None:
+        class_lut = create_class_bitmask_lut([class_key])
+        indices = np.flatnonzero(class_lut[points.classification])
+        indices = cache.put(key, indices)
+
+    return indices
+
+
+def get_empty_classes(las_file: Path, points: LasPoints, class_keys: List[str], cache: LRUCache = tile_cache):
+    """Find the (potentially composed) classes that have no points in a tile, from the histogram of the
+    classification codes of the tile (computed only once per tile, using the tiles cache).
+
+    Args:
+        las_file (Path): path to the las file from which points have been read (used as cache key)
+        points (LasPoints): points of the las file (classification is used)
+        class_keys (List[str]): ordered list of class keys
+        cache (LRUCache, optional): cache to use. Defaults to tile_cache.
+
+    Returns:
+        np.array: boolean array that is True for each class key without points (in the class_keys order)
+    """
+    key = ("class_counts", str(las_file))
+    counts = cache.get(key)
+    if counts is None:
+        counts = count_points_by_class([points.classification])
+        counts = cache.put(key, counts)
+
+    return merge_counts_by_class(counts, class_keys) == 0
+
+
+def get_occupancy_map_array(
+    las_file: Path, points: LasPoints, pixel_size: float, class_weights: dict, cache: LRUCache = tile_cache
+):
+    """Get the 2d occupancy maps for each class that is in class_weights keys (same result as
+    create_occupancy_map_array_from_points), using the tiles cache so that the maps of a tile are computed only once
+    per class key, pixel size and grid origin, even when several metrics use them.
+
+    Only the maps that are missing from the cache are computed (in a single pass on the points).
+
+    Args:
+        las_file (Path): path to the las file from which points have been read (used as cache key)
+        points (LasPoints): points of the las file (X, Y and classification are used)
+        pixel_size (float): size of the output raster pixels
+        class_weights (dict): class weights dict (to know for which classes to generate the binary map)
+        cache (LRUCache, optional): cache to use. Defaults to tile_cache.
+
+    Returns:
+        Tuple[np.array, float, float]: (binary_maps, x_min, y_max) where x_min, y_max are the coordinates of the
+        center of the top left pixel
+    """
+    (x_min, y_max), nb_pixels = get_grid_geometry(las_file, points, pixel_size, cache)
+    class_keys = sorted(class_weights.keys())
+
+    keys = {
+        class_key: ("occupancy_map", str(las_file), class_key, pixel_size, (x_min, y_max)) for class_key in class_keys
+    }
+    maps = {class_key: cache.get(key) for class_key, key in keys.items()}
+    missing_keys = [class_key for class_key, binary_map in maps.items() if binary_map is None]
+    if missing_keys:
+        logging.debug(f"Compute binary maps for {missing_keys} (not in cache)")
+        missing_maps = _create_occupancy_map_array_on_grid([points], missing_keys, pixel_size, x_min, y_max, nb_pixels)
+        for class_key, binary_map in zip(missing_keys, missing_maps):
+            # each map is copied in the cache, so that it does not keep the whole missing_maps array alive
+            maps[class_key] = cache.put(keys[class_key], binary_map)
+
+    binary_maps = np.stack([maps[class_key] for class_key in class_keys])
+
+    logging.debug(f"Creating binary maps with shape {binary_maps.shape}")
+    logging.debug(f"The binary maps order is {class_keys}")
+    return binary_maps, x_min, y_max
+
+
+def create_occupancy_map_array(xs: np.array, ys: np.array, classifs: np.array, pixel_size: float, class_weights: dict):
+    # points with coordinates that are already scaled (scale 1, offset 0): pixel indices are computed in float
+    points = LasPoints(xs, ys, None, np.asarray(classifs), np.ones(3), np.zeros(3), None)
+
+    return create_occupancy_map_array_from_points(points, pixel_size, class_weights)
+
+
+def create_occupancy_map_array_from_las(las_file: Path, pixel_size: float, class_weights: dict, chunk_size: int):
+    """Create the 2d occupancy maps for each class that is in class_weights keys, reading las_file chunk by chunk
+    (cf. create_occupancy_map_array_from_chunks).
+
+    Args:
+        las_file (Path): path to the las file on which to generate occupancy map
+        pixel_size (float): size of the output raster pixels
+        class_weights (dict): class weights dict (to know for which classes to generate the binary map)
+        chunk_size (int): maximum number of points to read at once
+
+    Returns:
+        Tuple[np.array, float, float, object]: (binary_maps, x_min, y_max, crs)
+    """
+    las_bounds, crs = read_las_header(las_file)
+    chunks = iter_las_points(las_file, chunk_size, OCCUPANCY_DIMENSIONS)
+    binary_maps, x_min, y_max = create_occupancy_map_array_from_chunks(chunks, las_bounds, pixel_size, class_weights)
+
+    return binary_maps, x_min, y_max, crs
+
+
+def write_occupancy_map(
+    binary_maps: np.array,
+    x_min: float,
+    y_max: float,
+    crs,
+    output_tif: Path,
+    pixel_size: float,
+    empty_layers: np.array = None,
+    compress: str = raster_compression["mpla0"],
+    sparse_max_occupancy: float = sparse_layer_max_occupancy,
+):
+    """Save 2d occupancy maps (as returned by create_occupancy_map_array) in a single output_tif file with one layer
+    per class, stored on 1 bit per pixel.
+
+    The file is tiled with one band after the other, and the empty layers are flagged (cf. commons.tag_empty_layers)
+    and not written on disk (sparse file, read as zeros), cf. coclico.io.write_raster. The pixels of the layers
+    with very few pixels set are also stored as lists of pixel indices (cf. commons.tag_sparse_layers).
+
+    Args:
+        binary_maps (np.array): 3d array of binary maps (one layer per class)
+        x_min (float): x coordinate of the center of the top left pixel
+        y_max (float): y coordinate of the center of the top left pixel
+        crs: crs of the output raster (as read in the las header)
+        output_tif (Path): path to output
+        pixel_size (float): size of the output raster pixels
+        empty_layers (np.array, optional): boolean array that is True for each empty layer. Defaults to None
+        (computed from binary_maps).
+        compress (str, optional): compression of the output file (None for no compression).
+        Defaults to raster_compression["mpla0"].
+        sparse_max_occupancy (float, optional): maximum proportion of pixels set for a layer to be also stored as a
+        list of pixels (0 to disable). Defaults to sparse_layer_max_occupancy.
+    """
+    write_raster(
+        binary_maps.astype(rasterio.uint8, copy=False),
+        output_tif,
+        transform=rasterio.transform.from_origin(
+            x_min - pixel_size / 2, y_max + pixel_size / 2, pixel_size, pixel_size
+        ),
+        crs=crs,
+        compress=compress,
+        nbits=1,
+        empty_layers=empty_layers,
+        sparse_max_occupancy=sparse_max_occupancy,
+    )
+
+
+def create_occupancy_map_from_points(
+    las_file: Path, points: LasPoints, class_weights: dict, output_tif: Path, pixel_size: float
+):
+    """Create 2d occupancy map for each class that is in class_weights keys from points that have already been read
+    (cf. get_occupancy_map_array), and save result in a single output_tif file with one layer per class
+    (the classes are sorted alphabetically).
+
+    Args:
+        las_file (Path): path to the las file from which points have been read (used as cache key)
+        points (LasPoints): points as returned by read_las
+        class_weights (Dict): class weights dict (to know for which classes to generate the binary map)
+        output_tif (Path): path to output
+        pixel_size (float): size of the output raster pixels
+    """
+    binary_maps, x_min, y_max = get_occupancy_map_array(las_file, points, pixel_size, class_weights)
+    empty_layers = get_empty_classes(las_file, points, sorted(class_weights.keys()))
+    write_occupancy_map(binary_maps, x_min, y_max, points.crs, output_tif, pixel_size, empty_layers)
+
+
+def create_occupancy_map(las_file, class_weights, output_tif, pixel_size, chunk_size=None):
     """Create 2d occupancy map for each class that is in class_weights keys, and save result in a single output_tif
     file with one layer per class (the classes are sorted alphabetically).
 
@@ -96,25 +528,13 @@ def create_occupancy_map(las_file, class_weights, output_tif, pixel_size):
         class_weights (Dict): class weights dict (to know for which classes to generate the binary map)
         output_tif (Path): path to output
         pixel_size (float): size of the output raster pixels
+        chunk_size (int, optional): if set, read the las file by chunks of chunk_size points (bounded memory) and
+        use the las header bounds for the raster geometry. Defaults to None (read all points at once).
     """
-    xs, ys, classifs, crs = read_las(las_file)
-
-    binary_maps, x_min, y_max = create_occupancy_map_array(xs, ys, classifs, pixel_size, class_weights)
-
-    output_tif.parent.mkdir(parents=True, exist_ok=True)
-
-    with rasterio.Env():
-        with rasterio.open(
-            output_tif,
-            "w",
-            driver="GTiff",
-            height=binary_maps.shape[1],
-            width=binary_maps.shape[2],
-            count=binary_maps.shape[0],
-            dtype=rasterio.uint8,
-            crs=crs,
-            transform=rasterio.transform.from_origin(
-                x_min - pixel_size / 2, y_max + pixel_size / 2, pixel_size, pixel_size
-            ),
-        ) as out_file:
-            out_file.write(binary_maps.astype(rasterio.uint8))
+    if chunk_size:
+        binary_maps, x_min, y_max, crs = create_occupancy_map_array_from_las(
+            las_file, pixel_size, class_weights, chunk_size
+        )
+        write_occupancy_map(binary_maps, x_min, y_max, crs, output_tif, pixel_size)
+    else:
+        create_occupancy_map_from_points(las_file, read_las(las_file), class_weights, output_tif, pixel_size)
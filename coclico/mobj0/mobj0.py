@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 import numpy as np
 import pandas as pd
@@ -19,6 +19,7 @@ class MOBJ0(Metric):
     """
 
     metric_name = "mobj0"
+    intrinsic_output_extension = ".json"
     pixel_size = 0.5  # Pixel size for occupancy map
     kernel = 3  # parameter for morphological operations on rasters
     tolerance_shp = 0.05  # parameter for simplification on geometries of the shapefile
@@ -33,15 +34,24 @@ docker run -t --rm --userns=host --shm-size=2gb
 ghcr.io/ignf/coclico:{__version__}
 python -m coclico.mobj0.mobj0_intrinsic \
 --input-file /input \
---output-geojson /output/{input.stem}.json \
+--output-geojson /output/{input.stem}{self.intrinsic_output_extension} \
 --config-file /config/{self.config_file.name} \
 --pixel-size {self.pixel_size} \
 --kernel {self.kernel} \
---tolerance-shp {self.tolerance_shp}
+--tolerance-shp {self.tolerance_shp} \
+{self.reader_options()}
 """
         job = Job(job_name, command, tags=["docker"])
         return job
 
+    def compute_metric_intrinsic_from_points(self, las_file: Path, points: Tuple, output: Path):
+        # imported here to avoid circular imports
+        from coclico.mobj0 import mobj0_intrinsic
+
+        mobj0_intrinsic.compute_metric_intrinsic_from_points(
+            las_file, points, self.config_file, output, self.pixel_size, self.kernel, self.tolerance_shp
+        )
+
     def create_metric_relative_to_ref_jobs(
         self, name: str, out_c1: Path, out_ref: Path, output: Path, c1_jobs: List[Job], ref_jobs: List[Job]
     ) -> Job:
@@ -12,21 +12,53 @@ from rasterio.features import shapes as rasterio_shapes
 from shapely.geometry import shape as shapely_shape
 
 import coclico.io
-from coclico.metrics.occupancy_map import create_occupancy_map_array, read_las
+from coclico.config import laz_threads
+from coclico.metrics.occupancy_map import (
+    create_occupancy_map_array_from_las,
+    get_empty_classes,
+    get_occupancy_map_array,
+    read_las,
+)
 from coclico.mobj0.mobj0 import MOBJ0
 
 gdal.UseExceptions()
 
 
-def create_objects_array(las_file: Path, pixel_size: float, class_weights: dict, kernel: int):
-    xs, ys, classifs, crs = read_las(las_file)
+def create_objects_array(las_file: Path, pixel_size: float, class_weights: dict, kernel: int, chunk_size: int = None):
+    if chunk_size:
+        binary_maps, x_min, y_max, crs = create_occupancy_map_array_from_las(
+            las_file, pixel_size, class_weights, chunk_size
+        )
+        return create_objects_array_from_binary_maps(binary_maps, class_weights, kernel), crs, x_min, y_max
+
+    return create_objects_array_from_points(las_file, read_las(las_file), pixel_size, class_weights, kernel)
+
+
+def create_objects_array_from_points(
+    las_file: Path, points: coclico.io.LasPoints, pixel_size: float, class_weights: dict, kernel: int
+):
+    binary_maps, x_min, y_max = get_occupancy_map_array(las_file, points, pixel_size, class_weights)
+    empty_layers = get_empty_classes(las_file, points, sorted(class_weights.keys()))
+
+    return (
+        create_objects_array_from_binary_maps(binary_maps, class_weights, kernel, empty_layers),
+        points.crs,
+        x_min,
+        y_max,
+    )
+
 
-    binary_maps, x_min, y_max = create_occupancy_map_array(xs, ys, classifs, pixel_size, class_weights)
+def create_objects_array_from_binary_maps(
+    binary_maps: np.ndarray, class_weights: dict, kernel: int, empty_layers: np.ndarray = None
+):
+    # layers of classes without points stay empty: no morphology transformation is needed
+    if empty_layers is None:
+        empty_layers = ~np.any(binary_maps, axis=(1, 2))
     object_maps = np.zeros_like(binary_maps)
-    for index in range(len(class_weights)):
+    for index in np.flatnonzero(~empty_layers):
         object_maps[index, :, :] = operate_morphology_transformations(binary_maps[index, :, :], kernel)
 
-    return object_maps, crs, x_min, y_max
+    return object_maps
 
 
 def vectorize_occupancy_map(binary_maps: np.ndarray, crs: str, x_min: float, y_max: float, pixel_size: float):
@@ -34,15 +66,18 @@ def vectorize_occupancy_map(binary_maps: np.ndarray, crs: str, x_min: float, y_m
     gdf_list = []
 
     for ii, map_layer in enumerate(binary_maps):
-        shapes_layer = rasterio_shapes(
-            map_layer,
-            connectivity=4,
-            transform=rasterio.transform.from_origin(
-                x_min - pixel_size / 2, y_max + pixel_size / 2, pixel_size, pixel_size
-            ),
-        )
-
-        geometries = [shapely_shape(shapedict) for shapedict, value in shapes_layer if value != 0]
+        if not np.any(map_layer):
+            # no objects in the layer: skip the polygonization
+            geometries = []
+        else:
+            shapes_layer = rasterio_shapes(
+                map_layer,
+                connectivity=4,
+                transform=rasterio.transform.from_origin(
+                    x_min - pixel_size / 2, y_max + pixel_size / 2, pixel_size, pixel_size
+                ),
+            )
+            geometries = [shapely_shape(shapedict) for shapedict, value in shapes_layer if value != 0]
         nb_geometries = len(geometries)
         gdf_list.append(
             gpd.GeoDataFrame(
@@ -73,6 +108,7 @@ def compute_metric_intrinsic(
     pixel_size: float = 0.5,
     kernel: int = 3,
     tolerance_shp: float = 0.05,
+    chunk_size: int = None,
 ):
     """
     Create a shapefile with geometries for all objects in each class contained in the config file:
@@ -88,11 +124,62 @@ def compute_metric_intrinsic(
         pixel_size (float, optional): size of the occupancy map rasters pixels. Defaults to 0.5.
         kernel (int, optional): size of the convolution matrix for morphological operations. Defaults to 3.
         tolerance_shp (float, optional): parameter for simplification of the shapefile geometries. Defaults to 0.05
+        chunk_size (int, optional): if set, read the las file by chunks of chunk_size points (bounded memory).
+        Defaults to None (read all points at once).
+    """
+    if chunk_size:
+        config_dict = coclico.io.read_config_file(config_file)
+        class_weights = config_dict[MOBJ0.metric_name]["weights"]
+        obj_array, crs, x_min, y_max = create_objects_array(las_file, pixel_size, class_weights, kernel, chunk_size)
+        save_objects(obj_array, crs, x_min, y_max, output_geojson, pixel_size, tolerance_shp)
+    else:
+        points = read_las(las_file)
+        compute_metric_intrinsic_from_points(
+            las_file, points, config_file, output_geojson, pixel_size, kernel, tolerance_shp
+        )
+
+
+def compute_metric_intrinsic_from_points(
+    las_file: Path,
+    points: coclico.io.LasPoints,
+    config_file: Path,
+    output_geojson: Path,
+    pixel_size: float = 0.5,
+    kernel: int = 3,
+    tolerance_shp: float = 0.05,
+):
+    """Compute mobj0 intrinsic metric (cf. compute_metric_intrinsic) from points that have already been read.
+    The occupancy maps are shared with the other metrics computed on the same tile through the tiles cache
+    (cf. occupancy_map.get_occupancy_map_array).
+
+    Args:
+        las_file (Path): path to the las file from which points have been read
+        points (LasPoints): points as returned by occupancy_map.read_las
+        config_file (Path): path to the config file (to know for which classes to generate the rasters)
+        output_geojson (Path): path to output shapefile with geometries of objects
+        pixel_size (float, optional): size of the occupancy map rasters pixels. Defaults to 0.5.
+        kernel (int, optional): size of the convolution matrix for morphological operations. Defaults to 3.
+        tolerance_shp (float, optional): parameter for simplification of the shapefile geometries. Defaults to 0.05
     """
     config_dict = coclico.io.read_config_file(config_file)
     class_weights = config_dict[MOBJ0.metric_name]["weights"]
+    obj_array, crs, x_min, y_max = create_objects_array_from_points(
+        las_file, points, pixel_size, class_weights, kernel
+    )
+    save_objects(obj_array, crs, x_min, y_max, output_geojson, pixel_size, tolerance_shp)
+
+
+def save_objects(
+    obj_array: np.ndarray,
+    crs: str,
+    x_min: float,
+    y_max: float,
+    output_geojson: Path,
+    pixel_size: float,
+    tolerance_shp: float,
+):
+    """Vectorize the objects maps (as returned by create_objects_array) and save them in output_geojson"""
     output_geojson.parent.mkdir(parents=True, exist_ok=True)
-    obj_array, crs, x_min, y_max = create_objects_array(las_file, pixel_size, class_weights, kernel)
     polygons_gdf = vectorize_occupancy_map(obj_array, crs, x_min, y_max, pixel_size)
     polygons_gdf.simplify(tolerance=tolerance_shp, preserve_topology=False)
     polygons_gdf.to_file(output_geojson)
@@ -114,14 +201,28 @@ def parse_args():
     )
     parser.add_argument("-k", "--kernel", type=int, required=True, help="Path to the output geojson")
     parser.add_argument("-t", "--tolerance-shp", type=float, required=True, help="Path to the output geojson")
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        help="If set, read the LAS file by chunks of this number of points (bounded memory)",
+    )
+    parser.add_argument(
+        "--laz-threads",
+        type=int,
+        default=laz_threads,
+        help="Number of threads used to decompress LAZ files (0 to use all the CPUs available to the container)",
+    )
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = parse_args()
     logging.basicConfig(format="%(message)s", level=logging.DEBUG)
+    coclico.io.configure_laz_decompression(args.laz_threads)
     compute_metric_intrinsic(
         las_file=Path(args.input_file),
         config_file=args.config_file,
         output_geojson=Path(args.output_geojson),
+        chunk_size=args.chunk_size,
     )
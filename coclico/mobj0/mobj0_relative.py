@@ -53,6 +53,12 @@ def check_paired_objects(c1_file: Path, ref_file: Path, classes: List) -> Tuple[
         # Count objects in reference
         ref_object_count[class_key] = nb_ref
 
+        if nb_c1 == 0 or nb_ref == 0:
+            # no possible pairing if the class is empty in c1 or in ref
+            paired_count[class_key] = 0
+            not_paired_count[class_key] = nb_c1 + nb_ref
+            continue
+
         # Find all geometries in ref that have an intersection with a geometry in c1
         # and store then as paired objects
         ref_intersection_gdf = ref_geom_layer.sjoin(c1_geom_layer, how="inner", lsuffix="ref", rsuffix="c1")
@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 import numpy as np
 import pandas as pd
@@ -18,6 +18,7 @@ class MPAP0(Metric):
     """
 
     metric_name = "mpap0"
+    intrinsic_output_extension = ".json"
 
     def create_metric_intrinsic_one_job(self, name: str, input: Path, output: Path):
         job_name = f"{self.metric_name}_intrinsic_{name}_{input.stem}"
@@ -30,13 +31,20 @@ docker run -t --rm --userns=host --shm-size=2gb
 ghcr.io/ignf/coclico:{__version__}
 python -m coclico.mpap0.mpap0_intrinsic
 --input-file /input
---output-file /output/{input.stem}.json
+--output-file /output/{input.stem}{self.intrinsic_output_extension}
 --config-file /config/{self.config_file.name}
+{self.reader_options()}
 """
 
         job = Job(job_name, command, tags=["docker"])
         return job
 
+    def compute_metric_intrinsic_from_points(self, las_file: Path, points: Tuple, output: Path):
+        # imported here to avoid circular imports
+        from coclico.mpap0 import mpap0_intrinsic
+
+        mpap0_intrinsic.compute_metric_intrinsic_from_points(points, self.config_file, output)
+
     def create_metric_relative_to_ref_jobs(
         self, name: str, out_c1: Path, out_ref: Path, output: Path, c1_jobs: List[Job], ref_jobs: List[Job]
     ) -> Job:
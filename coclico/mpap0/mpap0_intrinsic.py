@@ -4,50 +4,72 @@ import logging
 from pathlib import Path
 
 import numpy as np
-import pdal
 
-from coclico.io import read_config_file
-from coclico.metrics.commons import split_composed_class
+from coclico.config import las_read_chunk_size, laz_threads
+from coclico.io import (
+    LasPoints,
+    configure_laz_decompression,
+    iter_las_points,
+    read_config_file,
+)
+from coclico.metrics.commons import count_points_by_class, merge_counts_by_class
 from coclico.mpap0.mpap0 import MPAP0
 
 
-def compute_metric_intrinsic(las_file: Path, config_file: Path, output_json: Path):
+def compute_metric_intrinsic(las_file: Path, config_file: Path, output_json: Path, chunk_size: int = None):
     """Count points on las file for all classes in the config file, and save result
     in output_json file.
     In case of "composed classes" in the class_weight dict (eg: "3,4"), the returned value is the
     sum of the points counts of each class from the compose class (count(3) + count(4))
 
+    Only the classification of the points is read, chunk by chunk, so that the memory used does not depend on the
+    number of points.
+
     Args:
         las_file (Path): path to the las file on which to generate mpap0 intrinsic metric
         config_file (Path): class weights dict (to know for which classes to generate the count)
         output_json (Path): path to output
+        chunk_size (int, optional): number of points to read at once. Defaults to None (las_read_chunk_size from
+        coclico.config).
     """
+    chunks = iter_las_points(las_file, chunk_size or las_read_chunk_size, dimensions=("classification",))
+    counts = count_points_by_class(points.classification for points in chunks)
 
-    config_dict = read_config_file(config_file)
-    class_weights = config_dict[MPAP0.metric_name]["weights"]
+    save_merged_counts(counts, config_file, output_json)
+
+
+def compute_metric_intrinsic_from_points(points: LasPoints, config_file: Path, output_json: Path):
+    """Compute mpap0 intrinsic metric (cf. compute_metric_intrinsic) from points that have already been read.
+
+    Args:
+        points (LasPoints): points as returned by occupancy_map.read_las
+        config_file (Path): class weights dict (to know for which classes to generate the count)
+        output_json (Path): path to output
+    """
+    counts = count_points_by_class([points.classification])
 
-    # TODO: replace with function imported from pdaltools
-    # (pdaltools.count_occurences.count_occurences_for_attribute import compute_count_one_file)
-    # not done yet as this module is not accessible from outside the library
-    pipeline = pdal.Reader.las(str(las_file))
-    pipeline |= pdal.Filter.stats(dimensions="Classification", count="Classification")
-    pipeline.execute()
-    raw_counts = pipeline.metadata["metadata"]["filters.stats"]["statistic"][0]["counts"]
-    split_counts = [c.split("/") for c in raw_counts]
-    # metadata class key is a float represented as a string with 6 trailing zeros(eg 1.000000)
-    points_counts = dict({value.split(".")[0]: int(count) for value, count in split_counts})
+    save_merged_counts(counts, config_file, output_json)
 
-    def merge_counts(class_key):
-        splitted_class_key = split_composed_class(class_key)
-        count = np.sum([points_counts.get(k.strip(), 0) for k in splitted_class_key])
 
-        return count
+def save_merged_counts(counts: np.array, config_file: Path, output_json: Path):
+    """Merge points counts by las classification code into counts for the classes in the config file (cf.
+    merge_counts_by_class), and save them in output_json file.
+
+    Args:
+        counts (np.array): points count for each las classification code (as returned by count_points_by_class)
+        config_file (Path): class weights dict (to know for which classes to generate the count)
+        output_json (Path): path to output
+    """
+    config_dict = read_config_file(config_file)
+    class_weights = config_dict[MPAP0.metric_name]["weights"]
 
     # get results for classes that are in weights dictionary (merged if necessary)
-    out_counts = dict({k: int(merge_counts(k)) for k in class_weights.keys()})
+    class_keys = list(class_weights.keys())
+    out_counts = dict({k: int(count) for k, count in zip(class_keys, merge_counts_by_class(counts, class_keys))})
 
     logging.debug(f"Class weights: {class_weights}")
-    logging.debug(f"Points counts: {points_counts}")
+    classification_codes = np.flatnonzero(counts)
+    logging.debug(f"Points counts: {dict(zip(classification_codes.tolist(), counts[classification_codes].tolist()))}")
     logging.debug(f"out counts: {out_counts}")
 
     output_json.parent.mkdir(parents=True, exist_ok=True)
@@ -60,12 +82,28 @@ def parse_args():
     parser.add_argument("-i", "--input-file", type=Path, required=True, help="Path to the LAS file")
     parser.add_argument("-o", "--output-file", type=Path, required=True, help="Path to the JSON output file")
     parser.add_argument("--config-file", type=Path, required=True, help="Coclico configuration file")
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        help="Number of points to read at once",
+    )
+    parser.add_argument(
+        "--laz-threads",
+        type=int,
+        default=laz_threads,
+        help="Number of threads used to decompress LAZ files (0 to use all the CPUs available to the container)",
+    )
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = parse_args()
     logging.basicConfig(format="%(message)s", level=logging.DEBUG)
+    configure_laz_decompression(args.laz_threads)
     compute_metric_intrinsic(
-        las_file=Path(args.input_file), config_file=args.config_file, output_json=Path(args.output_file)
+        las_file=Path(args.input_file),
+        config_file=args.config_file,
+        output_json=Path(args.output_file),
+        chunk_size=args.chunk_size,
     )
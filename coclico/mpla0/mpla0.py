@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 import numpy as np
 import pandas as pd
@@ -21,7 +21,12 @@ class MPLA0(Metric):
 
     # Pixel size for the intermediate result: 2d binary maps for each class
     map_pixel_size = 0.5
+    # Pixel sizes (multiples of map_pixel_size) at which the relative metric also compares the maps, after OR-pooling
+    pooled_pixel_sizes = (1, 2, 5)
+    # Tolerances (in pixels) of the buffered IoU computed by the relative metric (cf. doc/mpla0.md)
+    buffer_tolerances = (1, 2)
     metric_name = "mpla0"
+    intrinsic_output_extension = ".tif"
 
     def create_metric_intrinsic_one_job(self, name: str, input: Path, output: Path):
         job_name = f"{self.metric_name}_intrinsic_{name}_{input.stem}"
@@ -34,14 +39,23 @@ docker run -t --rm --userns=host --shm-size=2gb
 ghcr.io/ignf/coclico:{__version__}
 python -m coclico.mpla0.mpla0_intrinsic
 --input-file /input
---output-file /output/{input.stem}.tif
+--output-file /output/{input.stem}{self.intrinsic_output_extension}
 --config-file /config/{self.config_file.name}
 --pixel-size {self.map_pixel_size}
+{self.reader_options()}
 """
 
         job = Job(job_name, command, tags=["docker"])
         return job
 
+    def compute_metric_intrinsic_from_points(self, las_file: Path, points: Tuple, output: Path):
+        # imported here to avoid circular imports
+        from coclico.mpla0 import mpla0_intrinsic
+
+        mpla0_intrinsic.compute_metric_intrinsic_from_points(
+            las_file, points, self.config_file, output, self.map_pixel_size
+        )
+
     def create_metric_relative_to_ref_jobs(
         self, name: str, out_c1: Path, out_ref: Path, output: Path, c1_jobs: List[Job], ref_jobs: List[Job]
     ) -> Job:
@@ -59,6 +73,8 @@ python -m coclico.mpla0.mpla0_relative
 --output-csv-tile /output/result_tile.csv
 --output-csv /output/result.csv
 --config-file /config/{self.config_file.name}
+--pooled-pixel-sizes {" ".join(str(size) for size in self.pooled_pixel_sizes)}
+--buffer-tolerances {" ".join(str(tolerance) for tolerance in self.buffer_tolerances)}
 """
 
         job = Job(job_name, command, tags=["docker"])
@@ -77,6 +93,8 @@ python -m coclico.mpla0.mpla0_relative
             - union
             - ref_pixel_count
         (these columns are described in the mpla0_relative function docstring)
+        The columns of the pooled maps (intersection_<size>m, union_<size>m, iou_<size>m) and of the buffered IoU
+        (intersection_buffer_<tolerance>px, iou_buffer_<tolerance>px) are not used in the note and are dropped.
 
         Args:
             metric_df (pd.DataFrame): mpla0 relative results as a pandas dataframe
@@ -112,5 +130,7 @@ python -m coclico.mpla0.mpla0_relative
         )
 
         metric_df.drop(columns=["ref_pixel_count", "intersection", "union"], inplace=True)
+        pooled_columns = [c for c in metric_df.columns if c.startswith(("intersection_", "union_", "iou_"))]
+        metric_df.drop(columns=pooled_columns, inplace=True)
 
         return metric_df
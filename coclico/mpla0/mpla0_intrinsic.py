@@ -3,11 +3,14 @@ import logging
 from pathlib import Path
 
 import coclico.metrics.occupancy_map as occupancy_map
-from coclico.io import read_config_file
+from coclico.config import laz_threads
+from coclico.io import LasPoints, configure_laz_decompression, read_config_file
 from coclico.mpla0.mpla0 import MPLA0
 
 
-def compute_metric_intrinsic(las_file: Path, config_file: Path, output_tif: Path, pixel_size: float = 0.5):
+def compute_metric_intrinsic(
+    las_file: Path, config_file: Path, output_tif: Path, pixel_size: float = 0.5, chunk_size: int = None
+):
     """Create 2d occupancy map for each class that is in the config_file,
     and save result in a single output_tif file with one layer per class
     (the classes are sorted alphabetically).
@@ -18,10 +21,36 @@ def compute_metric_intrinsic(las_file: Path, config_file: Path, output_tif: Path
         to generate the binary map)
         output_tif (Path): path to output
         pixel_size (float): size of the output raster pixels
+        chunk_size (int, optional): if set, read the las file by chunks of chunk_size points (bounded memory).
+        Defaults to None (read all points at once).
+    """
+    if chunk_size:
+        config_dict = read_config_file(config_file)
+        class_weights = config_dict[MPLA0.metric_name]["weights"]
+        occupancy_map.create_occupancy_map(las_file, class_weights, output_tif, pixel_size, chunk_size)
+    else:
+        points = occupancy_map.read_las(las_file)
+        compute_metric_intrinsic_from_points(las_file, points, config_file, output_tif, pixel_size)
+
+
+def compute_metric_intrinsic_from_points(
+    las_file: Path, points: LasPoints, config_file: Path, output_tif: Path, pixel_size: float = 0.5
+):
+    """Compute mpla0 intrinsic metric (cf. compute_metric_intrinsic) from points that have already been read.
+    The occupancy maps are shared with the other metrics computed on the same tile through the tiles cache
+    (cf. occupancy_map.get_occupancy_map_array).
+
+    Args:
+        las_file (Path): path to the las file from which points have been read
+        points (LasPoints): points as returned by occupancy_map.read_las
+        config_file (Path): Coclico configuration file (to know for which classes
+        to generate the binary map)
+        output_tif (Path): path to output
+        pixel_size (float): size of the output raster pixels
     """
     config_dict = read_config_file(config_file)
     class_weights = config_dict[MPLA0.metric_name]["weights"]
-    occupancy_map.create_occupancy_map(las_file, class_weights, output_tif, pixel_size)
+    occupancy_map.create_occupancy_map_from_points(las_file, points, class_weights, output_tif, pixel_size)
 
 
 def parse_args():
@@ -36,12 +65,28 @@ def parse_args():
         help="Coclico configuration file",
     )
     parser.add_argument("-p", "--pixel-size", type=float, required=True, help="Size of the output raster pixels")
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        help="If set, read the LAS file by chunks of this number of points (bounded memory)",
+    )
+    parser.add_argument(
+        "--laz-threads",
+        type=int,
+        default=laz_threads,
+        help="Number of threads used to decompress LAZ files (0 to use all the CPUs available to the container)",
+    )
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = parse_args()
     logging.basicConfig(format="%(message)s", level=logging.DEBUG)
+    configure_laz_decompression(args.laz_threads)
     compute_metric_intrinsic(
-        las_file=Path(args.input_file), config_file=args.config_file, output_tif=Path(args.output_file)
+        las_file=Path(args.input_file),
+        config_file=args.config_file,
+        output_tif=Path(args.output_file),
+        chunk_size=args.chunk_size,
     )
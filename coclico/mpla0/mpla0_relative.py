@@ -2,16 +2,26 @@ import argparse
 import logging
 from collections import Counter
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
+import cv2
 import numpy as np
 import pandas as pd
 import rasterio
 
 from coclico.config import csv_separator
 from coclico.io import read_config_file
+from coclico.metrics.commons import (
+    intersect_sorted_indices,
+    read_dense_layers,
+    read_empty_layers,
+    read_sparse_layers,
+)
 from coclico.mpla0.mpla0 import MPLA0
 
+# Number of set bits in each byte value
+POPCOUNT_LUT = np.array([bin(ii).count("1") for ii in range(256)], dtype=np.int64)
+
 
 def generate_sum_by_layer(raster: np.array, layers: List[str]) -> Dict:
     """Generate the sum on a raster by class:
@@ -31,12 +41,349 @@ def generate_sum_by_layer(raster: np.array, layers: List[str]) -> Dict:
     return sum_dict
 
 
-def compute_metric_relative(c1_dir: Path, ref_dir: Path, config_file: Path, output_csv: Path, output_csv_tile: Path):
+def pack_layers(raster: np.array) -> np.array:
+    """Pack a 3d binary raster with shape (nb_layers, height, width) to 1 bit per pixel (non-zero pixels are set),
+    row by row: the output shape is (nb_layers, height, ceil(width / 8)) and the padding bits are 0.
+
+    Args:
+        raster (np.array): 3d binary raster
+
+    Returns:
+        np.array: bit-packed raster (uint8)
+    """
+    return np.packbits(raster, axis=-1)
+
+
+def count_bits_by_layer(packed: np.array, layers: List[str]) -> Dict:
+    """Count the set bits (ie. the non-zero pixels) of each layer of a bit-packed raster (as returned by
+    pack_layers), with the same output as generate_sum_by_layer on the unpacked raster
+
+    Args:
+        packed (np.array): 3d bit-packed raster
+        layers (List[str]): List of layer ids
+
+    Returns:
+        Dict: dictionary with the number of set bits for each layer
+    """
+    if hasattr(np, "bitwise_count"):  # numpy >= 2.0
+        counts = np.bitwise_count(packed).sum(axis=(1, 2), dtype=np.int64)
+    else:
+        counts = [np.bincount(layer.ravel(), minlength=256) @ POPCOUNT_LUT for layer in packed]
+
+    return {k: v for (k, v) in zip(layers, counts)}
+
+
+def count_pixels_sparse_layer(c1_indices: np.array, ref_indices: np.array) -> Tuple[int, int, int]:
+    """Count the union, intersection and reference pixels of a layer from the sorted flat indices of its pixels that
+    are set in c1 and in ref (cf. commons.read_sparse_layers), without creating the binary maps
+
+    Args:
+        c1_indices (np.array): sorted flat indices of the pixels that are set in c1
+        ref_indices (np.array): sorted flat indices of the pixels that are set in ref
+
+    Returns:
+        Tuple[int, int, int]: union, intersection and reference pixels counts
+    """
+    intersection = len(intersect_sorted_indices(c1_indices, ref_indices)[0])
+    union = len(c1_indices) + len(ref_indices) - intersection
+
+    return union, intersection, len(ref_indices)
+
+
+def pool_layers(raster: np.array, factor: int) -> np.array:
+    """Reduce the resolution of a 3d binary raster with shape (nb_layers, height, width) by OR-pooling: each output
+    pixel is set if at least one of the factor x factor input pixels that it covers is set. The last rows/columns of
+    output pixels cover the remaining input pixels when height/width are not multiples of factor.
+
+    Args:
+        raster (np.array): 3d binary raster
+        factor (int): pooling factor (ratio between the output and input pixel sizes)
+
+    Returns:
+        np.array: pooled binary raster, with shape (nb_layers, ceil(height / factor), ceil(width / factor))
+    """
+    if factor == 1:
+        return raster
+    nb_layers, height, width = raster.shape
+    pooled_height, pooled_width = -(-height // factor), -(-width // factor)
+    if (height, width) != (pooled_height * factor, pooled_width * factor):
+        padded = np.zeros((nb_layers, pooled_height * factor, pooled_width * factor), dtype=raster.dtype)
+        padded[:, :height, :width] = raster
+        raster = padded
+
+    return raster.reshape(nb_layers, pooled_height, factor, pooled_width, factor).any(axis=(2, 4))
+
+
+def pool_sparse_indices(indices: np.array, width: int, factor: int) -> np.array:
+    """Reduce the resolution of a sparse layer (sorted flat indices of the pixels that are set, cf.
+    commons.read_sparse_layers) by OR-pooling, with the same output grid as pool_layers
+
+    Args:
+        indices (np.array): sorted flat indices of the pixels that are set
+        width (int): width of the layer (in pixels)
+        factor (int): pooling factor (ratio between the output and input pixel sizes)
+
+    Returns:
+        np.array: sorted flat indices of the pixels that are set in the pooled layer
+    """
+    if factor == 1:
+        return indices
+    rows, cols = np.divmod(indices, width)
+    pooled_width = -(-width // factor)
+
+    return np.unique((rows // factor) * pooled_width + cols // factor)
+
+
+def get_pooling_factors(pixel_size: float, pooled_pixel_sizes: Tuple[float]) -> List[int]:
+    """Get the pooling factors to go from the occupancy maps pixel size to each of pooled_pixel_sizes
+
+    Args:
+        pixel_size (float): pixel size of the occupancy maps
+        pooled_pixel_sizes (Tuple[float]): pixel sizes of the pooled maps
+
+    Raises:
+        ValueError: if a pooled pixel size is not a multiple of pixel_size
+
+    Returns:
+        List[int]: pooling factor for each pooled pixel size
+    """
+    factors = []
+    for pooled_pixel_size in pooled_pixel_sizes:
+        factor = int(round(pooled_pixel_size / pixel_size))
+        if factor < 1 or not np.isclose(factor * pixel_size, pooled_pixel_size):
+            raise ValueError(
+                f"Pooled pixel size {pooled_pixel_size} is not a multiple of the occupancy maps pixel size "
+                + f"{pixel_size}"
+            )
+        factors.append(factor)
+
+    return factors
+
+
+def compute_buffered_intersection(c1_layer: np.array, ref_layer: np.array, tolerances: Tuple[float]) -> List[int]:
+    """Count the intersection of two binary maps with a tolerance on the pixels locations: a pixel that is set in
+    only one of the maps is counted in the intersection if it lies within a given distance of a pixel that is set in
+    the other map. With a tolerance of 0, this is the usual intersection.
+
+    The distance of each pixel to the closest set pixel of each map is computed once with a distance transform
+    (exact euclidean distance, in pixels), and all the tolerances are computed from these distances.
+
+    Args:
+        c1_layer (np.array): 2d binary map of c1
+        ref_layer (np.array): 2d binary map of ref
+        tolerances (Tuple[float]): maximum distances (in pixels) for a pixel to match a pixel of the other map
+
+    Returns:
+        List[int]: buffered intersection for each tolerance
+    """
+    c1_set, ref_set = c1_layer != 0, ref_layer != 0
+    if not np.any(c1_set) or not np.any(ref_set):
+        return [0] * len(tolerances)
+
+    # distanceTransform computes the distance of each non-zero pixel to the closest zero pixel
+    distance_to_ref = cv2.distanceTransform((~ref_set).astype(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+    distance_to_c1 = cv2.distanceTransform((~c1_set).astype(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+    c1_distances = distance_to_ref[c1_set]
+    ref_distances = distance_to_c1[ref_set]
+    # pixels that are set in both maps are matched in both directions
+    nb_common = np.count_nonzero(c1_set & ref_set)
+
+    return [
+        int(np.count_nonzero(c1_distances <= tolerance) + np.count_nonzero(ref_distances <= tolerance) - nb_common)
+        for tolerance in tolerances
+    ]
+
+
+def compute_counts_single_tile(
+    c1_file: Path,
+    ref_file: Path,
+    classes: List[str],
+    pooled_pixel_sizes: Tuple[float] = (),
+    buffer_tolerances: Tuple[float] = (),
+) -> Tuple[List[Tuple[Dict, Dict, Dict]], List[Dict]]:
+    """Count the union, intersection and reference pixels of the occupancy maps of a tile for each class, at the
+    resolution of the maps and at each pooled pixel size (cf. pool_layers), and the buffered intersection for each
+    buffer tolerance (cf. compute_buffered_intersection)
+
+    Args:
+        c1_file (Path): occupancy maps of the tile in c1 (result of mpla0 intrinsic metric)
+        ref_file (Path): occupancy maps of the tile in ref (result of mpla0 intrinsic metric)
+        classes (List[str]): class of each layer of the occupancy maps
+        pooled_pixel_sizes (Tuple[float], optional): pixel sizes of the pooled maps. Defaults to () (no pooling).
+        buffer_tolerances (Tuple[float], optional): tolerances (in pixels) of the buffered intersections.
+        Defaults to () (no buffered intersection).
+
+    Returns:
+        Tuple[List[Tuple[Dict, Dict, Dict]], List[Dict]]:
+        - union, intersection and reference pixels counts by class (classes without pixels in c1 and ref can be
+        missing), at the maps resolution then at each pooled pixel size
+        - buffered intersection by class for each buffer tolerance
+    """
+    with rasterio.Env():
+        with rasterio.open(ref_file) as ref:
+            height, width = ref.height, ref.width
+            factors = [1] + get_pooling_factors(ref.res[0], pooled_pixel_sizes)
+    counts = [({}, {}, {}) for _ in factors]
+    buffered_intersections = [{} for _ in buffer_tolerances]
+
+    c1_empty, ref_empty = read_empty_layers(c1_file), read_empty_layers(ref_file)
+    c1_sparse, ref_sparse = read_sparse_layers(c1_file), read_sparse_layers(ref_file)
+    # layers that are empty or sparse in both c1 and ref are counted from their lists of pixels (and layers that
+    # are empty in both c1 and ref are not counted at all, all their values are 0)
+    c1_listed, ref_listed = c1_empty.copy(), ref_empty.copy()
+    c1_listed[list(c1_sparse)] = True
+    ref_listed[list(ref_sparse)] = True
+    sparse_layers = np.flatnonzero(c1_listed & ref_listed & ~(c1_empty & ref_empty))
+    layers = np.flatnonzero(~(c1_listed & ref_listed))
+    layers_classes = [classes[ii] for ii in layers]
+    if len(layers):
+        with rasterio.Env():
+            with rasterio.open(c1_file) as c1:
+                c1_raster = read_dense_layers(c1, [int(ii) + 1 for ii in layers])
+
+            with rasterio.open(ref_file) as ref:
+                ref_raster = read_dense_layers(ref, [int(ii) + 1 for ii in layers])
+
+        for factor, (union, intersection, ref_pixel_count) in zip(factors, counts):
+            # rasters are bit-packed (8 pixels per byte) after pooling, and counts are computed with bitwise
+            # operations on the packed rasters
+            c1_packed = pack_layers(pool_layers(c1_raster, factor))
+            ref_packed = pack_layers(pool_layers(ref_raster, factor))
+            union.update(count_bits_by_layer(c1_packed | ref_packed, layers_classes))
+            intersection.update(count_bits_by_layer(c1_packed & ref_packed, layers_classes))
+            ref_pixel_count.update(count_bits_by_layer(ref_packed, layers_classes))
+
+        if buffer_tolerances:
+            for cl, c1_layer, ref_layer in zip(layers_classes, c1_raster, ref_raster):
+                for buffered_intersection, value in zip(
+                    buffered_intersections, compute_buffered_intersection(c1_layer, ref_layer, buffer_tolerances)
+                ):
+                    buffered_intersection[cl] = value
+
+    no_pixels = np.array([], dtype=np.int64)
+    for ii in sparse_layers:
+        cl = classes[ii]
+        c1_indices = c1_sparse.get(ii, (no_pixels, None))[0]
+        ref_indices = ref_sparse.get(ii, (no_pixels, None))[0]
+        for factor, (union, intersection, ref_pixel_count) in zip(factors, counts):
+            union[cl], intersection[cl], ref_pixel_count[cl] = count_pixels_sparse_layer(
+                pool_sparse_indices(c1_indices, width, factor), pool_sparse_indices(ref_indices, width, factor)
+            )
+
+        if buffer_tolerances:
+            # the distance transforms need the whole layers
+            c1_layer, ref_layer = np.zeros(height * width, dtype=np.uint8), np.zeros(height * width, dtype=np.uint8)
+            c1_layer[c1_indices] = 1
+            ref_layer[ref_indices] = 1
+            for buffered_intersection, value in zip(
+                buffered_intersections,
+                compute_buffered_intersection(
+                    c1_layer.reshape(height, width), ref_layer.reshape(height, width), buffer_tolerances
+                ),
+            ):
+                buffered_intersection[cl] = value
+
+    return counts, buffered_intersections
+
+
+def get_pooled_columns(pooled_pixel_size: float) -> Tuple[str, str, str]:
+    """Get the names of the output columns for a pooled pixel size
+
+    Args:
+        pooled_pixel_size (float): pixel size of the pooled maps
+
+    Returns:
+        Tuple[str, str, str]: names of the intersection, union and IoU columns (eg. intersection_2m, union_2m, iou_2m)
+    """
+    suffix = f"{pooled_pixel_size:g}m"
+    return f"intersection_{suffix}", f"union_{suffix}", f"iou_{suffix}"
+
+
+def get_pooled_values(
+    pooled_pixel_sizes: Tuple[float], pooled_counts: List[Tuple[Counter, Counter, Counter]], cl: str
+) -> Dict:
+    """Get the values of the output columns of a class for each pooled pixel size. The IoU is 1 when the class
+    covers no pixel in c1 and ref.
+
+    Args:
+        pooled_pixel_sizes (Tuple[float]): pixel sizes of the pooled maps
+        pooled_counts (List[Tuple[Counter, Counter, Counter]]): union, intersection and reference pixels counts by
+        class for each pooled pixel size
+        cl (str): class
+
+    Returns:
+        Dict: values of the intersection, union and IoU columns for each pooled pixel size
+    """
+    values = {}
+    for pooled_pixel_size, (union, intersection, _) in zip(pooled_pixel_sizes, pooled_counts):
+        intersection_col, union_col, iou_col = get_pooled_columns(pooled_pixel_size)
+        values[intersection_col] = intersection.get(cl, 0)
+        values[union_col] = union.get(cl, 0)
+        values[iou_col] = values[intersection_col] / values[union_col] if values[union_col] else 1
+
+    return values
+
+
+def get_buffered_columns(buffer_tolerance: float) -> Tuple[str, str]:
+    """Get the names of the output columns for a buffer tolerance
+
+    Args:
+        buffer_tolerance (float): tolerance (in pixels) of the buffered intersection
+
+    Returns:
+        Tuple[str, str]: names of the buffered intersection and IoU columns (eg. intersection_buffer_1px,
+        iou_buffer_1px)
+    """
+    suffix = f"buffer_{buffer_tolerance:g}px"
+    return f"intersection_{suffix}", f"iou_{suffix}"
+
+
+def get_buffered_values(
+    buffer_tolerances: Tuple[float], buffered_intersections: List[Counter], union: Counter, cl: str
+) -> Dict:
+    """Get the values of the output columns of a class for each buffer tolerance. The buffered IoU is the buffered
+    intersection divided by the union of the maps, and is 1 when the class covers no pixel in c1 and ref.
+
+    Args:
+        buffer_tolerances (Tuple[float]): tolerances (in pixels) of the buffered intersections
+        buffered_intersections (List[Counter]): buffered intersection by class for each buffer tolerance
+        union (Counter): union by class
+        cl (str): class
+
+    Returns:
+        Dict: values of the buffered intersection and IoU columns for each buffer tolerance
+    """
+    values = {}
+    for buffer_tolerance, buffered_intersection in zip(buffer_tolerances, buffered_intersections):
+        intersection_col, iou_col = get_buffered_columns(buffer_tolerance)
+        values[intersection_col] = buffered_intersection.get(cl, 0)
+        values[iou_col] = values[intersection_col] / union[cl] if union.get(cl, 0) else 1
+
+    return values
+
+
+def compute_metric_relative(
+    c1_dir: Path,
+    ref_dir: Path,
+    config_file: Path,
+    output_csv: Path,
+    output_csv_tile: Path,
+    pooled_pixel_sizes: Tuple[float] = (),
+    buffer_tolerances: Tuple[float] = (),
+):
     """Count points on las file from c1 classification, for all classes, relative to reference classification.
     Compute also a score depending on weights keys in the config file, and save result in output_csv file.
     In case of "composed classes" in the class_weight dict (eg: "3,4"), the returned value is the
     sum of the points counts of each class from the compose class (count(3) + count(4))
 
+    If pooled_pixel_sizes is set, the occupancy maps are also compared at each of these (coarser) pixel sizes after
+    OR-pooling (cf. pool_layers), and the intersection, union and IoU at each pixel size are added to the results
+    (eg. intersection_2m, union_2m, iou_2m).
+
+    If buffer_tolerances is set, the buffered intersection (where a pixel that is set in only one map is matched if
+    it lies within the tolerance of a pixel of the other map, cf. compute_buffered_intersection) and the buffered IoU
+    are added to the results for each tolerance (eg. intersection_buffer_1px, iou_buffer_1px).
+
     Args:
         c1_dir (Path):  path to the c1 classification directory,
                         where there are json files with the result of mpla0 intrinsic metric
@@ -45,32 +392,33 @@ def compute_metric_relative(c1_dir: Path, ref_dir: Path, config_file: Path, outp
         config_file (Path): Coclico configuration file
         output_csv (Path):  path to output csv file
         output_csv_tile (Path):  path to output csv file, result by tile
+        pooled_pixel_sizes (Tuple[float], optional): pixel sizes at which the maps are also compared (multiples of
+        the pixel size of the occupancy maps). Defaults to () (no pooling).
+        buffer_tolerances (Tuple[float], optional): tolerances (in pixels) of the buffered intersections.
+        Defaults to () (no buffered intersection).
     """
     config_dict = read_config_file(config_file)
     class_weights = config_dict[MPLA0.metric_name]["weights"]
 
-    total_ref_pixel_count = Counter()
-    total_union = Counter()
-    total_intersection = Counter()
+    # union, intersection and reference pixels counts at the maps resolution then at each pooled pixel size
+    total_counts = [(Counter(), Counter(), Counter()) for _ in range(len(pooled_pixel_sizes) + 1)]
+    total_buffered_intersections = [Counter() for _ in buffer_tolerances]
     data = []
     classes = sorted(class_weights.keys())
     for ref_file in ref_dir.iterdir():
         c1_file = c1_dir / ref_file.name
-        with rasterio.Env():
-            with rasterio.open(c1_file) as c1:
-                c1_raster = c1.read()
-
-            with rasterio.open(ref_file) as ref:
-                ref_raster = ref.read()
-
-        union = generate_sum_by_layer(np.logical_or(c1_raster, ref_raster), classes)
-        intersection = generate_sum_by_layer(np.logical_and(c1_raster, ref_raster), classes)
-        ref_pixel_count = generate_sum_by_layer(ref_raster, classes)
-
-        total_ref_pixel_count += Counter(ref_pixel_count)
-        total_union += Counter(union)
-        total_intersection += Counter(intersection)
+        counts, buffered_intersections = compute_counts_single_tile(
+            c1_file, ref_file, classes, pooled_pixel_sizes, buffer_tolerances
+        )
+        for tile_counts, tile_total_counts in zip(counts, total_counts):
+            for count, total_count in zip(tile_counts, tile_total_counts):
+                total_count.update(count)
+        for buffered_intersection, total_buffered_intersection in zip(
+            buffered_intersections, total_buffered_intersections
+        ):
+            total_buffered_intersection.update(buffered_intersection)
 
+        union, intersection, ref_pixel_count = counts[0]
         new_line = [
             {
                 "tile": ref_file.stem,
@@ -78,6 +426,8 @@ def compute_metric_relative(c1_dir: Path, ref_dir: Path, config_file: Path, outp
                 "ref_pixel_count": ref_pixel_count.get(cl, 0),
                 "intersection": intersection.get(cl, 0),
                 "union": union.get(cl, 0),
+                **get_pooled_values(pooled_pixel_sizes, counts[1:], cl),
+                **get_buffered_values(buffer_tolerances, buffered_intersections, union, cl),
             }
             for cl in classes
         ]
@@ -88,12 +438,15 @@ def compute_metric_relative(c1_dir: Path, ref_dir: Path, config_file: Path, outp
     df.to_csv(output_csv_tile, index=False, sep=csv_separator)
     logging.debug(df.to_markdown())
 
+    total_union, total_intersection, total_ref_pixel_count = total_counts[0]
     data = [
         {
             "class": cl,
             "ref_pixel_count": total_ref_pixel_count.get(cl, 0),
             "intersection": total_intersection.get(cl, 0),
             "union": total_union.get(cl, 0),
+            **get_pooled_values(pooled_pixel_sizes, total_counts[1:], cl),
+            **get_buffered_values(buffer_tolerances, total_buffered_intersections, total_union, cl),
         }
         for cl in classes
     ]
@@ -131,6 +484,22 @@ def parse_args():
         type=Path,
         help="Coclico configuration file",
     )
+    parser.add_argument(
+        "--pooled-pixel-sizes",
+        type=float,
+        nargs="*",
+        default=[],
+        help="Pixel sizes at which the occupancy maps are also compared after OR-pooling "
+        + "(multiples of the occupancy maps pixel size)",
+    )
+    parser.add_argument(
+        "--buffer-tolerances",
+        type=float,
+        nargs="*",
+        default=[],
+        help="Tolerances (in pixels) at which a pixel of an occupancy map matches a pixel of the other map, "
+        + "for the buffered IoU",
+    )
 
     return parser.parse_args()
 
@@ -144,4 +513,6 @@ if __name__ == "__main__":
         config_file=args.config_file,
         output_csv=Path(args.output_csv),
         output_csv_tile=Path(args.output_csv_tile),
+        pooled_pixel_sizes=tuple(args.pooled_pixel_sizes),
+        buffer_tolerances=tuple(args.buffer_tolerances),
     )
@@ -68,6 +68,10 @@ def generate_metric_dataframes():
             "max_diff": [0.09, 4.0001, 0.1 + (4 - 0.1) / 2],
             "mean_diff": [0.01, 0.5, 0.01 + (0.5 - 0.01) / 2],
             "std_diff": [0.01, 0.5, 0.01 + (0.5 - 0.01) / 2],
+            # percentiles are not used in the note
+            "p50_diff": [0.01, 0.5, 0.1],
+            "p90_diff": [0.05, 2, 1],
+            "p99_diff": [0.09, 4, 2],
         }
     )
 
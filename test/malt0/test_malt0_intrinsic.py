@@ -1,6 +1,7 @@
 import logging
 import shutil
 import subprocess as sp
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import numpy as np
@@ -8,7 +9,15 @@ import pytest
 import rasterio
 from pdaltools.las_info import las_info_metadata
 
-from coclico.malt0 import malt0_intrinsic
+import coclico.metrics.occupancy_map as occupancy_map
+from coclico.io import LasPoints, read_las_header
+from coclico.malt0 import malt0_intrinsic, malt0_relative
+from coclico.metrics.cache import LRUCache
+from coclico.metrics.commons import (
+    get_raster_geometry_from_las_bounds,
+    read_dense_layers,
+    read_empty_layers,
+)
 
 pytestmark = pytest.mark.docker
 
@@ -51,12 +60,15 @@ def test_create_multilayer_2d_mnx_map(ensure_test1_data, ensure_malt0_data):
 
     output_tif = TMP_PATH / "unit_create_multilayer_2d_mnx_map.tif"
     output_tif.parent.mkdir(parents=True, exist_ok=True)
-    malt0_intrinsic.create_mnx_map(las_file, class_weights, output_tif, pixel_size, no_data_value=no_data_value)
+    mnx, x_min, y_max, crs = malt0_intrinsic.create_mnx_array_with_delaunay_from_las(
+        las_file, class_weights, pixel_size, chunk_size=100000, no_data_value=no_data_value
+    )
+    malt0_intrinsic.write_mnx_map(mnx, x_min, y_max, crs, output_tif, pixel_size, no_data_value, quantization_step=0)
 
     assert output_tif.exists()
     with rasterio.Env():
         with rasterio.open(output_tif) as f:
-            output_data = f.read()
+            output_data = read_dense_layers(f)
             output_bounds = f.bounds
 
     # check that las extent is comprised inside tif extent but tif has no border pixels
@@ -87,6 +99,213 @@ def test_create_multilayer_2d_mnx_map(ensure_test1_data, ensure_malt0_data):
             assert np.max(layer_data[has_data]) <= classes_z_minmax[k][1]
 
 
+@pytest.mark.parametrize("workers", [1, 3])
+def test_create_mnx_array_with_delaunay_workers(ensure_test1_data, workers):
+    las_file = Path("./data/test1/ref/tile_splitted_2818_32247.laz")
+    pixel_size = 0.5
+    class_weights = {"1": 1, "2": 0, "3_4_5": 1, "9": 1}
+    points = occupancy_map.read_las(las_file, malt0_intrinsic.MNX_DIMENSIONS)
+
+    expected_mnx, expected_x_min, expected_y_max = malt0_intrinsic.create_mnx_array_with_delaunay(
+        las_file, points, class_weights, pixel_size, workers=1
+    )
+    mnx, x_min, y_max = malt0_intrinsic.create_mnx_array_with_delaunay(
+        las_file, points, class_weights, pixel_size, workers=workers
+    )
+
+    assert (x_min, y_max) == (expected_x_min, expected_y_max)
+    assert np.array_equal(mnx, expected_mnx)
+
+
+@pytest.mark.parametrize("block_size", [0, 100])
+def test_create_mnx_array_with_delaunay_from_las(ensure_test1_data, block_size):
+    las_file = Path("./data/test1/ref/tile_splitted_2818_32247.laz")
+    pixel_size = 0.5
+    class_weights = {"1": 1, "2": 0, "3_4_5": 1, "9": 1}
+    points = occupancy_map.read_las(las_file, malt0_intrinsic.MNX_DIMENSIONS)
+    las_bounds, _ = read_las_header(las_file)
+    grid = get_raster_geometry_from_las_bounds(las_bounds, pixel_size)
+
+    expected_mnx, _, _ = malt0_intrinsic.create_mnx_array_with_delaunay(
+        las_file, points, class_weights, pixel_size, block_size=block_size, grid=grid, cache=LRUCache()
+    )
+    mnx, x_min, y_max, _ = malt0_intrinsic.create_mnx_array_with_delaunay_from_las(
+        las_file, class_weights, pixel_size, chunk_size=100000, block_size=block_size
+    )
+    binary_maps, occupancy_x_min, occupancy_y_max, _ = occupancy_map.create_occupancy_map_array_from_las(
+        las_file, pixel_size, class_weights, chunk_size=100000
+    )
+
+    # same grid as the occupancy maps computed chunk by chunk, so that they can be used as mask
+    assert (x_min, y_max) == (occupancy_x_min, occupancy_y_max)
+    assert mnx.shape == binary_maps.shape
+    assert np.array_equal(mnx, expected_mnx)
+
+
+def test_create_mnx_array_with_delaunay_blocks(ensure_test1_data):
+    las_file = Path("./data/test1/ref/tile_splitted_2818_32247.laz")
+    pixel_size = 0.5
+    block_halo = 20
+    class_weights = {"1": 1, "2": 0, "3_4_5": 1, "9": 1}
+    points = occupancy_map.read_las(las_file, malt0_intrinsic.MNX_DIMENSIONS)
+
+    expected_mnx, _, _ = malt0_intrinsic.create_mnx_array_with_delaunay(las_file, points, class_weights, pixel_size)
+    mnx, _, _ = malt0_intrinsic.create_mnx_array_with_delaunay(
+        las_file, points, class_weights, pixel_size, block_size=100, block_halo=block_halo
+    )
+
+    assert mnx.shape == expected_mnx.shape
+    # documented tolerance: same values as the single triangulation except in sparse areas near the blocks borders
+    is_near_border = np.zeros(mnx.shape[1:], dtype=bool)
+    for border in range(100, max(mnx.shape[1:]), 100):
+        near_border = slice(max(0, border - block_halo), border + block_halo)
+        is_near_border[near_border, :] = True
+        is_near_border[:, near_border] = True
+    assert np.allclose(mnx[:, ~is_near_border], expected_mnx[:, ~is_near_border], atol=1e-3)
+    assert np.mean(np.isclose(mnx, expected_mnx, atol=1e-3)) > 0.99
+
+
+def test_create_mnx_array_with_delaunay_blocks_stitching(monkeypatch):
+    # use the vectorized max instead of pdal to check that blocks are stitched at the right place (without halo, as
+    # points outside of the raster would be counted in its border pixels by create_mnx_array_from_chunks).
+    # The workers pool is replaced by threads, as the monkeypatched function is not available in worker processes
+    def create_class_mnx_layer(points, class_key, class_indices, pixel_size, top_left, nb_pixels, no_data_value):
+        block_points = points._replace(
+            X=points.X[class_indices],
+            Y=points.Y[class_indices],
+            Z=points.Z[class_indices],
+            classification=points.classification[class_indices],
+        )
+        return malt0_intrinsic.create_mnx_array_from_chunks(
+            [block_points], [class_key], "max", pixel_size, *top_left, nb_pixels, no_data_value
+        )[0]
+
+    monkeypatch.setattr(malt0_intrinsic, "_create_class_mnx_layer", create_class_mnx_layer)
+    monkeypatch.setattr(malt0_intrinsic, "ProcessPoolExecutor", ThreadPoolExecutor)
+    points = generate_las_points_with_z()
+    class_weights = {"1": 1, "3_4": 1, "5": 1}
+
+    expected_mnx, x_min, y_max = malt0_intrinsic.create_mnx_array_with_delaunay(
+        "tile", points, class_weights, 2, workers=1, block_size=0
+    )
+    mnx, _, _ = malt0_intrinsic.create_mnx_array_with_delaunay(
+        "tile", points, class_weights, 2, workers=2, block_size=7, block_halo=0
+    )
+
+    assert np.array_equal(mnx, expected_mnx)
+    assert np.any(mnx != -9999)
+
+
+def test_create_mnx_array_with_delaunay_from_las_stitching(monkeypatch):
+    # same as test_create_mnx_array_with_delaunay_blocks_stitching, with the points read chunk by chunk
+    def create_class_mnx_layer(points, class_key, class_indices, pixel_size, top_left, nb_pixels, no_data_value):
+        block_points = points._replace(
+            X=points.X[class_indices],
+            Y=points.Y[class_indices],
+            Z=points.Z[class_indices],
+            classification=points.classification[class_indices],
+        )
+        return malt0_intrinsic.create_mnx_array_from_chunks(
+            [block_points], [class_key], "max", pixel_size, *top_left, nb_pixels, no_data_value
+        )[0]
+
+    def iter_las_points(las_file, chunk_size, dimensions):
+        nb_reads.append(las_file)
+        for start in range(0, len(points.X), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            yield points._replace(
+                X=points.X[chunk], Y=points.Y[chunk], Z=points.Z[chunk], classification=points.classification[chunk]
+            )
+
+    nb_reads = []
+    points = generate_las_points_with_z()
+    las_bounds = occupancy_map.get_points_bounds(points)
+    monkeypatch.setattr(malt0_intrinsic, "_create_class_mnx_layer", create_class_mnx_layer)
+    monkeypatch.setattr(malt0_intrinsic.coclico.io, "iter_las_points", iter_las_points)
+    monkeypatch.setattr(malt0_intrinsic.coclico.io, "read_las_header", lambda las_file: (las_bounds, None))
+    class_weights = {"1": 1, "3_4": 1, "5": 1}
+    grid = get_raster_geometry_from_las_bounds(las_bounds, 2)
+
+    expected_mnx, x_min, y_max = malt0_intrinsic.create_mnx_array_with_delaunay(
+        "tile", points, class_weights, 2, workers=1, block_size=0, grid=grid, cache=LRUCache()
+    )
+    mnx, chunked_x_min, chunked_y_max, _ = malt0_intrinsic.create_mnx_array_with_delaunay_from_las(
+        Path("tile.laz"), class_weights, 2, chunk_size=1000, workers=1, block_size=7, block_halo=0
+    )
+
+    assert (chunked_x_min, chunked_y_max) == (x_min, y_max)
+    assert np.array_equal(mnx, expected_mnx)
+    assert np.any(mnx != -9999)
+    # the file is read once for all the blocks
+    assert len(nb_reads) == 1
+
+
+def test_create_mnx_array_with_delaunay_from_las_no_points(monkeypatch):
+    monkeypatch.setattr(
+        malt0_intrinsic.coclico.io, "iter_las_points", lambda las_file, chunk_size, dimensions: iter([])
+    )
+    monkeypatch.setattr(
+        malt0_intrinsic.coclico.io, "read_las_header", lambda las_file: ((1000, 2000, 1010, 2020), "EPSG:2154")
+    )
+    class_weights = {"1": 1, "3_4": 1}
+
+    mnx, x_min, y_max, crs = malt0_intrinsic.create_mnx_array_with_delaunay_from_las(
+        Path("tile.laz"), class_weights, 2, chunk_size=1000, no_data_value=-9999, block_size=3
+    )
+
+    (expected_x_min, expected_y_max), nb_pixels = get_raster_geometry_from_las_bounds((1000, 2000, 1010, 2020), 2)
+    assert mnx.shape == (2, nb_pixels[1], nb_pixels[0])
+    assert np.all(mnx == -9999)
+    assert (x_min, y_max, crs) == (expected_x_min, expected_y_max, "EPSG:2154")
+
+
+def test_get_mnx_blocks():
+    assert malt0_intrinsic.get_mnx_blocks((10, 5)) == [(0, 0, 10, 5)]
+    assert malt0_intrinsic.get_mnx_blocks((10, 5), 4) == [
+        (0, 0, 4, 4),
+        (4, 0, 8, 4),
+        (8, 0, 10, 4),
+        (0, 4, 4, 5),
+        (4, 4, 8, 5),
+        (8, 4, 10, 5),
+    ]
+
+
+def test_to_pdal_array():
+    points = generate_las_points_with_z()
+    selection = np.isin(points.classification, [1, 3, 4])
+    array = malt0_intrinsic.to_pdal_array(points, np.flatnonzero(selection))
+
+    assert len(array) == np.count_nonzero(selection)
+    assert np.allclose(array["X"], points.xs[selection])
+    assert np.allclose(array["Y"], points.ys[selection])
+    assert np.allclose(array["Z"], points.zs[selection])
+    assert np.array_equal(array["Classification"], points.classification[selection])
+
+
+def test_create_masked_mnx_map(ensure_test1_data):
+    las_file = Path("./data/test1/niv1/tile_splitted_2818_32247.laz")
+    pixel_size = 0.5
+    no_data_value = -9999
+    class_weights = {"1": 1, "2": 0, "3_4_5": 1}
+    output_tif = TMP_PATH / "unit_test_create_masked_mnx_map.tif"
+
+    points = occupancy_map.read_las(las_file, malt0_intrinsic.MNX_DIMENSIONS)
+    binary_maps, _, _ = occupancy_map.create_occupancy_map_array_from_points(points, pixel_size, class_weights)
+    malt0_intrinsic.create_masked_mnx_map(
+        las_file, points, binary_maps, class_weights, output_tif, pixel_size, no_data_value
+    )
+
+    assert output_tif.exists()
+    with rasterio.Env():
+        with rasterio.open(output_tif) as f:
+            output_data = read_dense_layers(f)
+            assert f.nodata == no_data_value
+
+    assert output_data.shape == binary_maps.shape
+    assert np.all(output_data[binary_maps == 0] == no_data_value)
+
+
 def test_compute_metric_intrinsic(ensure_test1_data):
     las_file = Path("./data/test1/niv1/tile_splitted_2818_32247.laz")
     pixel_size = 0.5
@@ -108,7 +327,7 @@ def test_compute_metric_intrinsic(ensure_test1_data):
     assert output_tif.exists()
     with rasterio.Env():
         with rasterio.open(output_tif) as f:
-            output_data = f.read()
+            output_data = read_dense_layers(f)
 
     assert np.any(output_data > 0)
     assert np.all(output_data[occupancy_data == 0] == no_data_value)
@@ -130,3 +349,149 @@ def test_run_main(ensure_test1_data):
     logging.info(cmd)
 
     assert output_tif.exists()
+
+
+def generate_las_points_with_z(nb_points: int = 5000, seed: int = 42) -> LasPoints:
+    """Generate random points as read from a las file with scale 0.01 on a 50m x 50m area"""
+    rng = np.random.default_rng(seed)
+    X = rng.integers(0, 5000, nb_points).astype(np.int32)
+    Y = rng.integers(0, 5000, nb_points).astype(np.int32)
+    Z = rng.integers(-1000, 3000, nb_points).astype(np.int32)
+    classifs = rng.choice([1, 2, 3, 4, 6], nb_points).astype(np.uint8)
+
+    return LasPoints(X, Y, Z, classifs, np.array([0.01, 0.01, 0.01]), np.array([770000.0, 6278000.0, 100.0]), None)
+
+
+@pytest.mark.parametrize("method", ["max", "min", "mean"])
+def test_create_mnx_array_from_chunks(method):
+    pixel_size = 2
+    no_data_value = -9999
+    class_keys = ["1", "3_4", "5"]
+    points = generate_las_points_with_z()
+    x_min, y_max = 770000.0, 6278050.0
+    nb_pixels = (26, 26)
+
+    mnx = malt0_intrinsic.create_mnx_array_from_chunks(
+        [points], class_keys, method, pixel_size, x_min, y_max, nb_pixels, no_data_value
+    )
+    assert mnx.shape == (3, 26, 26)
+    assert mnx.dtype == np.float32
+
+    # compare with a pixel by pixel computation
+    cols = np.floor((points.xs - x_min + pixel_size / 2) / pixel_size).astype(int)
+    rows = np.floor((y_max - points.ys + pixel_size / 2) / pixel_size).astype(int)
+    for ii, classes in enumerate([[1], [3, 4], [5]]):
+        in_class = np.isin(points.classification, classes)
+        expected = np.full((26, 26), no_data_value, dtype=np.float32)
+        for row, col in set(zip(rows[in_class], cols[in_class])):
+            zs = points.zs[in_class & (rows == row) & (cols == col)]
+            expected[row, col] = {"max": np.max, "min": np.min, "mean": np.mean}[method](zs)
+        assert np.allclose(mnx[ii], expected, atol=1e-4)
+    assert np.all(mnx[2] == no_data_value)  # no point with class 5
+
+    # same result when points are read by chunks
+    chunks = [
+        points._replace(
+            X=points.X[start:end],
+            Y=points.Y[start:end],
+            Z=points.Z[start:end],
+            classification=points.classification[start:end],
+        )
+        for start, end in zip(range(0, 5000, 999), range(999, 5999, 999))
+    ]
+    mnx_chunked = malt0_intrinsic.create_mnx_array_from_chunks(
+        chunks, class_keys, method, pixel_size, x_min, y_max, nb_pixels, no_data_value
+    )
+    assert np.allclose(mnx_chunked, mnx, atol=1e-4)
+
+
+def test_create_mnx_array_from_chunks_unknown_method():
+    with pytest.raises(ValueError):
+        malt0_intrinsic.create_mnx_array_from_chunks(
+            [generate_las_points_with_z()], ["1"], "delaunay", 2, 770000.0, 6278050.0, (26, 26)
+        )
+
+
+def test_fill_small_holes():
+    mnx_layer = np.full((7, 7), -9999, dtype=np.float32)
+    mnx_layer[1:6, 1:6] = 10
+    mnx_layer[3, 3] = -9999  # 1 pixel hole
+    mnx_layer[1, 1] = 20
+    occupied = mnx_layer != -9999
+
+    filled = mnx_layer.copy()
+    malt0_intrinsic.fill_small_holes(filled, occupied, 1)
+
+    assert filled[3, 3] == 10
+    assert filled[0, 0] == 20  # only neighbour is the (1, 1) pixel
+    assert np.all(filled != -9999)  # border pixels are 1 pixel away from occupied pixels
+    assert np.array_equal(filled[occupied], mnx_layer[occupied])  # occupied pixels are not modified
+
+    not_filled = mnx_layer.copy()
+    malt0_intrinsic.fill_small_holes(not_filled, occupied, 0)
+    assert np.array_equal(not_filled, mnx_layer)
+
+
+def test_quantize_mnx():
+    mnx = np.full((3, 4, 5), -9999, dtype=np.float32)
+    mnx[0, :2] = [[100.004, 100.5, 101, 102.126, 120], [99.99, 100, 100, 100, 100]]
+    mnx[1, 0, 0] = -12.345
+    # layer 2 has no values
+
+    quantized, offsets, no_data = malt0_intrinsic.quantize_mnx(mnx, -9999, 0.01)
+
+    assert quantized.dtype == np.int16
+    assert no_data == np.iinfo(np.int16).min
+    assert np.array_equal(quantized == no_data, mnx == -9999)
+    assert np.allclose(offsets, [99.99, -12.35, 0])
+    decoded = quantized * 0.01 + offsets[:, None, None]
+    assert np.allclose(decoded[mnx != -9999], mnx[mnx != -9999], atol=0.005 + 1e-4)
+
+
+def test_quantize_mnx_large_range():
+    mnx = np.array([[[0, 1000, -9999]]], dtype=np.float32)
+    quantized, _, no_data = malt0_intrinsic.quantize_mnx(mnx, -9999, 0.01)
+    assert quantized.dtype == np.int32
+    assert list(quantized[0, 0]) == [0, 100000, np.iinfo(np.int32).min]
+
+    with pytest.raises(ValueError):
+        malt0_intrinsic.quantize_mnx(mnx, -9999, 1e-7)
+
+
+def test_write_mnx_map_quantized():
+    rng = np.random.default_rng(0)
+    # smooth surfaces, with holes
+    rows, cols = np.mgrid[0:200, 0:300]
+    mnx = np.stack([100 + 0.05 * rows + 0.02 * cols, 120 - 0.03 * rows]).astype(np.float32)
+    mnx += rng.normal(0, 0.02, mnx.shape).astype(np.float32)
+    mnx[rng.uniform(0, 1, mnx.shape) < 0.3] = -9999
+    output_tif = TMP_PATH / "unit_test_write_mnx_map_quantized.tif"
+    output_float_tif = TMP_PATH / "unit_test_write_mnx_map_float.tif"
+
+    malt0_intrinsic.write_mnx_map(mnx, 1000.25, 2000.25, "EPSG:2154", output_tif, 0.5, quantization_step=0.01)
+    malt0_intrinsic.write_mnx_map(mnx, 1000.25, 2000.25, "EPSG:2154", output_float_tif, 0.5)
+
+    with rasterio.open(output_tif) as f:
+        assert f.dtypes[0] == "int16"
+        assert f.scales == (0.01, 0.01)
+        assert f.transform == rasterio.transform.from_origin(1000, 2000.5, 0.5, 0.5)
+    assert output_tif.stat().st_size < output_float_tif.stat().st_size / 2
+
+    # quantized rasters are decoded when they are read by the relative metric
+    raster = malt0_relative.read_raster_with_nan(output_tif)
+    expected = malt0_relative.read_raster_with_nan(output_float_tif)
+    assert np.array_equal(np.isnan(raster), mnx == -9999)
+    assert np.allclose(raster[~np.isnan(raster)], expected[~np.isnan(expected)], atol=0.005 + 1e-4)
+
+
+def test_write_mnx_map_empty_layers():
+    mnx = np.full((3, 300, 400), -9999, dtype=np.float32)
+    mnx[0, 10:20, 10:30] = 12.5
+    mnx[2, 299, 399] = 3
+    output_tif = TMP_PATH / "unit_test_write_mnx_map_empty_layers.tif"
+
+    malt0_intrinsic.write_mnx_map(mnx, 1000.25, 2000.25, "EPSG:2154", output_tif, 0.5)
+
+    assert list(read_empty_layers(output_tif)) == [False, True, False]
+    with rasterio.open(output_tif) as f:
+        assert np.array_equal(read_dense_layers(f), mnx)
@@ -8,9 +8,12 @@ import numpy as np
 import numpy.ma as ma
 import pandas as pd
 import pytest
+import rasterio
 
 from coclico.config import csv_separator
+from coclico.io import write_raster
 from coclico.malt0 import malt0_relative
+from coclico.metrics.commons import read_sparse_layers, tag_empty_layers
 
 pytestmark = pytest.mark.docker
 
@@ -90,12 +93,236 @@ def test_update_overall_stats():
     # is ok as long as std is the same between the 2 methods
 
 
+def test_compute_stats_single_raster_nan_blocks(monkeypatch):
+    rng = np.random.default_rng(0)
+    raster = rng.uniform(0, 10, (3, 20, 30)).astype(np.float32)
+    mask = rng.uniform(0, 1, raster.shape) < 0.3
+    mask[2] = True  # layer without values
+    expected_max = ma.max(ma.masked_array(raster, mask), axis=(1, 2)).filled(0)
+    expected_mean = ma.mean(ma.masked_array(raster.astype(np.float64), mask), axis=(1, 2)).filled(0)
+    expected_std = ma.std(ma.masked_array(raster.astype(np.float64), mask), axis=(1, 2)).filled(0)
+
+    # several blocks per layer, with a last block that is smaller than the others
+    monkeypatch.setattr(malt0_relative, "STATS_BLOCK_SIZE", 64)
+    nan_raster = np.where(mask, np.nan, raster)
+    max_val, count, mean_val, std_val, m2 = malt0_relative.compute_stats_single_raster(nan_raster)
+
+    assert np.allclose(max_val, expected_max)
+    assert np.array_equal(count, np.count_nonzero(~mask, axis=(1, 2)))
+    assert np.allclose(mean_val, expected_mean)
+    assert np.allclose(std_val, expected_std)
+    assert np.allclose(m2, expected_std**2 * count)
+    assert (max_val[2], count[2], mean_val[2], std_val[2], m2[2]) == (0, 0, 0, 0, 0)
+
+
+def test_compute_quantiles_from_histogram():
+    rng = np.random.default_rng(0)
+    raster = rng.exponential(1, (3, 40, 50)).astype(np.float32)
+    raster[1, :, :10] = np.nan
+    raster[2] = np.nan  # layer without values
+    quantiles = (50, 90, 99)
+
+    histogram = malt0_relative.compute_histogram_single_raster(raster)
+    max_val = np.nanmax(raster[:2], axis=(1, 2))
+    out = malt0_relative.compute_quantiles_from_histogram(histogram, np.append(max_val, 0), quantiles)
+
+    assert histogram.shape == (3, malt0_relative.DIFF_HISTOGRAM_NB_BINS)
+    assert np.array_equal(histogram.sum(axis=1), np.count_nonzero(~np.isnan(raster), axis=(1, 2)))
+    assert out.shape == (3, 3)
+    expected = np.nanpercentile(raster[:2], quantiles, axis=(1, 2)).T
+    assert np.allclose(out[:2], expected, atol=malt0_relative.DIFF_HISTOGRAM_BIN_SIZE)
+    assert np.all(out[2] == 0)
+
+
+def test_compute_quantiles_from_histogram_merge():
+    rng = np.random.default_rng(1)
+    rasters = [rng.uniform(0, 5, (2, 10, 10)).astype(np.float32) for _ in range(3)]
+    rasters[1][0] = np.nan
+    quantiles = (50, 90, 99)
+
+    total_histogram = sum(malt0_relative.compute_histogram_single_raster(r) for r in rasters)
+    raster = np.concatenate(rasters, axis=1)
+    histogram = malt0_relative.compute_histogram_single_raster(raster)
+    assert np.array_equal(total_histogram, histogram)
+
+    max_val = np.nanmax(raster, axis=(1, 2))
+    out = malt0_relative.compute_quantiles_from_histogram(total_histogram, max_val, quantiles)
+    expected = np.nanpercentile(raster, quantiles, axis=(1, 2)).T
+    assert np.allclose(out, expected, atol=malt0_relative.DIFF_HISTOGRAM_BIN_SIZE)
+
+
+def test_compute_quantiles_from_histogram_overflow():
+    raster = np.array([[[0.5, 1, 1000, 2000]]], dtype=np.float32)
+    histogram = malt0_relative.compute_histogram_single_raster(raster, bin_size=0.01, nb_bins=1000)
+    assert histogram[0, -1] == 2
+
+    out = malt0_relative.compute_quantiles_from_histogram(histogram, np.array([2000]), (25, 99), bin_size=0.01)
+    assert np.allclose(out, [[0.5, 2000]], atol=0.01)
+
+
+def test_read_raster_with_nan():
+    raster_file = TMP_PATH / "unit_test_read_raster_with_nan.tif"
+    raster_file.parent.mkdir(parents=True, exist_ok=True)
+    data = np.array([[[1, -9999], [3, 4]]], dtype=np.float32)
+    with rasterio.open(
+        raster_file, "w", driver="GTiff", height=2, width=2, count=1, dtype="float32", nodata=-9999
+    ) as f:
+        f.write(data)
+
+    raster = malt0_relative.read_raster_with_nan(raster_file)
+
+    assert raster.dtype == np.float32
+    assert np.isnan(raster[0, 0, 1])
+    assert np.array_equal(raster[~np.isnan(raster)], [1, 3, 4])
+
+
+def generate_mnx_rasters(out_dir: Path, nb_tiles: int, nb_classes: int, seed: int):
+    rng = np.random.default_rng(seed)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for ii in range(nb_tiles):
+        data = rng.uniform(0, 10, (nb_classes, 20, 30)).astype(np.float32)
+        data[rng.uniform(0, 1, data.shape) < 0.2] = -9999
+        with rasterio.open(
+            out_dir / f"tile_{ii}.tif",
+            "w",
+            driver="GTiff",
+            height=20,
+            width=30,
+            count=nb_classes,
+            dtype="float32",
+            crs="EPSG:2154",
+            nodata=-9999,
+            transform=rasterio.transform.from_origin(1000 + 15 * ii, 2000, 0.5, 0.5),
+        ) as f:
+            f.write(data)
+
+
+def test_compute_metric_relative_output_diff():
+    c1_dir = TMP_PATH / "output_diff" / "c1"
+    ref_dir = TMP_PATH / "output_diff" / "ref"
+    output_diff_dir = TMP_PATH / "output_diff" / "diff"
+    generate_mnx_rasters(c1_dir, nb_tiles=3, nb_classes=6, seed=0)
+    generate_mnx_rasters(ref_dir, nb_tiles=3, nb_classes=6, seed=1)
+
+    malt0_relative.compute_metric_relative(
+        c1_dir,
+        ref_dir,
+        CONFIG_FILE_METRICS,
+        TMP_PATH / "output_diff" / "result.csv",
+        TMP_PATH / "output_diff" / "result_tile.csv",
+        output_diff_dir=output_diff_dir,
+    )
+
+    df = pd.read_csv(TMP_PATH / "output_diff" / "result_tile.csv", sep=csv_separator, dtype={"class": str})
+    for ii in range(3):
+        c1_raster = malt0_relative.read_raster_with_nan(c1_dir / f"tile_{ii}.tif")
+        ref_raster = malt0_relative.read_raster_with_nan(ref_dir / f"tile_{ii}.tif")
+        expected_diff = np.abs(c1_raster - ref_raster)
+        with rasterio.open(output_diff_dir / f"tile_{ii}.tif") as f:
+            assert f.profile["tiled"]
+            assert f.transform == rasterio.transform.from_origin(1000 + 15 * ii, 2000, 0.5, 0.5)
+            assert f.descriptions[0] == "0"
+            diff = f.read(masked=True)
+        assert np.array_equal(diff.mask, np.isnan(expected_diff))
+        assert np.allclose(diff.compressed(), expected_diff[~np.isnan(expected_diff)])
+        tile_max_diff = df[df["tile"] == f"tile_{ii}"]["max_diff"].to_numpy()
+        assert np.allclose(tile_max_diff, np.nanmax(expected_diff, axis=(1, 2)))
+
+    with rasterio.open(output_diff_dir / "diff.vrt") as f:
+        assert f.count == 6
+        assert f.width == 60
+        assert f.height == 20
+
+
+def test_compute_metric_relative_empty_layers():
+    # same rasters, with layers without values that are flagged as empty (as written by malt0 intrinsic) or not
+    empty_layers = {
+        ("c1", "tile_0"): [True, False, False, False, False, True],
+        ("ref", "tile_0"): [False, True, False, False, False, True],
+        ("ref", "tile_1"): [True, True, True, True, True, True],
+    }
+    results = {}
+    for flagged in [True, False]:
+        out_dir = TMP_PATH / "empty_layers" / ("flagged" if flagged else "not_flagged")
+        generate_mnx_rasters(out_dir / "c1", nb_tiles=2, nb_classes=6, seed=0)
+        generate_mnx_rasters(out_dir / "ref", nb_tiles=2, nb_classes=6, seed=1)
+        for (name, tile), layers in empty_layers.items():
+            with rasterio.open(out_dir / name / f"{tile}.tif", "r+") as f:
+                for ii in np.flatnonzero(layers):
+                    f.write(np.full((20, 30), -9999, dtype=np.float32), int(ii) + 1)
+                if flagged:
+                    tag_empty_layers(f, np.array(layers))
+
+        malt0_relative.compute_metric_relative(
+            out_dir / "c1", out_dir / "ref", CONFIG_FILE_METRICS, out_dir / "result.csv", out_dir / "result_tile.csv"
+        )
+        df_tile = pd.read_csv(out_dir / "result_tile.csv", sep=csv_separator)
+        results[flagged] = (
+            pd.read_csv(out_dir / "result.csv", sep=csv_separator),
+            df_tile.sort_values(["tile", "class"], ignore_index=True),
+        )
+
+    assert results[True][0].equals(results[False][0])
+    assert results[True][1].equals(results[False][1])
+
+
+def test_compute_metric_relative_sparse_layers():
+    # same rasters, stored with or without lists of pixels for the layers with few pixels with values
+    rng = np.random.default_rng(0)
+    rasters = {}
+    for name in ["c1", "ref"]:
+        for ii in range(2):
+            data = rng.uniform(0, 10, (6, 20, 30)).astype(np.float32)
+            occupancy = np.array([0.8, 0.03, 0.03, 0.03, 0.8, 0])[:, None, None]
+            data[rng.uniform(0, 1, data.shape) >= occupancy] = -9999
+            rasters[(name, ii)] = data
+    rasters[("ref", 1)][3] = rasters[("c1", 1)][3] + 1  # same pixels in c1 and ref
+
+    results = {}
+    for sparse_max_occupancy in [0, 0.05]:
+        out_dir = TMP_PATH / "sparse_layers" / str(sparse_max_occupancy)
+        for (name, ii), data in rasters.items():
+            write_raster(
+                data,
+                out_dir / name / f"tile_{ii}.tif",
+                rasterio.transform.from_origin(1000 + 15 * ii, 2000, 0.5, 0.5),
+                "EPSG:2154",
+                nodata=-9999,
+                sparse_max_occupancy=sparse_max_occupancy,
+                sparse_values=True,
+            )
+
+        malt0_relative.compute_metric_relative(
+            out_dir / "c1",
+            out_dir / "ref",
+            CONFIG_FILE_METRICS,
+            out_dir / "result.csv",
+            out_dir / "result_tile.csv",
+            output_diff_dir=out_dir / "diff",
+        )
+        df_tile = pd.read_csv(out_dir / "result_tile.csv", sep=csv_separator)
+        results[sparse_max_occupancy] = (
+            pd.read_csv(out_dir / "result.csv", sep=csv_separator),
+            df_tile.sort_values(["tile", "class"], ignore_index=True),
+        )
+
+    assert len(read_sparse_layers(TMP_PATH / "sparse_layers" / "0.05" / "c1" / "tile_0.tif")) == 3
+    pd.testing.assert_frame_equal(results[0][0], results[0.05][0])
+    pd.testing.assert_frame_equal(results[0][1], results[0.05][1])
+    assert results[0][1]["max_diff"].iloc[6 + 3] == pytest.approx(1)  # tile_1, class "3_4"
+    for ii in range(2):
+        with rasterio.open(TMP_PATH / "sparse_layers" / "0" / "diff" / f"tile_{ii}.tif") as f:
+            diff = f.read()
+        with rasterio.open(TMP_PATH / "sparse_layers" / "0.05" / "diff" / f"tile_{ii}.tif") as f:
+            assert np.array_equal(f.read(), diff)
+
+
 def test_compute_metric_relative(ensure_malt0_data):
     c1_dir = Path("./data/malt0/c1/intrinsic/mnx")
     ref_dir = Path("./data/malt0/ref/intrinsic/mnx")
     output_csv = TMP_PATH / "relative" / "result.csv"
     output_csv_tile = TMP_PATH / "relative" / "result_tile.csv"
-    expected_cols = {"class", "max_diff", "mean_diff", "std_diff"}
+    expected_cols = {"class", "max_diff", "mean_diff", "std_diff", "p50_diff", "p90_diff", "p99_diff"}
 
     malt0_relative.compute_metric_relative(c1_dir, ref_dir, CONFIG_FILE_METRICS, output_csv, output_csv_tile)
 
@@ -109,6 +336,10 @@ def test_compute_metric_relative(ensure_malt0_data):
     assert set(df.columns) == expected_cols
     # Check that there is no pixel with -9999 used as a value
     assert (df["max_diff"].abs() < 1000).all()
+    # Check that the percentiles are consistent with the max
+    assert (df["p50_diff"] <= df["p90_diff"]).all()
+    assert (df["p90_diff"] <= df["p99_diff"]).all()
+    assert (df["p99_diff"] <= df["max_diff"]).all()
 
     expected_rows = 6  # 6 classes
     assert utils.csv_num_rows(output_csv) == expected_rows
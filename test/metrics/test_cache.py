@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from coclico.metrics.cache import LRUCache
+
+
+def test_lru_cache_eviction():
+    cache = LRUCache(max_bytes=300)
+    cache.put("a", np.zeros(100, dtype=np.uint8))
+    cache.put("b", np.zeros(100, dtype=np.uint8))
+    cache.put("c", (np.zeros(50, dtype=np.uint8), np.zeros(50, dtype=np.uint8)))
+    assert cache.nbytes == 300
+
+    cache.get("a")  # "b" is now the least recently used value
+    cache.put("d", np.zeros(100, dtype=np.uint8))
+
+    assert "b" not in cache
+    assert all(key in cache for key in ["a", "c", "d"])
+    assert cache.nbytes == 300
+
+    # values that are larger than the whole budget are not cached
+    cache.put("e", np.zeros(301, dtype=np.uint8))
+    assert "e" not in cache
+    assert len(cache) == 3
+
+    # replacing a value updates the memory usage
+    cache.put("a", np.zeros(10, dtype=np.uint8))
+    assert cache.nbytes == 210
+
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.nbytes == 0
+    assert cache.get("a") is None
+
+
+def test_lru_cache_read_only():
+    cache = LRUCache(max_bytes=1000)
+    cache.put("a", np.zeros(10))
+
+    with pytest.raises(ValueError):
+        cache.get("a")[0] = 1
+
+
+def test_lru_cache_copies_values():
+    cache = LRUCache(max_bytes=1000)
+    stack = np.zeros((4, 50), dtype=np.uint8)
+    cache.put("a", stack[0])
+    cache.put("b", (stack[1], 3))
+
+    # the caller's arrays are not frozen, and the cached values are not views of them
+    stack[0, 0] = 1
+    assert cache.get("a")[0] == 0
+    assert cache.get("a").base is None
+    assert cache.get("b")[0].base is None
+    assert cache.get("b")[1] == 3
+    assert cache.nbytes == 100
@@ -1,8 +1,14 @@
+import logging
+from pathlib import Path
+
 import numpy as np
 import pytest
+import rasterio
 
 import coclico.metrics.commons
 
+TMP_PATH = Path("./tmp/metrics_commons")
+
 affine_func_data = [
     ((1, 3), (2, 1), np.array([0, 1, 1.5, 1.75, 2, 3]), np.array([3, 3, 2, 1.5, 1, 1])),
     ((1, 0), (5, 2), np.array([-1, 1, 2, 4, 5, 12]), np.array([0, 0, 0.5, 1.5, 2, 2])),
@@ -12,3 +18,112 @@ affine_func_data = [
 @pytest.mark.parametrize("coord_min,coord_max,x_query,y_query", affine_func_data)
 def test_bounded_affine_function(coord_min, coord_max, x_query, y_query):
     assert np.all(coclico.metrics.commons.bounded_affine_function(coord_min, coord_max, x_query) == y_query)
+
+
+def test_create_class_bitmask_lut():
+    lut = coclico.metrics.commons.create_class_bitmask_lut(["1", "3_4", "4_5"])
+    assert lut.shape == (256,)
+    assert lut.dtype == np.uint8
+    assert lut[1] == 0b001
+    assert lut[3] == 0b010
+    assert lut[4] == 0b110
+    assert lut[5] == 0b100
+    assert np.count_nonzero(lut) == 4
+
+
+def test_create_class_bitmask_lut_many_classes():
+    lut = coclico.metrics.commons.create_class_bitmask_lut([str(ii) for ii in range(40)])
+    assert lut.dtype == np.uint64
+    assert lut[39] == np.uint64(1) << np.uint64(39)
+
+    with pytest.raises(ValueError):
+        coclico.metrics.commons.create_class_bitmask_lut([str(ii) for ii in range(65)])
+
+
+def test_count_points_by_class():
+    classifs = np.array([1, 2, 2, 3, 255, 2, 1], dtype=np.uint8)
+    counts = coclico.metrics.commons.count_points_by_class([classifs[:3], classifs[3:], classifs[:0]])
+    assert counts.shape == (256,)
+    assert counts[1] == 2
+    assert counts[2] == 3
+    assert counts[3] == 1
+    assert counts[255] == 1
+    assert np.sum(counts) == len(classifs)
+
+
+def test_merge_counts_by_class():
+    counts = np.zeros(256, dtype=np.int64)
+    counts[[1, 2, 3, 4, 5, 64]] = [10, 20, 30, 40, 50, 60]
+    merged = coclico.metrics.commons.merge_counts_by_class(counts, ["0", "1", "3_4_5", "3_4", "64", "9"])
+    assert list(merged) == [0, 10, 120, 70, 60, 0]
+
+
+def test_log_duration(caplog):
+    with caplog.at_level(logging.DEBUG):
+        with coclico.metrics.commons.log_duration("Test stage"):
+            pass
+
+    assert len(caplog.records) == 1
+    assert caplog.records[0].message.startswith("Test stage: ")
+    assert caplog.records[0].message.endswith("s")
+
+
+def test_tag_and_read_empty_layers():
+    raster_file = TMP_PATH / "unit_test_empty_layers.tif"
+    raster_file.parent.mkdir(parents=True, exist_ok=True)
+    with rasterio.open(raster_file, "w", driver="GTiff", height=2, width=2, count=3, dtype="uint8") as f:
+        f.write(np.zeros((3, 2, 2), dtype=np.uint8))
+        coclico.metrics.commons.tag_empty_layers(f, np.array([True, False, True]))
+
+    assert list(coclico.metrics.commons.read_empty_layers(raster_file)) == [True, False, True]
+
+
+def test_tag_and_read_sparse_layers():
+    raster_file = TMP_PATH / "unit_test_sparse_layers.tif"
+    raster_file.parent.mkdir(parents=True, exist_ok=True)
+    raster = np.full((3, 20, 30), -9999, dtype=np.int16)
+    raster[0] = 5  # dense layer
+    raster[1, [0, 3, 19], [2, 0, 29]] = [10, -20, 30]  # sparse layer, layer 2 is empty
+    with rasterio.open(raster_file, "w", driver="GTiff", height=20, width=30, count=3, dtype="int16") as f:
+        f.write(raster)
+        f.scales = [0.1] * 3
+        f.offsets = [100] * 3
+        is_sparse = coclico.metrics.commons.tag_sparse_layers(f, raster, -9999, 0.01, store_values=True)
+
+    assert list(is_sparse) == [False, True, False]
+    sparse_layers = coclico.metrics.commons.read_sparse_layers(raster_file)
+    assert list(sparse_layers.keys()) == [1]
+    indices, values = sparse_layers[1]
+    assert list(indices) == [2, 90, 599]
+    assert values == pytest.approx([101, 98, 103])
+
+
+def test_read_dense_layers():
+    raster_file = TMP_PATH / "unit_test_read_dense_layers.tif"
+    raster_file.parent.mkdir(parents=True, exist_ok=True)
+    raster = np.zeros((3, 20, 30), dtype=np.uint8)
+    raster[0] = 1  # dense layer
+    raster[1, [0, 3, 19], [2, 0, 29]] = 1  # sparse layers
+    raster[2, 5, 5] = 1
+    with rasterio.open(raster_file, "w", driver="GTiff", height=20, width=30, count=3, dtype="uint8") as f:
+        is_sparse = coclico.metrics.commons.tag_sparse_layers(f, raster, 0, 0.01)
+        # only the dense layer is written
+        f.write(raster[0], 1)
+
+    assert list(is_sparse) == [False, True, True]
+    with rasterio.open(raster_file) as f:
+        assert not np.any(f.read(2))
+        assert np.array_equal(coclico.metrics.commons.read_dense_layers(f), raster)
+        assert np.array_equal(coclico.metrics.commons.read_dense_layers(f, [3, 1]), raster[[2, 0]])
+        assert coclico.metrics.commons.read_dense_layers(f, [], out_dtype=np.float32).shape == (0, 20, 30)
+
+
+def test_intersect_sorted_indices():
+    indices_a = np.array([1, 5, 7, 30, 31])
+    indices_b = np.array([0, 5, 30, 40])
+    positions_a, positions_b = coclico.metrics.commons.intersect_sorted_indices(indices_a, indices_b)
+    assert list(positions_a) == [1, 3]
+    assert list(positions_b) == [1, 2]
+    positions_b, positions_a = coclico.metrics.commons.intersect_sorted_indices(indices_b, indices_a)
+    assert list(positions_a) == [1, 3]
+    assert list(positions_b) == [1, 2]
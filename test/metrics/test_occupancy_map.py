@@ -6,7 +6,27 @@ import pytest
 import rasterio
 from pdaltools.las_info import las_info_metadata
 
-from coclico.metrics.occupancy_map import create_occupancy_map
+from coclico.io import LasPoints
+from coclico.metrics.cache import LRUCache
+from coclico.metrics.commons import (
+    get_raster_geometry_from_las_bounds,
+    read_dense_layers,
+    read_empty_layers,
+)
+from coclico.metrics.occupancy_map import (
+    _create_2d_occupancy_array,
+    compute_flat_pixel_indices,
+    compute_flat_pixel_indices_from_records,
+    create_occupancy_map,
+    create_occupancy_map_array,
+    create_occupancy_map_array_from_chunks,
+    create_occupancy_map_array_from_points,
+    get_class_points_indices,
+    get_empty_classes,
+    get_integer_grid_geometry,
+    get_occupancy_map_array,
+    write_occupancy_map,
+)
 
 pytestmark = pytest.mark.docker
 
@@ -34,7 +54,7 @@ def test_create_multilayer_2d_occupancy_map(ensure_test1_data):
     assert output_tif.exists()
     with rasterio.Env():
         with rasterio.open(output_tif) as f:
-            output_data = f.read()
+            output_data = read_dense_layers(f)
             output_bounds = f.bounds
 
     # check that las extent is comprised inside tif extent but tif has no border pixels
@@ -56,3 +76,195 @@ def test_create_multilayer_2d_occupancy_map(ensure_test1_data):
     # all other classes have data, so their layers should not contain only zeroes
     for ii in range(1, len(class_weights.keys())):
         assert np.any(output_data[ii, :, :] == 1)
+
+
+def test_create_2d_occupancy_array_same_as_loop():
+    rng = np.random.default_rng(42)
+    pixel_size = 0.5
+    xs = np.round(770000 + rng.uniform(0, 100, 10000), 2)
+    ys = np.round(6278000 + rng.uniform(0, 100, 10000), 2)
+    # add points on the pixels borders and on the map extremities
+    xs = np.concatenate([xs, np.arange(770000, 770100, 0.25), [np.min(xs), np.max(xs)]])
+    ys = np.concatenate([ys, np.arange(6278000, 6278100, 0.25), [np.max(ys), np.min(ys)]])
+    top_left, nb_pixels = get_raster_geometry_from_las_bounds(
+        (np.min(xs), np.min(ys), np.max(xs), np.max(ys)), pixel_size
+    )
+    x_min, y_max = top_left
+
+    expected = np.zeros((nb_pixels[1], nb_pixels[0]), dtype=bool)
+    for x, y in zip(xs, ys):
+        grid_x = min(int((x - (x_min - pixel_size / 2)) / pixel_size), nb_pixels[0] - 1)
+        grid_y = min(int(((y_max + pixel_size / 2) - y) / pixel_size), nb_pixels[1] - 1)
+        expected[grid_y, grid_x] = True
+
+    grid = _create_2d_occupancy_array(xs, ys, pixel_size, x_min, y_max, nb_pixels)
+
+    assert grid.dtype == bool
+    assert np.array_equal(grid, expected)
+
+
+def generate_las_points(nb_points: int = 10000, seed: int = 42) -> LasPoints:
+    """Generate random points as read from a las file with scale 0.01 (including points on the pixels borders)"""
+    rng = np.random.default_rng(seed)
+    X = np.concatenate([rng.integers(0, 10000, nb_points), np.arange(0, 10000, 25)]).astype(np.int32)
+    Y = np.concatenate([rng.integers(0, 10000, nb_points), np.arange(10000, 0, -25)]).astype(np.int32)
+    classifs = rng.choice([1, 2, 3, 4, 6], len(X)).astype(np.uint8)
+
+    return LasPoints(X, Y, None, classifs, np.array([0.01, 0.01, 0.01]), np.array([770000.0, 6278000.0, 0.0]), None)
+
+
+def test_create_occupancy_map_array_from_chunks_same_as_single_read():
+    pixel_size = 0.5
+    points = generate_las_points()
+    class_weights = {"1": 1, "2": 1, "3_4": 1, "5": 1}
+    las_bounds = (np.min(points.xs), np.min(points.ys), np.max(points.xs), np.max(points.ys))
+
+    expected_maps, expected_x_min, expected_y_max = create_occupancy_map_array_from_points(
+        points, pixel_size, class_weights
+    )
+    chunks = [
+        points._replace(X=points.X[start:end], Y=points.Y[start:end], classification=points.classification[start:end])
+        for start, end in zip(range(0, points.nb_points, 999), range(999, points.nb_points + 999, 999))
+    ]
+    binary_maps, x_min, y_max = create_occupancy_map_array_from_chunks(chunks, las_bounds, pixel_size, class_weights)
+
+    assert (x_min, y_max) == (expected_x_min, expected_y_max)
+    assert np.array_equal(binary_maps, expected_maps)
+    # class 5 has no points
+    assert np.all(binary_maps[3] == 0)
+
+
+def test_create_occupancy_map_array_from_points_same_as_per_class():
+    pixel_size = 0.5
+    points = generate_las_points()
+    class_weights = {"1": 1, "2": 1, "3_4": 1, "4_6": 1, "5": 1}
+
+    binary_maps, x_min, y_max = create_occupancy_map_array_from_points(points, pixel_size, class_weights)
+
+    nb_pixels = (binary_maps.shape[2], binary_maps.shape[1])
+    for binary_map, class_key in zip(binary_maps, sorted(class_weights.keys())):
+        in_class = np.isin(points.classification, [int(c) for c in class_key.split("_")])
+        expected = _create_2d_occupancy_array(
+            points.xs[in_class], points.ys[in_class], pixel_size, x_min, y_max, nb_pixels
+        )
+        assert np.array_equal(binary_map, expected)
+
+
+def test_compute_flat_pixel_indices_from_records_same_as_float():
+    pixel_size = 0.5
+    points = generate_las_points()
+    xs, ys = points.xs, points.ys
+    top_left, nb_pixels = get_raster_geometry_from_las_bounds(
+        (np.min(xs), np.min(ys), np.max(xs), np.max(ys)), pixel_size
+    )
+    integer_geometry = get_integer_grid_geometry(points.scales, points.offsets, pixel_size, *top_left)
+    assert integer_geometry == (-25, 10025, 50)
+
+    flat_indices = compute_flat_pixel_indices_from_records(points.X, points.Y, *integer_geometry, nb_pixels)
+    expected = compute_flat_pixel_indices(xs, ys, pixel_size, *top_left, nb_pixels)
+
+    assert np.array_equal(flat_indices, expected)
+
+
+def test_create_occupancy_map_array_from_points_same_as_float():
+    pixel_size = 0.5
+    class_weights = {"1": 1, "2": 1, "3_4": 1, "5": 1}
+    for offsets in [(770000.0, 6278000.0, 0.0), (770000.003, 6278000.0, 0.0)]:  # integer and float gridding
+        points = generate_las_points()._replace(offsets=np.array(offsets))
+
+        binary_maps, x_min, y_max = create_occupancy_map_array_from_points(points, pixel_size, class_weights)
+        expected_maps, expected_x_min, expected_y_max = create_occupancy_map_array(
+            points.xs, points.ys, points.classification, pixel_size, class_weights
+        )
+
+        assert (x_min, y_max) == (expected_x_min, expected_y_max)
+        assert np.array_equal(binary_maps, expected_maps)
+
+
+def test_get_occupancy_map_array_uses_cache():
+    pixel_size = 0.5
+    points = generate_las_points()
+    cache = LRUCache()
+
+    binary_maps, x_min, y_max = get_occupancy_map_array("tile", points, pixel_size, {"1": 1, "3_4": 1}, cache)
+    expected_maps, expected_x_min, expected_y_max = create_occupancy_map_array_from_points(
+        points, pixel_size, {"1": 1, "3_4": 1}
+    )
+    assert (x_min, y_max) == (expected_x_min, expected_y_max)
+    assert np.array_equal(binary_maps, expected_maps)
+    assert len(cache) == 3  # grid geometry + 2 maps
+
+    # maps that are already in the cache are reused, only the missing ones are computed
+    binary_maps, _, _ = get_occupancy_map_array("tile", points, pixel_size, {"1": 1, "2": 1, "3_4": 1}, cache)
+    expected_maps, _, _ = create_occupancy_map_array_from_points(points, pixel_size, {"1": 1, "2": 1, "3_4": 1})
+    assert np.array_equal(binary_maps, expected_maps)
+    assert len(cache) == 4
+    # each cached map is stored in its own array, which is counted in the cache budget
+    assert cache.nbytes == binary_maps.nbytes
+    assert cache.get(("occupancy_map", "tile", "2", pixel_size, (x_min, y_max))).base is None
+
+    # cached maps are read-only, but the returned array can be modified
+    binary_maps[:] = 0
+    binary_maps, _, _ = get_occupancy_map_array("tile", points, pixel_size, {"1": 1, "2": 1, "3_4": 1}, cache)
+    assert np.array_equal(binary_maps, expected_maps)
+
+
+def test_get_class_points_indices():
+    points = generate_las_points()
+    cache = LRUCache()
+    indices = get_class_points_indices("tile", points, "3_4", cache)
+
+    assert np.array_equal(indices, np.flatnonzero(np.isin(points.classification, [3, 4])))
+    assert get_class_points_indices("tile", points, "3_4", cache) is indices
+
+
+def test_get_empty_classes():
+    points = generate_las_points()
+    points.classification[points.classification == 2] = 1
+    cache = LRUCache()
+
+    empty_classes = get_empty_classes("tile", points, ["1", "2", "2_3", "9"], cache)
+    assert list(empty_classes) == [False, True, False, True]
+    assert len(cache) == 1
+
+
+def test_write_occupancy_map_empty_layers():
+    binary_maps = np.zeros((3, 300, 400), dtype=np.uint8)
+    binary_maps[0, 10:20, 10:30] = 1
+    binary_maps[2, 299, 399] = 1
+    output_tif = TMP_PATH / "unit_test_write_occupancy_map_empty_layers.tif"
+
+    write_occupancy_map(binary_maps, 1000.25, 2000.25, "EPSG:2154", output_tif, 0.5)
+
+    assert list(read_empty_layers(output_tif)) == [False, True, False]
+    with rasterio.open(output_tif) as f:
+        assert f.tags(1, "IMAGE_STRUCTURE")["NBITS"] == "1"  # 1 bit per pixel
+        assert np.array_equal(read_dense_layers(f), binary_maps)
+
+
+def test_get_integer_grid_geometry_not_possible():
+    # offset that is not a multiple of the scale
+    assert get_integer_grid_geometry(np.array([0.01, 0.01, 0.01]), np.array([0.003, 0, 0]), 0.5, 0, 100) is None
+    # pixel size that is not a multiple of the scale
+    assert get_integer_grid_geometry(np.array([0.03, 0.03, 0.01]), np.array([0, 0, 0]), 0.5, 0, 100) is None
+
+
+def test_create_occupancy_map_chunked(ensure_test1_data):
+    las_file = Path("./data/test1/niv1/tile_splitted_2818_32247.laz")
+    pixel_size = 0.5
+    class_weights = {"1": 1, "2": 0, "3_4_5": 1}
+    output_tif = TMP_PATH / "unit_test_occupancy_map_full.tif"
+    output_tif_chunked = TMP_PATH / "unit_test_occupancy_map_chunked.tif"
+    create_occupancy_map(las_file, class_weights, output_tif, pixel_size=pixel_size)
+    create_occupancy_map(las_file, class_weights, output_tif_chunked, pixel_size=pixel_size, chunk_size=10000)
+
+    with rasterio.Env():
+        with rasterio.open(output_tif) as f:
+            expected_data = read_dense_layers(f)
+            expected_transform = f.transform
+        with rasterio.open(output_tif_chunked) as f:
+            output_data = read_dense_layers(f)
+            output_transform = f.transform
+
+    assert output_transform == expected_transform
+    assert np.array_equal(output_data, expected_data)
@@ -36,6 +36,23 @@ def test_create_object_array():
     assert np.all(obj_array == expected_raster)
 
 
+def test_create_objects_array_from_binary_maps_empty_layers():
+    rng = np.random.default_rng(0)
+    binary_maps = (rng.uniform(0, 1, (3, 50, 60)) < 0.5).astype(np.uint8)
+    binary_maps[1] = 0
+    class_weights = {"1": 1, "2": 1, "3": 1}
+
+    obj_array = mobj0_intrinsic.create_objects_array_from_binary_maps(binary_maps, class_weights, 3)
+    skipped_obj_array = mobj0_intrinsic.create_objects_array_from_binary_maps(
+        binary_maps, class_weights, 3, np.array([False, True, False])
+    )
+
+    assert np.array_equal(obj_array, skipped_obj_array)
+    assert not np.any(obj_array[1])
+    gdf = mobj0_intrinsic.vectorize_occupancy_map(obj_array, crs="EPSG:2154", x_min=10, y_max=10, pixel_size=1)
+    assert set(gdf["layer"]) == {0, 2}
+
+
 def test_compute_metric_intrinsic(ensure_test1_data):
     las_file = Path("./data/test1/niv1/tile_splitted_2818_32247.laz")
     pixel_size = 0.5
@@ -29,6 +29,11 @@ def generate_metric_dataframes():
             "ref_pixel_count": [1000, 1000, 1000, 1000, 500, 500, 500, 500, 500],
             "union": [100, 100, 100, 100, 100, 100, 100, 200, 200],
             "intersection": [100, 95, 90, 85, 95, 80, 40, 100, 50],
+            "intersection_2m": [10, 10, 10, 10, 10, 10, 5, 20, 10],
+            "union_2m": [10, 10, 10, 10, 10, 10, 10, 20, 20],
+            "iou_2m": [1, 1, 1, 1, 1, 1, 0.5, 1, 0.5],
+            "intersection_buffer_1px": [100, 100, 95, 90, 100, 90, 60, 150, 80],
+            "iou_buffer_1px": [1, 1, 0.95, 0.9, 1, 0.9, 0.6, 0.75, 0.4],
         }
     )
 
@@ -4,11 +4,14 @@ import subprocess as sp
 from pathlib import Path
 from test import utils
 
+import numpy as np
 import pandas as pd
 import pytest
 import rasterio
 
 from coclico.config import csv_separator
+from coclico.metrics.commons import read_sparse_layers
+from coclico.metrics.occupancy_map import write_occupancy_map
 from coclico.mpla0 import mpla0_relative
 
 pytestmark = pytest.mark.docker
@@ -49,6 +52,30 @@ def test_generate_sum_by_layer():
     }
 
 
+@pytest.mark.parametrize("use_bitwise_count", [True, False])
+def test_count_bits_by_layer(monkeypatch, use_bitwise_count):
+    if not use_bitwise_count:
+        monkeypatch.delattr(np, "bitwise_count", raising=False)
+    rng = np.random.default_rng(0)
+    c1_raster = (rng.uniform(0, 1, (3, 21, 37)) < 0.3).astype(np.uint8)  # width is not a multiple of 8
+    ref_raster = (rng.uniform(0, 1, (3, 21, 37)) < 0.5).astype(np.uint8)
+    layers = ["1", "2", "3"]
+
+    c1_packed = mpla0_relative.pack_layers(c1_raster)
+    ref_packed = mpla0_relative.pack_layers(ref_raster)
+
+    assert c1_packed.shape == (3, 21, 5)
+    assert mpla0_relative.count_bits_by_layer(c1_packed | ref_packed, layers) == mpla0_relative.generate_sum_by_layer(
+        np.logical_or(c1_raster, ref_raster), layers
+    )
+    assert mpla0_relative.count_bits_by_layer(c1_packed & ref_packed, layers) == mpla0_relative.generate_sum_by_layer(
+        np.logical_and(c1_raster, ref_raster), layers
+    )
+    assert mpla0_relative.count_bits_by_layer(ref_packed, layers) == mpla0_relative.generate_sum_by_layer(
+        ref_raster, layers
+    )
+
+
 def test_compute_metric_relative():
     c1_dir = Path("./data/mpla0/c1/intrinsic")
     ref_dir = Path("./data/mpla0/ref/intrinsic")
@@ -80,6 +107,212 @@ def test_compute_metric_relative():
     assert union_9 == 0
 
 
+def test_compute_metric_relative_empty_layers():
+    # same maps, with empty layers that are flagged (as written by mpla0 intrinsic) or not
+    rng = np.random.default_rng(0)
+    maps = {
+        (name, ii): (rng.uniform(0, 1, (6, 20, 30)) < 0.3).astype(np.uint8)
+        for name in ["c1", "ref"]
+        for ii in range(2)
+    }
+    maps[("c1", 0)][[0, 5]] = 0
+    maps[("ref", 0)][[1, 5]] = 0
+    maps[("ref", 1)][:] = 0
+
+    results = {}
+    for flagged in [True, False]:
+        out_dir = TMP_PATH / "empty_layers" / ("flagged" if flagged else "not_flagged")
+        for (name, ii), binary_maps in maps.items():
+            output_tif = out_dir / name / f"tile_{ii}.tif"
+            if flagged:
+                write_occupancy_map(binary_maps, 1000, 2000, "EPSG:2154", output_tif, 0.5)
+            else:
+                output_tif.parent.mkdir(parents=True, exist_ok=True)
+                with rasterio.open(
+                    output_tif, "w", driver="GTiff", height=20, width=30, count=6, dtype="uint8", crs="EPSG:2154"
+                ) as f:
+                    f.write(binary_maps)
+
+        mpla0_relative.compute_metric_relative(
+            out_dir / "c1", out_dir / "ref", CONFIG_FILE_METRICS, out_dir / "result.csv", out_dir / "result_tile.csv"
+        )
+        df_tile = pd.read_csv(out_dir / "result_tile.csv", sep=csv_separator)
+        results[flagged] = (
+            pd.read_csv(out_dir / "result.csv", sep=csv_separator),
+            df_tile.sort_values(["tile", "class"], ignore_index=True),
+        )
+
+    assert results[True][0].equals(results[False][0])
+    assert results[True][1].equals(results[False][1])
+
+
+def test_count_pixels_sparse_layer():
+    c1_indices = np.array([1, 5, 7, 30, 31])
+    ref_indices = np.array([0, 5, 30, 40])
+    assert mpla0_relative.count_pixels_sparse_layer(c1_indices, ref_indices) == (7, 2, 4)
+    assert mpla0_relative.count_pixels_sparse_layer(c1_indices, np.array([], dtype=np.int64)) == (5, 0, 0)
+
+
+def test_compute_metric_relative_sparse_layers():
+    # same maps, stored with or without lists of pixels for the layers with few pixels set
+    rng = np.random.default_rng(0)
+    occupancy = np.array([0.3, 0.02, 0.02, 0.02, 0.3, 0.3])[:, None, None]
+    maps = {
+        (name, ii): (rng.uniform(0, 1, (6, 20, 30)) < occupancy).astype(np.uint8)
+        for name in ["c1", "ref"]
+        for ii in range(2)
+    }
+    maps[("c1", 0)][5] = 0
+    maps[("ref", 0)][[2, 5]] = 0
+    maps[("ref", 1)][3] = maps[("c1", 1)][3]  # same sparse layer in c1 and ref
+    maps[("ref", 1)][4] = maps[("ref", 1)][1]  # sparse in ref only
+
+    results = {}
+    for sparse_max_occupancy in [0, 0.05]:
+        out_dir = TMP_PATH / "sparse_layers" / str(sparse_max_occupancy)
+        for (name, ii), binary_maps in maps.items():
+            output_tif = out_dir / name / f"tile_{ii}.tif"
+            write_occupancy_map(
+                binary_maps, 1000, 2000, "EPSG:2154", output_tif, 0.5, sparse_max_occupancy=sparse_max_occupancy
+            )
+
+        mpla0_relative.compute_metric_relative(
+            out_dir / "c1",
+            out_dir / "ref",
+            CONFIG_FILE_METRICS,
+            out_dir / "result.csv",
+            out_dir / "result_tile.csv",
+            pooled_pixel_sizes=(1, 2.5),
+        )
+        df_tile = pd.read_csv(out_dir / "result_tile.csv", sep=csv_separator)
+        results[sparse_max_occupancy] = (
+            pd.read_csv(out_dir / "result.csv", sep=csv_separator),
+            df_tile.sort_values(["tile", "class"], ignore_index=True),
+        )
+
+    assert len(read_sparse_layers(TMP_PATH / "sparse_layers" / "0.05" / "ref" / "tile_1.tif")) == 4
+    assert results[0][0].equals(results[0.05][0])
+    assert results[0][1].equals(results[0.05][1])
+
+
+def test_pool_layers():
+    raster = np.zeros((2, 5, 7), dtype=np.uint8)
+    raster[0, 0, 0] = 1
+    raster[0, 3, 5] = 1
+    raster[1, 4, 6] = 1
+    pooled = mpla0_relative.pool_layers(raster, 2)
+    assert pooled.shape == (2, 3, 4)
+    assert list(zip(*np.nonzero(pooled))) == [(0, 0, 0), (0, 1, 2), (1, 2, 3)]
+    assert mpla0_relative.pool_layers(raster, 1) is raster
+
+
+def test_pool_sparse_indices():
+    rng = np.random.default_rng(0)
+    layer = (rng.uniform(0, 1, (1, 23, 31)) < 0.05).astype(np.uint8)
+    for factor in [1, 2, 5]:
+        pooled_indices = mpla0_relative.pool_sparse_indices(np.flatnonzero(layer), 31, factor)
+        assert np.array_equal(pooled_indices, np.flatnonzero(mpla0_relative.pool_layers(layer, factor)))
+
+
+def test_get_pooling_factors():
+    assert mpla0_relative.get_pooling_factors(0.5, (1, 2, 5, 2.5)) == [2, 4, 10, 5]
+    with pytest.raises(ValueError):
+        mpla0_relative.get_pooling_factors(0.5, (1.2,))
+
+
+def test_compute_metric_relative_pooled():
+    rng = np.random.default_rng(0)
+    occupancy = np.array([0.3, 0.02, 0.02, 0.3, 0.3, 0])[:, None, None]
+    maps = {name: (rng.uniform(0, 1, (6, 20, 30)) < occupancy).astype(np.uint8) for name in ["c1", "ref"]}
+    out_dir = TMP_PATH / "pooled"
+    for name, binary_maps in maps.items():
+        write_occupancy_map(binary_maps, 1000, 2000, "EPSG:2154", out_dir / name / "tile.tif", 0.5)
+
+    mpla0_relative.compute_metric_relative(
+        out_dir / "c1",
+        out_dir / "ref",
+        CONFIG_FILE_METRICS,
+        out_dir / "result.csv",
+        out_dir / "result_tile.csv",
+        pooled_pixel_sizes=(1, 2.5),
+    )
+
+    df = pd.read_csv(out_dir / "result.csv", sep=csv_separator)
+    pooled_cols = {f"{col}_{size}m" for col in ["intersection", "union", "iou"] for size in ["1", "2.5"]}
+    assert set(df.columns) == {"class", "ref_pixel_count", "intersection", "union"} | pooled_cols
+    df_tile = pd.read_csv(out_dir / "result_tile.csv", sep=csv_separator)
+    assert df_tile.drop(columns="tile").equals(df)
+
+    for factor, size in [(2, "1"), (5, "2.5")]:
+        c1_pooled = mpla0_relative.pool_layers(maps["c1"], factor)
+        ref_pooled = mpla0_relative.pool_layers(maps["ref"], factor)
+        expected_intersection = np.count_nonzero(c1_pooled & ref_pooled, axis=(1, 2))
+        expected_union = np.count_nonzero(c1_pooled | ref_pooled, axis=(1, 2))
+        assert list(df[f"intersection_{size}m"]) == list(expected_intersection)
+        assert list(df[f"union_{size}m"]) == list(expected_union)
+        assert df[f"iou_{size}m"].iloc[-1] == 1  # class without pixels
+        assert (df[f"iou_{size}m"] >= df["intersection"] / df["union"]).iloc[:-1].all()
+
+
+def test_compute_buffered_intersection():
+    c1_layer = np.zeros((10, 12), dtype=np.uint8)
+    ref_layer = np.zeros((10, 12), dtype=np.uint8)
+    c1_layer[2:5, 2:5] = 1
+    ref_layer[2:5, 3:6] = 1  # shifted by 1 pixel
+    ref_layer[8, 11] = 1  # far from c1
+    c1_layer[6, 6] = 1  # sqrt(5) pixels from ref
+    tolerances = (0, 1, 2, 3)
+    buffered_intersection = mpla0_relative.compute_buffered_intersection(c1_layer, ref_layer, tolerances)
+    # tolerance 0: usual intersection, 1: shifted borders are matched, 3: isolated c1 pixel is matched
+    assert buffered_intersection == [6, 12, 12, 13]
+    assert mpla0_relative.compute_buffered_intersection(c1_layer, np.zeros_like(ref_layer), tolerances) == [0] * 4
+
+
+def test_compute_metric_relative_buffered():
+    rng = np.random.default_rng(0)
+    occupancy = np.array([0.3, 0.02, 0.02, 0.3, 0.3, 0])[:, None, None]
+    maps = {name: (rng.uniform(0, 1, (6, 20, 30)) < occupancy).astype(np.uint8) for name in ["c1", "ref"]}
+    results = {}
+    for sparse_max_occupancy in [0, 0.05]:
+        out_dir = TMP_PATH / "buffered" / str(sparse_max_occupancy)
+        for name, binary_maps in maps.items():
+            write_occupancy_map(
+                binary_maps,
+                1000,
+                2000,
+                "EPSG:2154",
+                out_dir / name / "tile.tif",
+                0.5,
+                sparse_max_occupancy=sparse_max_occupancy,
+            )
+
+        mpla0_relative.compute_metric_relative(
+            out_dir / "c1",
+            out_dir / "ref",
+            CONFIG_FILE_METRICS,
+            out_dir / "result.csv",
+            out_dir / "result_tile.csv",
+            buffer_tolerances=(0, 1, 1.5),
+        )
+        results[sparse_max_occupancy] = pd.read_csv(out_dir / "result.csv", sep=csv_separator)
+
+    df = results[0]
+    assert results[0.05].equals(df)
+    assert set(df.columns) == {"class", "ref_pixel_count", "intersection", "union"} | {
+        f"{col}_buffer_{tolerance}px" for col in ["intersection", "iou"] for tolerance in ["0", "1", "1.5"]
+    }
+    assert list(df["intersection_buffer_0px"]) == list(df["intersection"])
+    assert (df["intersection_buffer_1px"] >= df["intersection_buffer_0px"]).all()
+    assert (df["intersection_buffer_1.5px"] >= df["intersection_buffer_1px"]).all()
+    assert (df["intersection_buffer_1.5px"] <= df["union"]).all()
+    assert df["iou_buffer_1px"].iloc[-1] == 1  # class without pixels
+    for ii, (c1_layer, ref_layer) in enumerate(zip(maps["c1"], maps["ref"])):
+        assert (
+            df["intersection_buffer_1px"].iloc[ii]
+            == mpla0_relative.compute_buffered_intersection(c1_layer, ref_layer, (1,))[0]
+        )
+
+
 def test_run_main():
     c1_dir = Path("./data/mpla0/c1/intrinsic")
     ref_dir = Path("./data/mpla0/ref/intrinsic")
@@ -0,0 +1,92 @@
+import json
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pytest
+import rasterio
+from gpao_utils.store import Store
+
+from coclico import intrinsic_all
+from coclico.mpap0 import mpap0_intrinsic
+
+TMP_PATH = Path("./tmp/intrinsic_all")
+CONFIG_FILE_METRICS = Path("./test/configs/config_test_metrics.yaml")
+
+STORE = Store("local_store", "win_store", "unix_store")
+
+
+def setup_module(module):
+    if TMP_PATH.is_dir():
+        shutil.rmtree(TMP_PATH)
+
+
+def test_create_intrinsic_all_jobs():
+    tile_names = ["tile_splitted_2818_32247.laz", "tile_splitted_2818_32248.laz"]
+    input_path = Path("local_store/c1")
+    out_path = Path("local_store/out/c1")
+    config_file = Path("local_store/out/config.yaml")
+
+    jobs = intrinsic_all.create_intrinsic_all_jobs("c1", tile_names, input_path, out_path, STORE, config_file)
+
+    assert [job.name for job in jobs] == [
+        "intrinsic_all_c1_tile_splitted_2818_32247",
+        "intrinsic_all_c1_tile_splitted_2818_32248",
+    ]
+    assert all("python -m coclico.intrinsic_all" in job.command for job in jobs)
+    # the tile is mounted as /input in the container: the output files are named after the tile name
+    assert ":/input\n" in jobs[0].command
+    assert "--output-stem tile_splitted_2818_32247\n" in jobs[0].command
+    assert "--output-stem tile_splitted_2818_32248\n" in jobs[1].command
+    assert not any("--laz-threads" in job.command for job in jobs)
+
+    jobs = intrinsic_all.create_intrinsic_all_jobs(
+        "c1", tile_names, input_path, out_path, STORE, config_file, laz_threads=0
+    )
+    assert all("--laz-threads 0" in job.command for job in jobs)
+
+
+def test_compute_intrinsic_all_output_stem(monkeypatch):
+    class FakeMetric:
+        intrinsic_output_extension = ".tif"
+
+        def __init__(self, store, config_file):
+            pass
+
+        def compute_metric_intrinsic_from_points(self, las_file, points, output):
+            output.parent.mkdir(parents=True, exist_ok=True)
+            output.touch()
+
+    monkeypatch.setattr(intrinsic_all.occupancy_map, "read_las", lambda las_file, dimensions: None)
+    monkeypatch.setattr(intrinsic_all, "METRICS", {"mpla0": FakeMetric, "unused": FakeMetric})
+    output_dir = TMP_PATH / "compute_intrinsic_all_output_stem"
+
+    intrinsic_all.compute_intrinsic_all(Path("/input"), CONFIG_FILE_METRICS, output_dir, "tile_splitted_2818_32247")
+
+    assert [p.name for p in output_dir.rglob("*.tif")] == ["tile_splitted_2818_32247.tif"]
+    assert (output_dir / "mpla0" / "intrinsic" / "tile_splitted_2818_32247.tif").is_file()
+
+
+@pytest.mark.docker
+def test_compute_intrinsic_all(ensure_test1_data):
+    las_file = Path("./data/test1/niv1/tile_splitted_2818_32247.laz")
+    output_dir = TMP_PATH / "compute_intrinsic_all"
+
+    intrinsic_all.compute_intrinsic_all(las_file, CONFIG_FILE_METRICS, output_dir)
+
+    for metric_name, extension in [("mpap0", ".json"), ("mpla0", ".tif"), ("malt0", ".tif"), ("mobj0", ".json")]:
+        assert (output_dir / metric_name / "intrinsic" / f"{las_file.stem}{extension}").is_file()
+
+    # Results should be the same as the ones from the metric-by-metric intrinsic computation
+    expected_mpap0 = TMP_PATH / "expected_mpap0.json"
+    mpap0_intrinsic.compute_metric_intrinsic(las_file, CONFIG_FILE_METRICS, expected_mpap0)
+    with open(expected_mpap0, "r") as f:
+        expected_counts = json.load(f)
+    with open(output_dir / "mpap0" / "intrinsic" / f"{las_file.stem}.json", "r") as f:
+        counts = json.load(f)
+    assert counts == expected_counts
+
+    with rasterio.Env():
+        with rasterio.open(output_dir / "mpla0" / "intrinsic" / f"{las_file.stem}.tif") as f:
+            mpla0_raster = f.read()
+    assert np.any(mpla0_raster)
@@ -1,10 +1,23 @@
+import shutil
 from pathlib import Path
 
+import laspy
+import numpy as np
 import pytest
+import rasterio
+import yaml
 
 import coclico.io as io
+import coclico.metrics.commons
 from coclico.metrics.listing import METRICS
 
+TMP_PATH = Path("./tmp/io")
+
+
+def setup_module(module):
+    if TMP_PATH.is_dir():
+        shutil.rmtree(TMP_PATH)
+
 
 def test_read_config_file_ok():
     config_file = Path("./test/configs/config_test_main.yaml")
@@ -20,3 +33,195 @@ def test_read_config_file_fail():
     config_file = Path("./test/configs/config_test_read_fail.yaml")
     with pytest.raises(ValueError):
         io.read_config_file(config_file)
+
+
+def test_read_config_file_too_many_classes():
+    config_file = TMP_PATH / "config_too_many_classes.yaml"
+    config_file.parent.mkdir(parents=True, exist_ok=True)
+    weights = {str(ii): 1 for ii in range(coclico.metrics.commons.MAX_CLASS_KEYS + 1)}
+    with open(config_file, "w") as f:
+        yaml.safe_dump({"mpap0": {"weights": weights, "notes": {}}}, f)
+
+    with pytest.raises(ValueError):
+        io.read_config_file(config_file)
+
+
+def test_read_las_points(ensure_test1_data):
+    las_file = Path("./data/test1/niv1/tile_splitted_2818_32247.laz")
+    las = laspy.read(las_file)
+
+    points = io.read_las_points(las_file, chunk_size=10000)
+
+    assert points.nb_points == len(las.points)
+    assert points.X.dtype == np.int32
+    assert points.classification.dtype == np.uint8
+    assert np.array_equal(points.xs, las.x)
+    assert np.array_equal(points.ys, las.y)
+    assert np.array_equal(points.zs, las.z)
+    assert np.array_equal(points.classification, las.classification)
+    assert points.nbytes == len(las.points) * (3 * 4 + 1)
+
+
+def test_read_las_points_selected_dimensions(ensure_test1_data):
+    las_file = Path("./data/test1/niv1/tile_splitted_2818_32247.laz")
+    las = laspy.read(las_file)
+
+    points = io.read_las_points(las_file, dimensions=("classification",))
+
+    assert points.X is None and points.Y is None and points.Z is None
+    assert np.array_equal(points.classification, las.classification)
+    assert points.nbytes == len(las.points)
+
+
+def test_iter_las_points(ensure_test1_data):
+    las_file = Path("./data/test1/niv1/tile_splitted_2818_32247.laz")
+    las = laspy.read(las_file)
+
+    chunks = list(io.iter_las_points(las_file, chunk_size=10000, dimensions=("X", "classification")))
+
+    assert all(chunk.nb_points <= 10000 for chunk in chunks)
+    assert np.array_equal(np.concatenate([chunk.xs for chunk in chunks]), las.x)
+    assert np.array_equal(np.concatenate([chunk.classification for chunk in chunks]), las.classification)
+
+
+def test_memmap_las_points(ensure_test1_data):
+    laz_file = Path("./data/test1/niv1/tile_splitted_2818_32247.laz")
+    las_file = TMP_PATH / "tile_splitted_2818_32247.las"
+    las_file.parent.mkdir(parents=True, exist_ok=True)
+    las = laspy.read(laz_file)
+    las.write(las_file)
+
+    points = io.read_las_points(las_file)
+
+    assert isinstance(points.X.base, np.memmap)
+    assert np.array_equal(points.xs, las.x)
+    assert np.array_equal(points.ys, las.y)
+    assert np.array_equal(points.zs, las.z)
+    assert np.array_equal(points.classification, las.classification)
+
+    chunks = list(io.iter_las_points(las_file, chunk_size=10000, dimensions=("Y", "classification")))
+    assert all(chunk.X is None and chunk.nb_points <= 10000 for chunk in chunks)
+    assert np.array_equal(np.concatenate([chunk.ys for chunk in chunks]), las.y)
+
+    with pytest.raises(ValueError):
+        io.memmap_las_points(laz_file)
+
+
+def test_read_cgroup_cpu_quota():
+    cgroup_root = TMP_PATH / "cgroup"
+    cgroup_root.mkdir(parents=True)
+    assert io._read_cgroup_cpu_quota(cgroup_root) is None
+
+    (cgroup_root / "cpu.max").write_text("max 100000\n")
+    assert io._read_cgroup_cpu_quota(cgroup_root) is None
+
+    (cgroup_root / "cpu.max").write_text("250000 100000\n")
+    assert io._read_cgroup_cpu_quota(cgroup_root) == 2.5
+
+    (cgroup_root / "cpu.max").unlink()
+    (cgroup_root / "cpu").mkdir()
+    (cgroup_root / "cpu" / "cpu.cfs_quota_us").write_text("-1\n")
+    (cgroup_root / "cpu" / "cpu.cfs_period_us").write_text("100000\n")
+    assert io._read_cgroup_cpu_quota(cgroup_root) is None
+
+    (cgroup_root / "cpu" / "cpu.cfs_quota_us").write_text("50000\n")
+    assert io._read_cgroup_cpu_quota(cgroup_root) == 0.5
+    # a quota lower than 1 CPU still allows 1 thread
+    assert io.get_available_cpu_count(cgroup_root) == 1
+
+
+def test_configure_laz_decompression():
+    available_cpu_count = io.get_available_cpu_count()
+    try:
+        assert io.configure_laz_decompression(1) == 1
+        assert io._laz_backend is None
+
+        threads = io.configure_laz_decompression(0)
+        assert 1 <= threads <= available_cpu_count
+        assert io.configure_laz_decompression(available_cpu_count + 10) == threads
+    finally:
+        io.configure_laz_decompression()
+
+
+@pytest.mark.parametrize(
+    "dtype,nodata,compress,nbits,expected_predictor",
+    [
+        (np.float32, -9999, "deflate", None, "3"),
+        (np.int16, -32768, "zstd", None, "2"),
+        (np.uint8, None, "lzw", 1, None),
+        (np.float32, -9999, None, None, None),
+    ],
+)
+def test_write_raster(dtype, nodata, compress, nbits, expected_predictor):
+    output_tif = TMP_PATH / f"unit_test_write_raster_{np.dtype(dtype).name}_{compress}.tif"
+    empty_value = 0 if nodata is None else nodata
+    raster = np.full((3, 300, 200), empty_value, dtype=dtype)
+    raster[0, :100, :50] = 1
+    raster[2, 150:, 20:] = 0 if nbits else 12
+    raster[2, 150, 20] = 1
+    transform = rasterio.transform.from_origin(1000, 2000, 0.5, 0.5)
+
+    io.write_raster(
+        raster,
+        output_tif,
+        transform,
+        "EPSG:2154",
+        nodata=nodata,
+        compress=compress,
+        nbits=nbits,
+        descriptions=["a", "b", "c"],
+    )
+
+    with rasterio.open(output_tif) as f:
+        assert f.count == 3
+        assert f.transform == transform
+        assert f.nodata == nodata
+        assert f.descriptions == ("a", "b", "c")
+        assert f.profile["tiled"]
+        assert f.compression == (rasterio.enums.Compression(compress.upper()) if compress else None)
+        image_structure = f.tags(ns="IMAGE_STRUCTURE")
+        assert image_structure.get("PREDICTOR") == expected_predictor
+        assert f.tags(1, "IMAGE_STRUCTURE").get("NBITS") == (str(nbits) if nbits else None)
+        assert np.all(f.read() == raster)
+
+    assert list(coclico.metrics.commons.read_empty_layers(output_tif)) == [False, True, False]
+
+
+def test_write_raster_scales_offsets():
+    output_tif = TMP_PATH / "unit_test_write_raster_scales_offsets.tif"
+    raster = np.arange(2 * 20 * 10, dtype=np.int16).reshape((2, 20, 10))
+    transform = rasterio.transform.from_origin(1000, 2000, 0.5, 0.5)
+
+    io.write_raster(raster, output_tif, transform, "EPSG:2154", scales=[0.01, 0.1], offsets=[10, 20])
+
+    with rasterio.open(output_tif) as f:
+        assert f.scales == (0.01, 0.1)
+        assert f.offsets == (10, 20)
+        assert np.all(f.read() == raster)
+
+
+@pytest.mark.parametrize("sparse_values", [True, False])
+def test_write_raster_sparse_layers(sparse_values):
+    output_tif = TMP_PATH / f"unit_test_write_raster_sparse_layers_{sparse_values}.tif"
+    nodata = -9999 if sparse_values else None
+    empty_value = 0 if nodata is None else nodata
+    raster = np.full((3, 300, 200), empty_value, dtype=np.int16)
+    raster[0, :100] = 1  # dense layer
+    raster[2, [0, 150, 299], [0, 100, 199]] = [1, 1, 1] if not sparse_values else [5, -3, 12]  # sparse layer
+    transform = rasterio.transform.from_origin(1000, 2000, 0.5, 0.5)
+
+    io.write_raster(
+        raster,
+        output_tif,
+        transform,
+        "EPSG:2154",
+        nodata=nodata,
+        sparse_max_occupancy=0.01,
+        sparse_values=sparse_values,
+    )
+
+    assert list(coclico.metrics.commons.read_sparse_layers(output_tif).keys()) == [2]
+    with rasterio.open(output_tif) as f:
+        # the band of the sparse layer is not written
+        assert np.all(f.read(3) == empty_value)
+        assert np.array_equal(coclico.metrics.commons.read_dense_layers(f), raster)
@@ -116,6 +116,44 @@ def test_create_compare_project_unlock(ensure_test1_data):
     assert np.sum([job.name.endswith("_unlock") for job in project.jobs]) == 3
 
 
+def test_create_compare_project_fused_intrinsic(ensure_test1_data):
+    c1 = Path("./data/test1/niv1/")
+    c2 = Path("./data/test1/niv4/")
+    ref = Path("./data/test1/ref/")
+    out = TMP_PATH / "create_compare_project_fused_intrinsic"
+    project_name = "coclico_test_create_compare_projects_fused_intrinsic"
+    config_file = Path("./test/configs/config_test_main.yaml")  # mpap0, mpla0 and malt0
+
+    project = main.create_compare_project([c1, c2], ref, out, STORE, project_name, config_file, fused_intrinsic=True)
+
+    # One intrinsic job per tile for each classification (ref, niv1, niv4), instead of one per tile and metric
+    assert np.sum(["_intrinsic_" in job.name for job in project.jobs]) == 0
+    assert np.sum([job.name.startswith("intrinsic_all_") for job in project.jobs]) == 3 * 4
+    assert np.sum([job.name.endswith("_relative_to_ref") for job in project.jobs]) == 2 * 3
+    for metric_name in ["mpap0", "mpla0", "malt0"]:
+        assert (out / "ref" / metric_name / "intrinsic").is_dir()
+
+
+def test_create_compare_project_chunk_size(ensure_test1_data):
+    c1 = Path("./data/test1/niv1/")
+    c2 = Path("./data/test1/niv4/")
+    ref = Path("./data/test1/ref/")
+    out = TMP_PATH / "create_compare_project_chunk_size"
+    project_name = "coclico_test_create_compare_projects_chunk_size"
+    config_file = Path("./test/configs/config_test_main.yaml")  # mpap0, mpla0 and malt0
+
+    project = main.create_compare_project([c1, c2], ref, out, STORE, project_name, config_file, chunk_size=100000)
+
+    intrinsic_jobs = [job for job in project.jobs if "_intrinsic_" in job.name]
+    assert len(intrinsic_jobs) == 3 * 3 * 4
+    assert all("--chunk-size 100000" in job.command for job in intrinsic_jobs)
+
+    with pytest.raises(ValueError):
+        main.create_compare_project(
+            [c1, c2], ref, out, STORE, project_name, config_file, fused_intrinsic=True, chunk_size=100000
+        )
+
+
 @pytest.mark.gpao
 def test_compare_test1_default(ensure_test1_data, use_gpao_server):
     c1 = Path("./data/test1/niv1/")